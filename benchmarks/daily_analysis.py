@@ -0,0 +1,158 @@
+"""
+    Benchmark of the analysis of the daily COVID data (see DailyCOVIDData in dags/taskgroups/DataAnalysis.py): the wall
+    time and the peak memory allocated by each analysis task (cases, deaths and hospitalizations), from reading the
+    snapshot of the merged data to building every document to be stored. The data is synthetic, with the same series as
+    the RENAVE dataset, and the documents are built as when they are written into MongoDB, but they are discarded, so
+    no database is needed. With --incremental, only the last days are recomputed and upserted, from a snapshot with the
+    look-back days they need (see IncrementalAnalysis).
+
+    Run it from the root of the repository, with the same dependencies as the Airflow image:
+        python benchmarks/daily_analysis.py [--days 500] [--incremental 30] [--repeat 3] [--output results.json]
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import timedelta as td
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags', 'taskgroups'))
+from AuxiliaryFunctions import MongoDatabase  # noqa: E402
+from DataAnalysis import DailyCOVIDData  # noqa: E402
+from increase_percentages import daily_dataframe  # noqa: E402
+
+tasks = {
+    # task: DailyCOVIDData method, collection
+    'analyze_cases_data': ('process_and_store_cases', 'cases'),
+    'analyze_deaths_data': ('process_and_store_deaths', 'deaths'),
+    'analyze_hospitalizations_data': ('process_and_store_hospitalizations', 'hospitalizations')
+}
+
+
+class DiscardingCollection:
+    """Collection that accepts the writes of MongoDatabase without storing anything"""
+
+    def __init__(self, name):
+        self.name = name
+        self.documents = 0
+
+    def delete_many(self, filters):
+        pass
+
+    def list_indexes(self):
+        return [{}, {}]
+
+    def create_index(self, keys):
+        pass
+
+    def insert_many(self, documents, ordered=True):
+        self.documents += len(documents)
+
+    def bulk_write(self, operations, ordered=True):
+        self.documents += len(operations)
+
+
+class DiscardingDatabase(MongoDatabase):
+    """MongoDatabase whose collections discard the documents, once they have been built"""
+
+    def __init__(self):
+        self.client = self.db = self
+        self.collections = {}
+
+    def get_collection(self, collection_name):
+        if collection_name not in self.collections:
+            self.collections[collection_name] = DiscardingCollection(collection_name)
+
+        return self.collections[collection_name]
+
+    def close(self):
+        pass
+
+
+def merged_dataframe(number_of_days):
+    """Return the synthetic daily data merged with the population, sorted as in DailyCOVIDData"""
+    rng = np.random.default_rng(1)
+    df = daily_dataframe(number_of_days).reset_index()
+    for column in ['new_cases', 'new_deaths', 'new_hospitalizations', 'new_ic_hospitalizations']:
+        df[column.replace('new_', 'total_')] = df.groupby(DailyCOVIDData.series_columns)[column].cumsum()
+    df['population'] = rng.integers(10 ** 4, 10 ** 6, len(df))
+
+    return df.sort_values(DailyCOVIDData.series_columns + ['date'])
+
+
+def write_snapshot(df, path, incremental_days):
+    """Write the snapshot of the data, or of the days needed to recompute the last days"""
+    df = df.set_index('date')
+    analysis_start = input_start = None
+    if incremental_days:
+        analysis_start = (df.index.max() - td(days=incremental_days - 1)).to_pydatetime()
+        input_start = DailyCOVIDData.__input_start__(df, analysis_start, True)
+        df = df[df.index >= input_start]
+
+    DailyCOVIDData.write_snapshot_file(df, path, analysis_start, input_start, '')
+
+
+def run_task(snapshot, method, collection):
+    """Run an analysis task over a snapshot, returning the number of documents built"""
+    data = DailyCOVIDData.__new__(DailyCOVIDData)
+    data.df, data.analysis_start, data.input_start, data.analysis_version = \
+        DailyCOVIDData.__read_snapshot__(snapshot)
+    data.db_write = DiscardingDatabase()
+    getattr(data, method)()
+
+    return data.db_write.get_collection(collection).documents
+
+
+def measure(function, repeat):
+    """Return the result and the time of the fastest run of a function, and the peak memory allocated in another run"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, min(times), peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the analysis tasks of the daily COVID data")
+    parser.add_argument('--days', type=int, default=500, help="number of days of each series")
+    parser.add_argument('--incremental', type=int, default=0, help="number of last days recomputed (0 for all)")
+    parser.add_argument('--repeat', type=int, default=3, help="number of timed runs of each task")
+    parser.add_argument('--output', help="JSON file where the results will be saved")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        snapshot = temporary_directory + '/daily_data.feather'
+        write_snapshot(merged_dataframe(args.days), snapshot, args.incremental)
+
+        print("%-32s %10s %10s %12s %12s" % ('Task', 'Documents', 'Time (s)', 'Rows/s', 'Peak (MB)'))
+        for task, (method, collection) in tasks.items():
+            documents, seconds, peak_memory = measure(lambda: run_task(snapshot, method, collection), args.repeat)
+            results[task] = {'documents': documents, 'seconds': seconds, 'peak_memory_mb': peak_memory / 2 ** 20}
+            print("%-32s %10i %10.3f %12.0f %12.1f" % (task, documents, seconds, documents / seconds,
+                                                      peak_memory / 2 ** 20))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
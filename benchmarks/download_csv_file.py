@@ -0,0 +1,151 @@
+"""
+    Benchmark of the conditional downloads of the CSV datasets (see download_csv_file and RawFileStore in
+    dags/AuxiliaryFunctions.py) against a local HTTP server standing in for the data sources: the first download, a
+    304 response, the same content with a new ETag, a new content and a 404 response. The status, the bytes received
+    and the time of each request are shown, so the cost of a full download can be compared with the one of a
+    conditional request. For each one, the return value of download_csv_file, the stored content and its validators
+    (ETag and Last-Modified) must be the expected ones, otherwise the exit status is 1.
+
+    Run it from the root of the repository, with the same dependencies as the Airflow image:
+        python benchmarks/download_csv_file.py [--size 50]
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+from AuxiliaryFunctions import DownloadManager, RawFileStore, download_csv_file  # noqa: E402
+
+filename = 'daily_covid_data.csv'
+
+
+class SourceHandler(BaseHTTPRequestHandler):
+    """Serve the current content of the stand-in server, answering the conditional requests as the sources do"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.status_code != 200:
+            self.send_response(server.status_code)
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == server.etag:
+            # A 304 response doesn't have to repeat all the validators
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', server.etag)
+            self.send_header('Last-Modified', server.last_modified)
+            self.send_header('Content-Length', str(len(server.content)))
+            self.end_headers()
+            self.wfile.write(server.content)
+
+    def log_message(self, *args):
+        """Don't print each request"""
+
+
+def csv_content(size, days):
+    """Return a CSV like the RENAVE one, of about size MB, with some rows for each day"""
+    rows = [b'fecha,num_casos\n']
+    rows_per_day = max(1, size * 10 ** 6 // 20 // days)
+    for day in range(days):
+        rows.append(b''.join(b'2021-%02i-%02i,%i\n' % (day // 28 % 12 + 1, day % 28 + 1, row)
+                             for row in range(rows_per_day)))
+
+    return b''.join(rows)
+
+
+def start_server(content):
+    """Start the stand-in server in a thread, listening in a free port"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SourceHandler)
+    server.requests = []
+    server.status_code = 200
+    server.content = content
+    server.etag = '"v1"'
+    server.last_modified = 'Fri, 01 Jan 2021 00:00:00 GMT'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def stored_file():
+    """Return the stored file and its content, reading the manifest again as the next task would do"""
+    raw_file = RawFileStore('csv_data').get(filename)
+    with open(raw_file.path, 'rb') as file:
+        return raw_file, file.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark and check the conditional downloads of the CSV datasets")
+    parser.add_argument('--size', type=int, default=50, help="size of the CSV file, in MB")
+    args = parser.parse_args()
+
+    server = start_server(csv_content(args.size, 300))
+    url = 'http://127.0.0.1:%i/%s' % (server.server_address[1], filename)
+    download_manager = DownloadManager(requests_per_second=None, retries=0)
+    os.chdir(tempfile.mkdtemp())  # the store and the csv_data folder are relative to the working directory
+
+    def first_download():
+        return {'ETag stored': '"v1"', 'Last-Modified stored': server.last_modified}
+
+    def not_modified():
+        return {'ETag kept': '"v1"', 'Last-Modified kept': server.last_modified}
+
+    def new_etag():
+        server.etag = '"v2"'
+        return {'new ETag stored': '"v2"', 'Last-Modified kept': server.last_modified}
+
+    def new_content():
+        server.content += b'2021-12-31,1\n'
+        server.etag = '"v3"'
+        server.last_modified = 'Sat, 02 Jan 2021 00:00:00 GMT'
+        return {'new ETag stored': '"v3"', 'new Last-Modified stored': server.last_modified}
+
+    def not_found():
+        server.status_code = 404
+        return {'ETag kept': '"v3"', 'Last-Modified kept': server.last_modified}
+
+    # Case: function changing the server and returning the expected validators, expected return value
+    cases = {'First download': (first_download, True),
+             'Not modified (304)': (not_modified, False),
+             'Same content with a new ETag': (new_etag, False),
+             'Changed content': (new_content, True),
+             'Not found (404)': (not_found, False)}
+
+    print("CSV file of %.1f MB" % (len(server.content) / 1e6))
+    print("%-30s %8s %12s %10s  %s" % ('Case', 'Status', 'Bytes', 'Time (s)', 'Checks'))
+    all_passed = True
+    for case, (prepare, expected_changed) in cases.items():
+        expected_validators = prepare()
+        stored_content = server.content if server.status_code == 200 else stored_file()[1]
+        changed = download_csv_file(url, filename, download_manager=download_manager)
+        result = download_manager.timings[-1]
+        raw_file, content = stored_file()
+
+        conditions = {'returns %s' % expected_changed: changed is expected_changed,
+                      'content stored': content == stored_content,
+                      'hash stored': raw_file.sha256 == hashlib.sha256(stored_content).hexdigest()}
+        for condition, value in expected_validators.items():
+            field = 'etag' if 'ETag' in condition else 'last_modified'
+            conditions[condition] = raw_file.metadata.get(field) == value
+        if case != 'First download':
+            conditions['conditional request'] = server.requests[-1].get('If-None-Match') is not None and \
+                server.requests[-1].get('If-Modified-Since') is not None
+
+        failed = [condition for condition, met in conditions.items() if not met]
+        all_passed = all_passed and not failed
+        print("%-30s %8i %12i %10.3f  %s" % (case, result.status_code, result.size, result.elapsed_time,
+                                             'FAILED: ' + ', '.join(failed) if failed else 'ok'))
+
+    server.shutdown()
+    if not all_passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+    Benchmark of the increase percentages of the daily COVID data (see DailyCOVIDData in
+    dags/taskgroups/DataAnalysis.py): the groupby().rolling().apply() calls with a Python function for each window, used
+    before, against the vectorized increase_percentage_by_time and increase_percentage_by_rows, over synthetic series
+    with the same shape as the RENAVE dataset (Autonomous Region, gender and age range). The results must be identical,
+    otherwise the exit status is 1.
+
+    Run it from the root of the repository, with the same dependencies as the Airflow image:
+        python benchmarks/increase_percentages.py [--days 500] [--repeat 3]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags', 'taskgroups'))
+from DataAnalysis import DailyCOVIDData  # noqa: E402
+
+autonomous_regions = ['Andalucía', 'Aragón', 'Asturias', 'Baleares', 'Canarias', 'Cantabria', 'Castilla-La Mancha',
+                      'Castilla y León', 'Cataluña', 'Ceuta', 'Comunidad Valenciana', 'Extremadura', 'Galicia',
+                      'Madrid', 'Melilla', 'Murcia', 'Navarra', 'País Vasco', 'La Rioja', 'España']
+genders = ['M', 'F', 'total']
+age_ranges = ['0-9', '10-19', '20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80+', 'total']
+
+
+def daily_dataframe(number_of_days):
+    """Return a DataFrame indexed by date like the daily COVID data, sorted by date, with many days without cases"""
+    rng = np.random.default_rng(0)
+    dates = pd.date_range('2020-01-01', periods=number_of_days)
+    index = pd.MultiIndex.from_product([dates, autonomous_regions, genders, age_ranges],
+                                       names=['date'] + DailyCOVIDData.series_columns)
+    df = index.to_frame(index=False)
+    for column in ['new_cases', 'new_deaths', 'new_hospitalizations', 'new_ic_hospitalizations']:
+        df[column] = rng.poisson(2, len(df)) * rng.integers(0, 2, len(df))
+
+    return df.set_index('date')
+
+
+def measure(function, repeat):
+    """Return the result and the time of the fastest run of a function"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the calculation of the increase percentages")
+    parser.add_argument('--days', type=int, default=500, help="number of days of each series")
+    parser.add_argument('--repeat', type=int, default=3, help="number of timed runs of each calculation")
+    args = parser.parse_args()
+
+    df = daily_dataframe(args.days)
+    series = DailyCOVIDData.series_columns
+    apply = DailyCOVIDData.calculate_increase_percentage
+
+    calculations = []
+    for window in ['2D', '8D', '15D', '31D']:
+        # Deaths and hospitalizations: increase over a time window of each series
+        for columns in ['new_deaths', ['new_hospitalizations', 'new_ic_hospitalizations']]:
+            name = '%s %s' % (window, columns if isinstance(columns, str) else '+'.join(columns))
+            calculations.append((
+                name,
+                lambda c=columns, w=window: df.groupby(series)[c].rolling(w).apply(apply, raw=True),
+                lambda c=columns, w=window: DailyCOVIDData.increase_percentage_by_time(df, c, w)))
+    for window, rows in [('7D', 2), ('14D', 8), ('60D', 31)]:
+        # Cases: increase over some rows of the moving average
+        moving_average = df.groupby(series)['new_cases'].rolling(window).mean()
+        calculations.append((
+            '%s mean, %i rows' % (window, rows),
+            lambda moving_average=moving_average, rows=rows: moving_average.rolling(rows).apply(apply, raw=True),
+            lambda moving_average=moving_average, rows=rows: DailyCOVIDData.increase_percentage_by_rows(
+                moving_average, rows)))
+
+    print("%i series of %i days (%i rows)" % (len(autonomous_regions) * len(genders) * len(age_ranges), args.days,
+                                              len(df)))
+    print("%-48s %12s %12s %10s %10s" % ('Calculation', 'apply (s)', 'vector (s)', 'Speedup', 'Identical'))
+    all_identical = True
+    total_apply_time = total_vectorized_time = 0
+    for calculation, apply_function, vectorized_function in calculations:
+        apply_result, apply_time = measure(apply_function, args.repeat)
+        vectorized_result, vectorized_time = measure(vectorized_function, args.repeat)
+        identical = apply_result.index.equals(vectorized_result.index) and \
+            np.array_equal(apply_result.to_numpy(), vectorized_result.to_numpy(), equal_nan=True)
+        all_identical = all_identical and identical
+        total_apply_time += apply_time
+        total_vectorized_time += vectorized_time
+        print("%-48s %12.3f %12.3f %9.0fx %10s" % (calculation, apply_time, vectorized_time,
+                                                   apply_time / vectorized_time, 'yes' if identical else 'no'))
+
+    print("%-48s %12.3f %12.3f %9.0fx" % ('Total', total_apply_time, total_vectorized_time,
+                                          total_apply_time / total_vectorized_time))
+    if not all_identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
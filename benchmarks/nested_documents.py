@@ -0,0 +1,118 @@
+"""
+    Benchmark of the conversion of DataFrames with dotted column paths into nested MongoDB documents: the loop over
+    every key of every record used before for the vaccination reports, against dataframe_to_documents (see
+    dags/AuxiliaryFunctions.py), which builds the documents column-wise. The flat df.to_dict('records') is also timed as
+    a reference. Both conversions must return the same documents, otherwise the exit status is 1.
+
+    Run it from the root of the repository, with the same dependencies as the Airflow image:
+        python benchmarks/nested_documents.py [--rows 200000] [--repeat 3]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+from datetime import datetime as dt, timedelta as td
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+from AuxiliaryFunctions import dataframe_to_documents  # noqa: E402
+
+autonomous_regions = ['Andalucía', 'Aragón', 'Asturias', 'Baleares', 'Canarias', 'Cantabria', 'Castilla La Mancha',
+                      'Castilla y León', 'Cataluña', 'Ceuta', 'C. Valenciana', 'Extremadura', 'Galicia', 'Madrid',
+                      'Melilla', 'Murcia', 'Navarra', 'País Vasco', 'La Rioja', 'España']
+
+
+def vaccination_dataframe(number_of_rows):
+    """Return a DataFrame like the general data of the vaccination reports, with one row per region and day"""
+    rng = np.random.default_rng(0)
+    regions = np.resize(autonomous_regions, number_of_rows)
+    dates = [dt(2021, 1, 11) + td(days=i // len(autonomous_regions)) for i in range(number_of_rows)]
+    df = pd.DataFrame({'autonomous_region': regions})
+    for manufacturer in ['total', 'Pfizer', 'Moderna', 'AstraZeneca', 'Janssen']:
+        df['received_doses.' + manufacturer] = rng.integers(0, 10 ** 6, number_of_rows)
+    df['applied_doses'] = rng.integers(0, 10 ** 6, number_of_rows)
+    df['percentage_applied_doses'] = rng.uniform(0, 100, number_of_rows)
+    df['number_at_least_single_dose_people'] = rng.integers(0, 10 ** 6, number_of_rows).astype('float64')
+    df.loc[::7, 'number_at_least_single_dose_people'] = np.nan  # older reports don't have this column
+    df['number_fully_vaccinated_people'] = rng.integers(0, 10 ** 6, number_of_rows)
+    df['date'] = pd.to_datetime(dates)
+
+    return df
+
+
+def loop_documents(df):
+    """Nested documents built as in the vaccination reports before dataframe_to_documents"""
+    mongo_data = []
+    for record in df.to_dict('records'):
+        transformed_record = {}
+        mongo_data.append(transformed_record)
+        for k, v in record.items():
+            if '.' not in k:
+                transformed_record[k] = v
+            else:
+                key, subkey = k.split('.')
+                if key not in transformed_record:
+                    transformed_record[key] = {}
+
+                transformed_record[key][subkey] = v
+
+    return mongo_data
+
+
+def same_documents(documents, reference_documents):
+    """Compare two lists of documents, considering the NaN values equal (NaN != NaN)"""
+    def normalize(value):
+        if isinstance(value, dict):
+            return {key: normalize(item) for key, item in value.items()}
+        return None if isinstance(value, float) and value != value else value
+
+    return len(documents) == len(reference_documents) and \
+        all(normalize(document) == normalize(reference_document) and list(document) == list(reference_document)
+            for document, reference_document in zip(documents, reference_documents))
+
+
+def measure(function, repeat):
+    """Return the result and the time of the fastest run of a function"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the conversion of DataFrames into nested documents")
+    parser.add_argument('--rows', type=int, default=200000, help="number of rows of the DataFrame")
+    parser.add_argument('--repeat', type=int, default=3, help="number of timed runs of each conversion")
+    args = parser.parse_args()
+
+    df = vaccination_dataframe(args.rows)
+    flat_df = df.rename(columns=lambda column: column.replace('.', '_'))
+
+    conversions = [('to_dict (flat)', lambda: flat_df.to_dict('records')),
+                   ('records loop', lambda: loop_documents(df)),
+                   ('dataframe_to_documents', lambda: dataframe_to_documents(df)),
+                   ('dataframe_to_documents (flat)', lambda: dataframe_to_documents(flat_df))]
+
+    print("%-30s %10s %10s %14s" % ('Conversion', 'Rows', 'Time (s)', 'Documents/s'))
+    results = {}
+    for conversion, function in conversions:
+        results[conversion], seconds = measure(function, args.repeat)
+        print("%-30s %10i %10.3f %14.0f" % (conversion, args.rows, seconds, args.rows / seconds))
+
+    equal = same_documents(results['dataframe_to_documents'], results['records loop']) and \
+        same_documents(results['dataframe_to_documents (flat)'], results['to_dict (flat)'])
+    print("Same documents: %s" % ('yes' if equal else 'no'))
+    if not equal:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+    Parity and speed harness of the PDF text backends (see PDFTextBackend in dags/AuxiliaryFunctions.py). Every backend
+    reads all the local reports: the normalized text of each page and the rows returned by each extractor are compared
+    with the ones of the reference backend, and the throughput of each backend is shown, so the backend can be switched
+    knowing that the extraction still gives the same results. The exit status is 1 if any extracted row differs.
+
+    Run it from the root of the repository, with the same dependencies (and Spanish locale, needed for the RENAVE report
+    dates) as the Airflow image, over the raw files store of the workflow or over synthetic reports:
+        python benchmarks/pdf_backends.py [--store /home/airflow/covid/raw_files | --synthetic]
+            [--backends pypdf2,pymupdf,pdfium] [--reference pypdf2] [--limit 50]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags', 'taskgroups'))
+from AuxiliaryFunctions import PDFPages, RawFileStore, pdf_text_backends  # noqa: E402
+from PDFMhealth import MHealthPDFReport, PDFMhealthTaskGroup  # noqa: E402
+from PDFRenave import RenavePDFReport, PDFRenaveTaskGroup  # noqa: E402
+from synthetic_reports import generate_reports  # noqa: E402
+
+report_types = {
+    # collection of the raw files store: report class, extractors
+    'renave_reports': (RenavePDFReport, PDFRenaveTaskGroup.extractors),
+    'mhealth_reports': (MHealthPDFReport, PDFMhealthTaskGroup.extractors)
+}
+
+
+def read_report(report_class, extractors, path, number, backend):
+    """
+        Read a report with a text backend.
+        :return: tuple with the normalized text of the pages, the rows returned by each extractor (or the error raised),
+        and the time spent extracting the text and the rows.
+    """
+    PDFPages.text_backend = backend
+
+    start = time.perf_counter()
+    pages = PDFPages(path)
+    texts = list(pages)
+    pages.close()
+    text_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        report = report_class(path, number)
+        rows = {}
+        for collection, (method, version, keys) in extractors.items():
+            try:
+                rows[collection] = getattr(report, method)()
+            except Exception as e:
+                rows[collection] = "%s: %s" % (type(e).__name__, e)
+    except Exception as e:
+        rows = "%s: %s" % (type(e).__name__, e)
+    rows_time = time.perf_counter() - start
+
+    return texts, rows, text_time, rows_time
+
+
+def first_difference(text, reference_text):
+    """Return the pieces of two texts around the first character where they differ"""
+    position = next((i for i, (a, b) in enumerate(zip(text, reference_text)) if a != b),
+                    min(len(text), len(reference_text)))
+    return text[max(0, position - 30):position + 30], reference_text[max(0, position - 30):position + 30]
+
+
+def compare_backends(reports, backends, reference):
+    """
+        Read each report with every backend, comparing the results with the reference backend.
+        :param reports: list of (collection, path, report number) tuples.
+        :return: dict with the statistics of each backend.
+    """
+    statistics = {backend: {'reports': 0, 'pages': 0, 'text_time': 0, 'rows_time': 0, 'equal_pages': 0,
+                            'equal_reports': 0} for backend in backends}
+
+    for collection, path, number in reports:
+        report_class, extractors = report_types[collection]
+        results = {backend: read_report(report_class, extractors, path, number, backend) for backend in backends}
+        reference_texts, reference_rows = results[reference][:2]
+
+        for backend, (texts, rows, text_time, rows_time) in results.items():
+            backend_statistics = statistics[backend]
+            backend_statistics['reports'] += 1
+            backend_statistics['pages'] += len(texts)
+            backend_statistics['text_time'] += text_time
+            backend_statistics['rows_time'] += rows_time
+            backend_statistics['equal_pages'] += sum(text == reference_text
+                                                     for text, reference_text in zip(texts, reference_texts))
+            backend_statistics['equal_reports'] += rows == reference_rows
+
+            if backend == reference:
+                continue
+
+            different_pages = [page_number for page_number, (text, reference_text)
+                               in enumerate(zip(texts, reference_texts)) if text != reference_text]
+            if different_pages:
+                text, reference_text = first_difference(texts[different_pages[0]], reference_texts[different_pages[0]])
+                print("%s %i (%s): %i different pages, first one %i: %r instead of %r"
+                      % (collection, number, backend, len(different_pages), different_pages[0], text, reference_text))
+            if len(texts) != len(reference_texts):
+                print("%s %i (%s): %i pages instead of %i" % (collection, number, backend, len(texts),
+                                                             len(reference_texts)))
+            if rows != reference_rows:
+                different_collections = [extracted_collection for extracted_collection in extractors
+                                         if not isinstance(rows, dict) or not isinstance(reference_rows, dict)
+                                         or rows[extracted_collection] != reference_rows[extracted_collection]]
+                print("%s %i (%s): different rows in %s" % (collection, number, backend,
+                                                            ', '.join(different_collections)))
+
+    return statistics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the results and the speed of the PDF text backends")
+    parser.add_argument('--store', default='raw_files', help="directory of the raw files store with the reports")
+    parser.add_argument('--synthetic', action='store_true', help="use synthetic reports instead of the stored ones")
+    parser.add_argument('--backends', default=','.join(pdf_text_backends), help="comma separated list of backends")
+    parser.add_argument('--reference', default='pypdf2', help="backend whose results are taken as the right ones")
+    parser.add_argument('--limit', type=int, help="maximum number of reports of each type, the latest ones")
+    args = parser.parse_args()
+
+    backends = args.backends.split(',')
+    if args.reference not in backends:
+        backends.insert(0, args.reference)
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        reports = []
+        for collection in report_types:
+            if args.synthetic:
+                directory = temporary_directory + '/' + collection
+                os.mkdir(directory)
+                numbers = [16 + i * 3 for i in range(args.limit or 10)]  # both RENAVE layouts
+                generate_reports(directory, 'renave' if collection == 'renave_reports' else 'mhealth', numbers)
+                paths = {number: '%s/%i.pdf' % (directory, number) for number in numbers}
+            else:
+                store = RawFileStore(collection, args.store)
+                paths = {int(name[:-4]): store.path(name) for name in store if name.endswith('.pdf')}
+
+            numbers = sorted(paths)[-args.limit:] if args.limit else sorted(paths)
+            reports.extend((collection, paths[number], number) for number in numbers)
+
+        print("Comparing %i reports with the backends %s (reference: %s)" % (len(reports), ', '.join(backends),
+                                                                              args.reference))
+        statistics = compare_backends(reports, backends, args.reference)
+
+    print("%-10s %8s %8s %12s %12s %14s %14s" % ('Backend', 'Reports', 'Pages', 'Pages/s', 'Reports/s', 'Equal pages',
+                                                'Equal reports'))
+    for backend, backend_statistics in statistics.items():
+        print("%-10s %8i %8i %12.1f %12.1f %13.1f%% %13.1f%%" % (
+            backend, backend_statistics['reports'], backend_statistics['pages'],
+            backend_statistics['pages'] / backend_statistics['text_time'] if backend_statistics['text_time'] else 0,
+            backend_statistics['reports'] / backend_statistics['rows_time'] if backend_statistics['rows_time'] else 0,
+            100 * backend_statistics['equal_pages'] / max(backend_statistics['pages'], 1),
+            100 * backend_statistics['equal_reports'] / max(backend_statistics['reports'], 1)))
+
+    if any(backend_statistics['equal_reports'] != backend_statistics['reports']
+           for backend_statistics in statistics.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+    Throughput benchmark of the PDF reports extraction, over a corpus of synthetic RENAVE and Ministry of Health reports
+    (see synthetic_reports.py). For each stage (opening the file, extracting the text of every page, building the tables
+    index and each get_* extractor) it shows the pages/s, tables/s and the peak memory allocated. The corpus is always
+    the same and each stage is timed several times, keeping the fastest run, so the numbers can be compared between
+    commits.
+
+    Run it from the root of the repository, with the same dependencies (and Spanish locale, needed for the RENAVE report
+    dates) as the Airflow image:
+        python benchmarks/pdf_extraction.py [--reports 20] [--pages 30] [--repeat 3] [--output results.json]
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags', 'taskgroups'))
+from AuxiliaryFunctions import PDFPages  # noqa: E402
+from PDFMhealth import MHealthPDFReport  # noqa: E402
+from PDFRenave import RenavePDFReport  # noqa: E402
+from synthetic_reports import generate_reports  # noqa: E402
+
+report_types = {
+    # type: report class, report numbers (the first offset), extractors
+    'renave': (RenavePDFReport, [16, 34], ['get_clinic_description', 'get_transmission_indicators']),
+    'mhealth': (MHealthPDFReport, [200], ['get_hospital_pressure', 'get_hospitalized_cases',
+                                          'get_outbreaks_description'])
+}
+
+
+def measure(function, repeat):
+    """Return the time of the fastest run of a function, and the peak memory allocated in a separate run"""
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peak_memory
+
+
+def benchmark_report_type(directory, report_class, extractors, repeat):
+    """Measure every stage over all the reports of a directory, returning a list with the results of each stage"""
+    files = sorted(os.listdir(directory), key=lambda file: int(file[:-4]))
+    paths = [directory + '/' + file for file in files]
+    number_of_pages = sum(len(PDFPages(path)) for path in paths)
+    reports = [report_class(path, int(file[:-4])) for path, file in zip(paths, files)]
+    number_of_tables = sum(len(report.tables_index_numbers) for report in reports)
+
+    stages = [('open', lambda: [PDFPages(path) for path in paths], number_of_pages, 0),
+              ('text extraction', lambda: [list(PDFPages(path)) for path in paths], number_of_pages, 0),
+              ('tables index', lambda: [report_class(path, int(file[:-4])) for path, file in zip(paths, files)],
+               number_of_pages, number_of_tables)]
+    for extractor in extractors:
+        # Each extractor reads one table of the reports where it applies (the RENAVE tables depend on the report number)
+        extracted_tables = sum(getattr(report, extractor)() is not None for report in reports)
+        stages.append((extractor, lambda method=extractor: [getattr(report, method)() for report in reports], 0,
+                       extracted_tables))
+
+    results = []
+    for stage, function, pages, tables in stages:
+        seconds, peak_memory = measure(function, repeat)
+        results.append({'stage': stage, 'reports': len(files), 'seconds': seconds,
+                        'pages_per_second': pages / seconds if pages else None,
+                        'tables_per_second': tables / seconds if tables else None,
+                        'peak_memory_mb': peak_memory / 2 ** 20})
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PDF reports extraction over synthetic reports")
+    parser.add_argument('--reports', type=int, default=20, help="number of reports of each type")
+    parser.add_argument('--pages', type=int, default=30, help="number of pages of each report")
+    parser.add_argument('--repeat', type=int, default=3, help="number of timed runs of each stage")
+    parser.add_argument('--output', help="JSON file where the results will be saved")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        for report_type, (report_class, first_numbers, extractors) in report_types.items():
+            directory = temporary_directory + '/' + report_type
+            os.mkdir(directory)
+
+            # Spread the reports between the different ranges of report numbers
+            numbers = [first_numbers[i % len(first_numbers)] + i for i in range(args.reports)]
+            generate_reports(directory, report_type, numbers, args.pages)
+
+            results[report_type] = benchmark_report_type(directory, report_class, extractors, args.repeat)
+
+    print("%-8s %-28s %8s %10s %10s %10s %12s" % ('Type', 'Stage', 'Reports', 'Time (s)', 'Pages/s', 'Tables/s',
+                                                    'Peak (MB)'))
+    for report_type, stages in results.items():
+        for stage in stages:
+            print("%-8s %-28s %8i %10.3f %10s %10s %12.1f" % (
+                report_type, stage['stage'], stage['reports'], stage['seconds'],
+                '%.0f' % stage['pages_per_second'] if stage['pages_per_second'] else '-',
+                '%.0f' % stage['tables_per_second'] if stage['tables_per_second'] else '-', stage['peak_memory_mb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
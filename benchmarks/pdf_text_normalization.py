@@ -0,0 +1,151 @@
+"""
+    Micro-benchmark of the normalization of the PDF reports text: the replacement of the Autonomous Regions names and the
+    removal of symbols, the table extraction and the search of the table titles. The current implementation is compared
+    with the previous one, checking that both give the same output, and the throughput is shown in tokens per second.
+
+    Run it from the root of the repository, with the same dependencies as the DAGs installed:
+        python benchmarks/pdf_text_normalization.py
+"""
+
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+from AuxiliaryFunctions import PDFReport  # noqa: E402
+
+regions = ['Andalucía', 'Aragón', 'Asturias', 'Islas Baleares', 'Canarias', 'Cantabria', 'Castilla La Mancha',
+           'Castilla y León', 'Cataluña', 'Ceuta', 'C. Valenciana', 'Extremadura', 'Galicia', 'Madrid', 'Melilla',
+           'Murcia', 'Navarra', 'País Vasco', 'La Rioja', 'Total general']
+table_names_regexes = {
+    'hospital_pressure': 'Tabla [1-9]+\\. Situación capacidad asistencial',
+    'hospital_cases': 'Tabla [1-9]+\\. Casos (de )?COVID-19.+, ingreso en UCI',
+    'outbreaks_description': 'Tabla [0-9]+\\. Distribución del nº de brotes y casos por ámbito'
+}
+
+
+def generate_page(table_number):
+    """Return the text of a page with a table of the Autonomous Regions, like the ones in the reports"""
+    rows = ['Texto del informe (continuación)*. Tabla %i. Situación capacidad asistencial y casos por CCAA. '
+            'CCAA Casos %% Casos 7d %% (*) Hospitalizados UCI' % table_number]
+    for region in regions:
+        rows.append(region + ' ' + ' '.join('%i.%03i %.1f%%' % (random.randint(0, 99), random.randint(0, 999),
+                                                                 random.random() * 100) for _ in range(6)))
+    rows.append('* Fuente: Comunidades Autónomas. Tabla %i. Casos de COVID-19 hospitalizados, ingreso en UCI'
+                % (table_number + 1))
+    return ' '.join(rows)
+
+
+def previous_normalization(page, table_number):
+    """Previous implementation of PDFReport.remove_ar_spaces_and_symbols"""
+    replaced_page = page.replace('Castilla La Mancha', 'Castilla_La_Mancha') \
+        .replace('Castilla-La Mancha', 'Castilla_La_Mancha') \
+        .replace('C. Valenciana', 'Comunidad_Valenciana') \
+        .replace('C Valenciana', 'Comunidad_Valenciana') \
+        .replace('País Vasco', 'País_Vasco') \
+        .replace('Castilla y León', 'Castilla_y_León') \
+        .replace('La Rioja', 'La_Rioja') \
+        .replace('Total general', 'ESPAÑA') \
+        .replace('Total', 'ESPAÑA') \
+        .replace('Islas Baleares', 'Baleares') \
+        .replace('Islas Canarias', 'Canarias')
+
+    if table_number:
+        replaced_page = replaced_page.replace(f'Tabla {table_number}.', f'_TABLA{table_number}_')
+
+    return re.sub('[^A-zÀ-ú0-9,.<>≤≥ \\-]', '', replaced_page)
+
+
+def previous_table_extraction(page, table_number):
+    """Previous implementation of PDFReport.extract_table_from_page, for a single table"""
+    header_column = PDFReport.autonomous_regions
+    table_page = page.split()
+    table_first_row = table_page.index(header_column[0], table_page.index(f'_TABLA{table_number}_'))
+
+    table = []
+    row = []
+    for cell in table_page[table_first_row:]:
+        if re.match('[A-zÀ-ú_]', cell):
+            if cell in header_column:
+                row = []
+                table.append(row)
+                row.append(cell)
+            else:
+                break
+        else:
+            row.append(cell)
+
+    return table
+
+
+def previous_tables_index(pages):
+    """Previous way of finding the page and the number of each table, and the number of the tables of interest"""
+    tables_index_numbers = {}
+    tables_index_names = {}
+    for page_number, page in enumerate(pages):
+        for title in re.findall('Tabla [0-9]+[a-z]?[.,]', page):
+            tables_index_numbers[int(re.match('Tabla [0-9]+', title).group()[6:])] = page_number
+
+    for table_name, regex in table_names_regexes.items():
+        for page in pages:
+            match_result = re.search(regex, page)
+            if match_result:
+                tables_index_names[table_name] = int(re.match('Tabla [0-9]+', match_result.group()).group()[6:])
+                break
+
+    return tables_index_numbers, tables_index_names
+
+
+def current_tables_index(pages):
+    """Current way of finding the tables, as done in PDFReport.__init__"""
+    compiled_regexes = {table_name: re.compile(regex) for table_name, regex in table_names_regexes.items()}
+    tables_index_numbers = {}
+    tables_index_names = {}
+    for page_number, page in enumerate(pages):
+        for title in PDFReport.table_title_regex.finditer(page):
+            table_number = int(title.group(1))
+            tables_index_numbers[table_number] = page_number
+            for table_name, regex in compiled_regexes.items():
+                if table_name not in tables_index_names and regex.match(page, title.start()):
+                    tables_index_names[table_name] = table_number
+
+    return tables_index_numbers, tables_index_names
+
+
+def benchmark(name, function, pages, tokens):
+    """Print the throughput of a function run over all the pages"""
+    seconds = min(timeit.repeat(lambda: [function(page, number) for number, page in pages], number=5, repeat=5)) / 5
+    print("%-45s %12.0f tokens/s" % (name, tokens / seconds))
+
+
+def main():
+    random.seed(0)
+    pages = [(number, generate_page(number)) for number in range(1, 201)]
+    tokens = sum(len(page.split()) for number, page in pages)
+    print("%i pages, %i tokens" % (len(pages), tokens))
+
+    # Check that the output has not changed
+    for number, page in pages:
+        normalized_page = PDFReport.remove_ar_spaces_and_symbols(page, number)
+        assert normalized_page == previous_normalization(page, number)
+        assert PDFReport.extract_table_from_page(normalized_page, number, 0) == \
+            previous_table_extraction(normalized_page, number)
+    assert current_tables_index([page for number, page in pages]) == \
+        previous_tables_index([page for number, page in pages])
+
+    benchmark("Normalization (previous)", previous_normalization, pages, tokens)
+    benchmark("Normalization (current)", PDFReport.remove_ar_spaces_and_symbols, pages, tokens)
+
+    normalized_pages = [(number, previous_normalization(page, number)) for number, page in pages]
+    benchmark("Table extraction (previous)", previous_table_extraction, normalized_pages, tokens)
+    benchmark("Table extraction (current)", lambda page, number: PDFReport.extract_table_from_page(page, number, 0),
+              normalized_pages, tokens)
+
+    benchmark("Tables index (previous)", lambda page, number: previous_tables_index([page]), pages, tokens)
+    benchmark("Tables index (current)", lambda page, number: current_tables_index([page]), pages, tokens)
+
+
+if __name__ == '__main__':
+    main()
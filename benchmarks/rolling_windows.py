@@ -0,0 +1,113 @@
+"""
+    Benchmark of the rolling windows of the daily COVID data (see RollingWindows in dags/taskgroups/DataAnalysis.py):
+    a groupby().rolling() pass of pandas for each window, used before, against RollingWindows, which calculates all the
+    windows of a column from the same cumulative sums, with the NumPy kernel and, if Numba is installed, with the Numba
+    one. The series are synthetic, with the same shape as the RENAVE dataset. The results must be equal up to the
+    rounding errors of the sums, otherwise the exit status is 1.
+
+    Run it from the root of the repository, with the same dependencies as the Airflow image:
+        python benchmarks/rolling_windows.py [--days 500] [--repeat 3]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dags', 'taskgroups'))
+import DataAnalysis  # noqa: E402
+from DataAnalysis import DailyCOVIDData, RollingWindows  # noqa: E402
+from increase_percentages import daily_dataframe  # noqa: E402
+
+# Windows of the analysis of the cases, deaths and hospitalizations
+windows = {
+    'ci_last_14_days': ('new_cases_per_population', '14D', 'sum'),
+    'new_cases_ma_7d': ('new_cases', '7D', 'mean'),
+    'new_cases_ma_14d': ('new_cases', '14D', 'mean'),
+    'new_cases_ma_60d': ('new_cases', '60D', 'mean'),
+    'new_cases_ma_1w': ('new_cases_per_population', '8D', 'mean'),
+    'new_cases_ma_2w': ('new_cases_per_population', '15D', 'mean'),
+    'new_deaths_ma_1w': ('new_deaths_per_population', '8D', 'mean'),
+    'new_deaths_ma_2w': ('new_deaths_per_population', '15D', 'mean'),
+    'new_hospitalizations_ma_1w': ('new_hospitalizations_per_population', '8D', 'mean'),
+    'new_hospitalizations_ma_2w': ('new_hospitalizations_per_population', '15D', 'mean')
+}
+tolerance = 1e-9
+
+
+def analysis_dataframe(number_of_days):
+    """Return the synthetic daily data sorted by series and date, with the columns per population"""
+    rng = np.random.default_rng(2)
+    df = daily_dataframe(number_of_days).reset_index()
+    df = df.sort_values(DailyCOVIDData.series_columns + ['date']).set_index('date')
+    population = rng.integers(10 ** 4, 10 ** 6, len(df))
+    for column in ['new_cases', 'new_deaths', 'new_hospitalizations']:
+        df[column + '_per_population'] = 100000 * df[column] / population
+
+    return df
+
+
+def pandas_windows(df):
+    """Calculate each window with its own groupby().rolling() pass"""
+    results = {}
+    for name, (column, window, statistic) in windows.items():
+        rolling = df.groupby(DailyCOVIDData.series_columns)[column].rolling(window)
+        results[name] = getattr(rolling, statistic)().to_numpy()
+
+    return results
+
+
+def engine_windows(df, use_numba):
+    """Calculate all the windows with RollingWindows"""
+    RollingWindows.use_numba = use_numba
+    return RollingWindows(df, DailyCOVIDData.series_columns).calculate(windows)
+
+
+def measure(function, repeat):
+    """Return the result and the time of the fastest run of a function"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the calculation of the rolling windows")
+    parser.add_argument('--days', type=int, default=500, help="number of days of each series")
+    parser.add_argument('--repeat', type=int, default=3, help="number of timed runs of each calculation")
+    args = parser.parse_args()
+
+    df = analysis_dataframe(args.days)
+    calculations = [('pandas rolling', lambda: pandas_windows(df)),
+                    ('RollingWindows (NumPy)', lambda: engine_windows(df, False))]
+    if DataAnalysis.numba is not None:
+        engine_windows(df, True)  # the first call compiles the kernel
+        calculations.append(('RollingWindows (Numba)', lambda: engine_windows(df, True)))
+    else:
+        print("Numba is not installed: only the NumPy kernel is measured")
+
+    print("%i windows over %i rows" % (len(windows), len(df)))
+    print("%-30s %10s %10s %10s" % ('Calculation', 'Time (s)', 'Speedup', 'Equal'))
+    reference_results = reference_time = None
+    all_equal = True
+    for calculation, function in calculations:
+        results, seconds = measure(function, args.repeat)
+        if reference_results is None:
+            reference_results, reference_time = results, seconds
+        equal = all(np.allclose(results[name], reference_results[name], rtol=tolerance, atol=0, equal_nan=True)
+                    for name in windows)
+        all_equal = all_equal and equal
+        print("%-30s %10.3f %9.1fx %10s" % (calculation, seconds, reference_time / seconds, 'yes' if equal else 'no'))
+
+    if not all_equal:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
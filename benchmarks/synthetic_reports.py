@@ -0,0 +1,187 @@
+"""
+    Generator of synthetic PDF reports with the same table titles and layouts as the RENAVE and Ministry of Health
+    reports, so the PDF extraction can be measured offline. The PDF files are written directly, without any other
+    dependency, with one line of text per row. The content only depends on the report number, so the same corpus is
+    generated every time.
+"""
+
+import random
+import zlib
+from datetime import datetime as dt, timedelta as td
+
+autonomous_regions = ['Andalucía', 'Aragón', 'Asturias', 'Baleares', 'Canarias', 'Cantabria', 'Castilla La Mancha',
+                      'Castilla y León', 'Cataluña', 'Ceuta', 'C. Valenciana', 'Extremadura', 'Galicia', 'Madrid',
+                      'Melilla', 'Murcia', 'Navarra', 'País Vasco', 'La Rioja']
+
+symptoms = ['fiebre o reciente historia de fiebre', 'tos', 'dolor de garganta', 'disnea', 'escalofríios', 'vómitos',
+            'diarrea', 'síndrome de distrés respiratorio agudo', 'fallo renal agudo', 'otros síntomas']
+
+outbreak_scopes = {'Centro educativo': ['Colegios', 'Universidades'],
+                   'Centro sanitario': ['Hospitales', 'Centros de salud'],
+                   'Centro sociosanitario': ['Residencias de mayores', 'Centros de día'],
+                   'Colectivos socialmente vulnerables': ['Asentamientos'],
+                   'Familiar': [],
+                   'Mixto': [],
+                   'Laboral': ['Sector sanitario', 'Temporeros'],
+                   'Social': ['Reuniones familiares', 'Ocio nocturno'],
+                   'Otros': ['Otros']}
+
+filler_words = ['casos', 'evolución', 'incidencia', 'notificados', 'semana', 'acumulada', 'diagnóstico', 'pruebas',
+                'comunidades', 'hospitalización', 'datos', 'periodo', 'análisis', 'vigilancia', 'información']
+
+months = ['enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto', 'septiembre', 'octubre',
+          'noviembre', 'diciembre']
+
+
+def integer(value):
+    """Format an integer as in the reports: 12.345"""
+    return '{:,}'.format(value).replace(',', '.')
+
+
+def decimal(value):
+    """Format a decimal number as in the reports: 12,3"""
+    return ('%.1f' % value).replace('.', ',')
+
+
+def filler_lines(rng, number_of_lines):
+    """Return lines of text without tables"""
+    return [' '.join(rng.choice(filler_words) for _ in range(12)) for _ in range(number_of_lines)]
+
+
+def write_pdf(path, pages, creation_date):
+    """
+        Write a PDF file with a page for each list of lines, using a standard font, so it can be read without embedding
+        any font file.
+    """
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>',
+               ('<< /Type /Pages /Kids [%s] /Count %i >>' % (' '.join('%i 0 R' % (4 + 2 * i) for i in range(len(pages))),
+                                                             len(pages))).encode(),
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>']
+
+    for i, lines in enumerate(pages):
+        objects.append(('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> '
+                        '/Contents %i 0 R >>' % (5 + 2 * i)).encode())
+
+        # Each line ends with a space, since the line breaks are removed when the text is extracted
+        text = ' '.join('(%s ) Tj T*' % line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+                        for line in lines)
+        content = zlib.compress(('BT /F1 8 Tf 30 810 Td 9 TL %s ET' % text).encode('cp1252'))
+        objects.append(b'<< /Length %i /Filter /FlateDecode >>\nstream\n' % len(content) + content + b'\nendstream')
+
+    objects.append(('<< /CreationDate (D:%s000000) >>' % creation_date.strftime('%Y%m%d')).encode())
+
+    pdf = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, pdf_object in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%i 0 obj\n' % number + pdf_object + b'\nendobj\n'
+
+    xref_offset = len(pdf)
+    pdf += b'xref\n0 %i\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010i 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<< /Size %i /Root 1 0 R /Info %i 0 R >>\nstartxref\n%i\n%%%%EOF\n' % (len(objects) + 1,
+                                                                                          len(objects), xref_offset)
+
+    with open(path, 'wb') as f:
+        f.write(pdf)
+
+
+def renave_report_pages(number, number_of_pages):
+    """
+        Return the pages of a RENAVE report: the date in the first page, the clinic description (table 2) and the
+        transmission indicators (table 6)
+    """
+    rng = random.Random(number)
+    report_date = dt(2020, 4, 1) + td(days=7 * number)
+    pages = [['Informe nº %i Situación de COVID-19 en España' % number,
+              'Fecha del informe: %i de %s de %i' % (report_date.day, months[report_date.month - 1], report_date.year)]
+             + filler_lines(rng, 60)]
+    pages.extend(filler_lines(rng, 70) for _ in range(1, number_of_pages))
+
+    # Clinic description
+    clinic_page = ['Tabla 2. Características demográficas y clínicas de los casos',
+                   'Características Total Hombres Mujeres', 'Síntomas']
+    for symptom in symptoms:
+        total = rng.randint(1000, 50000)
+        women = rng.randint(0, total)
+        clinic_page.append('%s %s %s %s %s %s %s' % (symptom, integer(total), decimal(rng.uniform(1, 99)),
+                                                     integer(women), decimal(rng.uniform(1, 99)),
+                                                     integer(total - women), decimal(rng.uniform(1, 99))))
+    clinic_page.append('Enfermedad de base y factores de riesgo')
+    clinic_page.extend(filler_lines(rng, 20))
+    pages[1 % number_of_pages] = clinic_page
+
+    # Transmission indicators
+    transmission_page = ['Tabla 6. Indicadores de transmisión por CCAA',
+                         'CCAA Casos Sintomáticos % Casos Mediana días IQR Contacto desconocido % Mediana contactos IQR']
+    for ar in autonomous_regions + ['Total']:
+        transmission_page.append('%s %s %s%% %s %s %i %i-%i %s %s%% %i %i-%i' % (
+            ar, integer(rng.randint(100, 90000)), decimal(rng.uniform(30, 90)), integer(rng.randint(10, 900)),
+            integer(rng.randint(10, 900)), rng.randint(1, 9), rng.randint(0, 3), rng.randint(4, 9),
+            integer(rng.randint(10, 9000)), decimal(rng.uniform(1, 60)), rng.randint(1, 9), rng.randint(0, 3),
+            rng.randint(4, 9)))
+    transmission_page.append('Fuente: SiViES')
+    pages[2 % number_of_pages] = transmission_page
+
+    return pages, report_date
+
+
+def mhealth_report_pages(number, number_of_pages):
+    """
+        Return the pages of a Ministry of Health report: the hospital pressure table next to the hospitalized cases
+        table in the same page, and the outbreaks table split in two pages
+    """
+    rng = random.Random(number)
+    report_date = dt(2020, 6, 1) + td(days=number)
+    pages = [filler_lines(rng, 70) for _ in range(number_of_pages)]
+
+    # Hospital pressure (left) and hospitalized cases (right): their rows are interleaved
+    tables_page = ['Tabla 5. Situación capacidad asistencial COVID-19 por CCAA '
+                   'Tabla 6. Casos de COVID-19 hospitalizados, ingreso en UCI y fallecidos',
+                   'Pacientes Tasa de ocupación hospitalaria por 100.000 % Camas Ocupadas COVID Pacientes UCI '
+                   'Tasa UCI % Camas Ocupadas UCI COVID Ingresos Altas Hospitalizados Nuevos UCI Nuevos']
+    for ar in autonomous_regions + ['Total']:
+        tables_page.append('%s %s %s %s%% %s %s %s%% %s %s' % (
+            ar, integer(rng.randint(10, 9000)), decimal(rng.uniform(1, 300)), decimal(rng.uniform(1, 60)),
+            integer(rng.randint(1, 900)), decimal(rng.uniform(1, 50)), decimal(rng.uniform(1, 60)),
+            integer(rng.randint(0, 900)), integer(rng.randint(0, 900))))
+        tables_page.append('%s %s %s %s %s' % (ar, integer(rng.randint(100, 90000)), integer(rng.randint(0, 900)),
+                                               integer(rng.randint(10, 9000)), integer(rng.randint(0, 90))))
+    tables_page.append('Fuente: Comunidades Autónomas')
+    pages[3 % number_of_pages] = tables_page
+
+    # Outbreaks, in two pages
+    outbreak_rows = []
+    for scope, subscopes in outbreak_scopes.items():
+        for key in [scope] + subscopes:
+            outbreaks = rng.randint(10, 900)
+            cases = outbreaks * rng.randint(2, 9)
+            new_outbreaks = rng.randint(1, 90)
+            new_cases = new_outbreaks * rng.randint(2, 9)
+            outbreak_rows.append('%s %s %s %s %s %s %s' % (key, integer(outbreaks), integer(cases),
+                                                           decimal(cases / outbreaks), integer(new_outbreaks),
+                                                           integer(new_cases), decimal(new_cases / new_outbreaks)))
+    outbreak_rows.append('Total %s %s %s %s %s %s' % (integer(9000), integer(40000), decimal(4.4), integer(90),
+                                                      integer(400), decimal(4.4)))
+    header = 'Ámbito Brotes Casos Casos/brote Brotes Casos Casos/brote'
+    half = len(outbreak_rows) // 2
+    pages[4 % number_of_pages] = ['Tabla 8. Distribución del nº de brotes y casos por ámbito', header] + \
+        outbreak_rows[:half]
+    pages[5 % number_of_pages] = [header] + outbreak_rows[half:] + ['Fuente: Comunidades Autónomas']
+
+    return pages, report_date
+
+
+def generate_reports(directory, report_type, numbers, number_of_pages=30):
+    """
+        Write a synthetic report for each number in a directory, named like the downloaded reports.
+
+        :param directory: directory where the reports will be written.
+        :param report_type: 'renave' or 'mhealth'.
+        :param numbers: list with the numbers of the reports.
+        :param number_of_pages: number of pages of each report (at least 6).
+    """
+    report_pages = renave_report_pages if report_type == 'renave' else mhealth_report_pages
+    for number in numbers:
+        pages, report_date = report_pages(number, number_of_pages)
+        write_pdf('%s/%i.pdf' % (directory, number), pages, report_date)
@@ -1,13 +1,40 @@
+import hashlib
+import json
 import math
 import os
 import re
+import sqlite3
+import threading
+import time
+import zlib
 from abc import abstractmethod
+from bisect import bisect_left
+from collections import namedtuple
+from contextlib import contextmanager
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime as dt, timedelta as td
+from urllib.parse import urlparse
 
+import bson
+import numpy as np
 import PyPDF2
 import requests
-from pymongo import ASCENDING, DESCENDING
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pymongo import ASCENDING, DESCENDING, ReplaceOne
 import pandas as pd
 
+# Optional PDF text backends
+try:
+    import fitz
+except ImportError:
+    fitz = None
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
 from airflow.providers.mongo.hooks.mongo import MongoHook
 
 
@@ -19,17 +46,26 @@ class MongoDatabase:
 
     collection_indexes = {
         'default': [('date', DESCENDING), ('autonomous_region', ASCENDING)],  # this is the most common index
+        'daily_data': [('date', DESCENDING), ('autonomous_region', ASCENDING), ('gender', ASCENDING),
+                       ('age_range', ASCENDING)],
         'clinic_description': [('type', ASCENDING), ('description', ASCENDING)],
         'population_ar': [('autonomous_region', ASCENDING)],
         'death_causes': [('death_cause', ASCENDING), ('age_range', ASCENDING)],
         'chronic_illnesses': [('illness', ASCENDING)],
         'outbreaks_description': [('date', DESCENDING), ('scope', ASCENDING), ('subscope', ASCENDING)],
-        'top_death_causes': [('death_cause', ASCENDING)]
+        'top_death_causes': [('death_cause', ASCENDING)],
+        'analysis_state': [('collection', ASCENDING)],
+        'load_state': [('collection', ASCENDING)]
     }
 
     extracted_db_name = 'covid_extracted_data'
     analyzed_db_name = 'covid_analyzed_data'
 
+    last_values_window_days = 60  # days grouped at once when reading the last document of each series
+
+    write_batch_size = 5000  # documents sent to the server in each write operation
+    write_threads = 4  # batches written at the same time, each one through its own pooled connection
+
     def __init__(self, database_name):
         """
             Connect to the database.
@@ -49,12 +85,30 @@ class MongoDatabase:
 
             collection.create_index(index)
 
-    def read_data(self, collection_name, filters=None, projection=None):
+    @staticmethod
+    def create_upsert_index(collection, keys):
+        """
+            Create the index on the fields identifying the upserted documents, even if the collection already has other
+            indexes (create_index does nothing when the index exists), so each upsert doesn't scan the whole collection.
+            :param collection: Collection in which the documents will be upserted
+            :param keys: List of fields identifying each document
+        """
+        index = MongoDatabase.collection_indexes.get(collection.name)
+        if not index or {field for field, _ in index} != set(keys):
+            # The custom index of the collection is not on the same fields: index them in ascending order
+            index = [(key, ASCENDING) for key in keys]
+
+        collection.create_index(index)
+
+    def read_data(self, collection_name, filters=None, projection=None, columnar=False):
         """
             Read data from the database and return it as a DataFrame.
             :param collection_name: Name of the collection from which the data will be read
             :param filters: (optional) Dictionary with the query filters.
             :param projection: (optional) List of columns to retrieve.
+            :param columnar: (optional) decode the raw BSON batches returned by the server one at a time into typed
+            columns, instead of building a dictionary for every document of the collection first. Recommended for
+            large collections of flat documents.
         """
         collection = self.db.get_collection(collection_name)
         if projection:
@@ -64,16 +118,81 @@ class MongoDatabase:
 
         projected_fields['_id'] = 0
 
+        if columnar:
+            return MongoDatabase.__read_raw_batches__(collection, filters, projected_fields)
+
         query = collection.find(filters, projected_fields)
         df = pd.DataFrame(query)
 
         return df
 
+    @staticmethod
+    def __read_raw_batches__(collection, filters, projected_fields):
+        """
+            Read the documents as raw BSON batches and convert each batch into a DataFrame, so only the documents of one
+            batch are decoded as Python objects at the same time.
+        """
+        batches = [pd.DataFrame(bson.decode_all(batch))
+                   for batch in collection.find_raw_batches(filters, projected_fields)]
+
+        if not batches:
+            return pd.DataFrame()
+        elif len(batches) == 1:
+            return batches[0]
+
+        # A field can be empty in a whole batch, but not in the others: use the same types as pd.DataFrame(query)
+        return pd.concat(batches, ignore_index=True, sort=False).infer_objects()
+
+    def read_latest_date(self, collection_name, filters=None):
+        """
+            Return the most recent date stored in a collection, or None if the collection is empty.
+            :param collection_name: Name of the collection from which the date will be read
+            :param filters: (optional) Dictionary with the query filters.
+        """
+        collection = self.db.get_collection(collection_name)
+        document = collection.find_one(filters, {'date': 1, '_id': 0}, sort=[('date', DESCENDING)])
+
+        return document['date'] if document else None
+
+    def read_last_values(self, collection_name, date, keys, fields, series=None):
+        """
+            Read the last document of each time series stored before a date, and return them as a DataFrame. A series
+            may have no document on some days, so its last document can be of any previous day: the documents of the
+            last last_values_window_days days are grouped by series, and only the series that still have no document
+            are looked up one by one in the older ones.
+            :param collection_name: Name of the collection from which the data will be read
+            :param date: only the documents before this date will be considered
+            :param keys: List of fields identifying each time series (for example, Autonomous Region and gender)
+            :param fields: List of fields to retrieve from the last document of each time series
+            :param series: (optional) DataFrame with the keys of the series whose values are needed. The series without
+            documents in the window are only looked up in the older documents if they are here.
+        """
+        collection = self.db.get_collection(collection_name)
+        window_start = date - td(days=MongoDatabase.last_values_window_days)
+        documents = list(collection.aggregate([
+            {'$match': {'date': {'$lt': date, '$gte': window_start}}},
+            {'$sort': {'date': ASCENDING}},
+            {'$group': {'_id': {key: '$' + key for key in keys}, **{field: {'$last': '$' + field} for field in fields}}}
+        ], allowDiskUse=True))
+        rows = [{**document['_id'], **{field: document[field] for field in fields}} for document in documents]
+
+        if series is not None:
+            found = {tuple(row[key] for key in keys) for row in rows}
+            for values in series[keys].drop_duplicates().itertuples(index=False, name=None):
+                if values not in found:
+                    document = collection.find_one({'date': {'$lt': window_start}, **dict(zip(keys, values))},
+                                                   {field: 1 for field in keys + fields}, sort=[('date', DESCENDING)])
+                    if document:
+                        rows.append({field: document.get(field) for field in keys + fields})
+
+        return pd.DataFrame(rows, columns=keys + fields)
+
     def store_data(self, collection_name, data, overwrite=True):
         """
             Store data in the database.
             :param collection_name: Name of the collection in which the data will be stored
-            :param data: document or documents to be stored in the collection
+            :param data: document or documents to be stored in the collection, or a DataFrame with a document in each
+            row (see dataframe_to_documents)
             :param overwrite: whether to delete the previous data in the collection before storing the new one
         """
 
@@ -84,13 +203,68 @@ class MongoDatabase:
 
         MongoDatabase.create_collection_index(collection)
 
-        if type(data) == list:
-            # Several documents to be inserted
-            collection.insert_many(data)
+        if isinstance(data, pd.DataFrame):
+            # The documents of each batch are built just before writing it, so they are never all in memory at once
+            self.__write_in_batches__(
+                lambda batch: collection.insert_many(dataframe_to_documents(batch), ordered=False), data)
+        elif type(data) == list:
+            # Several documents to be inserted: the order doesn't matter, so they are written in parallel batches
+            self.__write_in_batches__(lambda batch: collection.insert_many(batch, ordered=False), data)
         elif type(data) == dict:
             # One single document to be inserted
             collection.insert_one(data)
 
+    def upsert_data(self, collection_name, data, keys):
+        """
+            Insert or replace documents in the database, without deleting the rest of the collection.
+            :param collection_name: Name of the collection in which the data will be stored
+            :param data: list of documents to be stored in the collection, or a DataFrame with a document in each row
+            (see dataframe_to_documents)
+            :param keys: List of fields identifying each document: a stored document with the same values in these
+            fields will be replaced
+        """
+        collection = self.db.get_collection(collection_name)
+        MongoDatabase.create_collection_index(collection)
+        MongoDatabase.create_upsert_index(collection, keys)
+
+        def replace_operations(documents):
+            return [ReplaceOne({key: document[key] for key in keys}, document, upsert=True) for document in documents]
+
+        if isinstance(data, pd.DataFrame):
+            # The documents of each batch are built just before writing it, so they are never all in memory at once
+            self.__write_in_batches__(
+                lambda batch: collection.bulk_write(replace_operations(dataframe_to_documents(batch)), ordered=False),
+                data)
+        else:
+            self.__write_in_batches__(lambda batch: collection.bulk_write(batch, ordered=False),
+                                      replace_operations(data))
+
+    def __write_in_batches__(self, write_batch, data):
+        """
+            Split a list of documents (or write operations), or the rows of a DataFrame, in batches and write them
+            concurrently, reporting the write throughput.
+            :param write_batch: function that writes one batch into the database
+            :param data: list of documents or write operations, or DataFrame
+        """
+        if not len(data):
+            return
+
+        rows = data.iloc if isinstance(data, pd.DataFrame) else data
+        batches = [rows[i:i + self.write_batch_size] for i in range(0, len(data), self.write_batch_size)]
+        start_time = time.perf_counter()
+
+        if self.write_threads > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=self.write_threads) as executor:
+                # Consume the results, so any exception raised while writing a batch is propagated
+                list(executor.map(write_batch, batches))
+        else:
+            for batch in batches:
+                write_batch(batch)
+
+        elapsed_time = time.perf_counter() - start_time
+        print("%i documents written in %.2f s (%.0f documents/s)" %
+              (len(data), elapsed_time, len(data) / elapsed_time if elapsed_time else len(data)))
+
     def __del__(self):
         """When the object is destroyed, the connection with the MongoDB server is released"""
         self.client.close()
@@ -128,13 +302,340 @@ class CSVDataset:
     def __process_dataset__(self):
         """Transform the DataFrame to extract the important information"""
 
-    def store_dataset(self, database, collection_name):
-        """Store the dataset in the MongoDB database"""
+    def store_dataset(self, database, collection_name, upsert_keys=None):
+        """
+            Store the dataset in the MongoDB database.
+            :param upsert_keys: (optional) List of fields identifying each document. When set, the documents are
+            upserted instead of replacing the whole collection.
+        """
 
         if not self.mongo_data:
-            self.mongo_data = self.df.to_dict('records')
+            self.mongo_data = dataframe_to_documents(self.df)
+
+        if upsert_keys:
+            database.upsert_data(collection_name, self.mongo_data, upsert_keys)
+        else:
+            database.store_data(collection_name, self.mongo_data)
+
+
+class PDFTextBackend:
+    """
+        Text layer of a PDF file, read with a PDF library. Set PDFPages.text_backend to the name of the backend used
+        for extracting the reports (see pdf_text_backends).
+    """
+
+    # Literal (...) and hexadecimal <...> strings in a page content stream
+    content_strings_regex = re.compile(rb'\(((?:\\.|[^\\)])*)\)|(?<!<)<([0-9A-Fa-f\s]*)>(?!>)', re.S)
+    literal_escapes_regex = re.compile(rb'\\([0-7]{1,3}|.)', re.S)
+    literal_escapes = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f', b'\n': b'', b'\r': b''}
+    # Strings of fonts whose codes aren't characters (for example, the glyph identifiers of Identity-H fonts) decode
+    # mostly into control characters
+    control_characters_regex = re.compile('[\x00-\x08\x0b\x0e-\x1f]')
+    max_control_characters = 0.1  # fraction of control characters above which a page can't be scanned
+
+    def __init__(self, path):
+        self.path = path
+
+    @abstractmethod
+    def number_of_pages(self):
+        """Return the number of pages of the file"""
+
+    @abstractmethod
+    def extract_text(self, page_number):
+        """Return the raw text of a page"""
+
+    def scan_text(self, page_number):
+        """Return the text of a page, or a faster approximation of it good enough for searching words in the page"""
+        return self.normalize(self.extract_text(page_number))
+
+    @abstractmethod
+    def metadata(self):
+        """Return a dict with the document information of the file (CreationDate, Title...)"""
+
+    def normalize(self, text):
+        """Normalize the raw text of a page, leaving the words separated by a single space"""
+        return ' '.join(text.split())
+
+    def close(self):
+        """Close the file"""
+
+    def content_strings_text(self, data):
+        """
+            Join the strings of the content stream of a page, without parsing the whole page, which is much faster than
+            extracting its text.
+        """
+        strings = PDFTextBackend.content_strings_regex.findall(data)
+        text = ''.join(PDFTextBackend.__decode_string__(literal, hexadecimal) for literal, hexadecimal in strings)
+        if len(PDFTextBackend.control_characters_regex.findall(text)) > \
+                PDFTextBackend.max_control_characters * len(text):
+            raise ValueError("The strings of the content stream can't be decoded")
+
+        return self.normalize(text)
+
+    @staticmethod
+    def __decode_string__(literal, hexadecimal):
+        """Decode a literal or hexadecimal string of a content stream"""
+        if literal:
+            data = PDFTextBackend.literal_escapes_regex.sub(
+                lambda match: bytes([int(match.group(1), 8) & 0xFF]) if match.group(1).isdigit()
+                else PDFTextBackend.literal_escapes.get(match.group(1), match.group(1)), literal)
+        else:
+            hexadecimal = re.sub(rb'\s', b'', hexadecimal)
+            data = bytes.fromhex((hexadecimal + b'0' * (len(hexadecimal) % 2)).decode())
+
+        return data[2:].decode('utf-16-be', 'ignore') if data.startswith(b'\xfe\xff') else data.decode('latin-1')
+
+
+class PyPDF2TextBackend(PDFTextBackend):
+    """PDF text layer read with PyPDF2, in pure Python"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(path, 'rb')
+        self.reader = PyPDF2.PdfFileReader(self.file)
+
+    def number_of_pages(self):
+        return self.reader.getNumPages()
+
+    def extract_text(self, page_number):
+        return self.reader.getPage(page_number).extractText()
+
+    def scan_text(self, page_number):
+        contents = self.reader.getPage(page_number).getContents()
+        if contents is None:
+            return ''
+
+        if isinstance(contents, PyPDF2.generic.ArrayObject):
+            data = b''.join(stream.getObject().getData() for stream in contents)
+        else:
+            data = contents.getData()
 
-        database.store_data(collection_name, self.mongo_data)
+        return self.content_strings_text(data)
+
+    def metadata(self):
+        return {key.lstrip('/'): str(value) for key, value in (self.reader.documentInfo or {}).items()}
+
+    def normalize(self, text):
+        # PyPDF2 adds random line breaks between words and letters
+        return ' '.join(text.replace('\n', '').split())
+
+    def close(self):
+        self.file.close()
+
+
+class PyMuPDFTextBackend(PDFTextBackend):
+    """PDF text layer read with PyMuPDF (pip install pymupdf), based on the MuPDF C library"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        if fitz is None:
+            raise ImportError("PyMuPDF is not installed: pip install pymupdf")
+
+        self.document = fitz.open(path)
+
+    def number_of_pages(self):
+        return self.document.page_count
+
+    def extract_text(self, page_number):
+        # Keep the text outside of the page borders too, as the other backends do
+        return self.document[page_number].get_text(clip=fitz.INFINITE_RECT())
+
+    def scan_text(self, page_number):
+        return self.content_strings_text(b''.join(self.document.xref_stream(xref)
+                                                  for xref in self.document[page_number].get_contents()))
+
+    def metadata(self):
+        return {key[0].upper() + key[1:]: value for key, value in (self.document.metadata or {}).items() if value}
+
+    def close(self):
+        self.document.close()
+
+
+class PdfiumTextBackend(PDFTextBackend):
+    """PDF text layer read with pypdfium2 (pip install pypdfium2), based on the PDFium C library"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        if pdfium is None:
+            raise ImportError("pypdfium2 is not installed: pip install pypdfium2")
+
+        self.document = pdfium.PdfDocument(path)
+
+    def number_of_pages(self):
+        return len(self.document)
+
+    def extract_text(self, page_number):
+        page = self.document[page_number]
+        text_page = page.get_textpage()
+        try:
+            return text_page.get_text_range()
+        finally:
+            text_page.close()
+            page.close()
+
+    def metadata(self):
+        return {key: value for key, value in self.document.get_metadata_dict().items() if value}
+
+    def close(self):
+        self.document.close()
+
+
+pdf_text_backends = {'pypdf2': PyPDF2TextBackend, 'pymupdf': PyMuPDFTextBackend, 'pdfium': PdfiumTextBackend}
+
+
+class PDFPages:
+    """
+        Sequence with the text of the pages of a PDF file. Each page is extracted with the text backend and normalized
+        only when it's accessed for the first time, and then kept in memory.
+    """
+
+    text_backend = 'pypdf2'  # name of the PDFTextBackend used for reading the files (see pdf_text_backends)
+
+    def __init__(self, path, texts=None, number_of_pages=None, text_backend=None):
+        """
+            :param path: path of the PDF file.
+            :param texts: (optional) dict with the text of the pages already extracted.
+            :param number_of_pages: (optional) number of pages of the file, if known.
+            :param text_backend: (optional) name of the text backend. By default, PDFPages.text_backend.
+        """
+        self.path = path
+        self.texts = texts or {}  # page number -> normalized text of the page
+        self.text_backend = text_backend or PDFPages.text_backend
+        self.pdf_backend = None
+        self.number_of_pages = number_of_pages if number_of_pages is not None else self.backend.number_of_pages()
+
+    @property
+    def backend(self):
+        """Text backend reading the file, opened again if it had been closed"""
+        if self.pdf_backend is None:
+            self.pdf_backend = pdf_text_backends[self.text_backend](self.path)
+
+        return self.pdf_backend
+
+    @property
+    def metadata(self):
+        """Dict with the document information of the file"""
+        return self.backend.metadata()
+
+    def close(self):
+        """Close the PDF file. The pages already extracted are kept."""
+        if self.pdf_backend:
+            self.pdf_backend.close()
+
+        self.pdf_backend = None
+
+    def __len__(self):
+        return self.number_of_pages
+
+    def __getitem__(self, page_number):
+        if page_number < 0:
+            page_number += self.number_of_pages
+        if not 0 <= page_number < self.number_of_pages:
+            raise IndexError("page %i out of range" % page_number)
+
+        if page_number not in self.texts:
+            self.texts[page_number] = self.backend.normalize(self.backend.extract_text(page_number))
+
+        return self.texts[page_number]
+
+    def __iter__(self):
+        return (self[page_number] for page_number in range(self.number_of_pages))
+
+    def __getstate__(self):
+        # The PDF file can't be pickled, it will be opened again if needed
+        state = self.__dict__.copy()
+        state['pdf_backend'] = None
+        return state
+
+    def find_pages(self, text):
+        """
+            Return the numbers of the pages that may contain a text, scanning them with the fastest method of the
+            backend. The pages that can't be scanned are always returned.
+        """
+        page_numbers = []
+        for page_number in range(self.number_of_pages):
+            if page_number in self.texts:
+                page_text = self.texts[page_number]
+            else:
+                try:
+                    page_text = self.backend.scan_text(page_number)
+                except Exception:
+                    page_text = text  # the page will have to be extracted
+
+            if text in page_text:
+                page_numbers.append(page_number)
+
+        return page_numbers
+
+
+class PageTokens:
+    """
+        Tokens of a normalized report page, split only once, for extracting the tables in a single pass over them.
+    """
+
+    def __init__(self, page, indexed=False):
+        """
+            :param page: normalized text of the page.
+            :param indexed: if True, index the positions of every token, so that looking for many tokens doesn't require
+            scanning the page again each time.
+        """
+        self.tokens = page.split()
+        self.positions = None
+        if indexed:
+            self.positions = {}  # token -> positions where it appears, in order
+            for position, token in enumerate(self.tokens):
+                self.positions.setdefault(token, []).append(position)
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, position):
+        return self.tokens[position]
+
+    def index(self, token, start=0):
+        """Return the position of the first appearance of a token from a position, raising ValueError if missing"""
+        if self.positions is None:
+            return self.tokens.index(token, start)
+
+        positions = self.positions.get(token, [])
+        i = bisect_left(positions, start)
+        if i == len(positions):
+            raise ValueError("%r is not in the page" % token)
+
+        return positions[i]
+
+    def extract_table(self, first_row, header_column, table_position=0):
+        """
+            Extract a table in one pass, from the position of its first row until a word that is not a row header. Each
+            row starts with its header, followed by the values.
+
+            :param first_row: position of the header of the first row.
+            :param header_column: list with the headers of the rows.
+            :param table_position: 0 if there is not another table in the page, 1 if there is one to the left, -1 if
+            there is one to the right. The rows of two tables in the same page are interleaved: the rows of the table
+            on the left are the even ones, and the rows of the table on the right, the odd ones.
+            :return: list with a list for each row of the table.
+        """
+        header_cells = set(header_column)
+        table = []
+        row = []  # the values before the first row header are discarded
+        number_of_rows = 0
+        for cell in islice(self.tokens, first_row, None):
+            if PDFReport.header_cell_regex.match(cell):
+                if cell not in header_cells:
+                    # The table has finished
+                    break
+
+                # New row: keep it only if it belongs to our table
+                row = [cell]
+                if table_position == 0 or number_of_rows % 2 == (table_position == 1):
+                    table.append(row)
+                number_of_rows += 1
+            else:
+                # New cell of the current row
+                row.append(cell)
+
+        return table
 
 
 class PDFReport:
@@ -143,30 +644,74 @@ class PDFReport:
                           'Castilla_y_León', 'Cataluña', 'Ceuta', 'Comunidad_Valenciana', 'Extremadura', 'Galicia',
                           'Madrid', 'Melilla', 'Murcia', 'Navarra', 'País_Vasco', 'La_Rioja']
 
-    def __init__(self, directory, filename):
-        self.index = int(filename[:-4])
-        with open(directory + '/' + filename, 'rb') as file:
-            # Open the file with PyPDF
-            reader = PyPDF2.PdfFileReader(file)
+    # Patterns used for extracting the data, compiled only once
+    table_title_regex = re.compile('Tabla ([0-9]+)[a-z]?[.,]')
+    table_names_regexes = {}  # title of the tables of interest for each table name, depending on the report type
+    removed_symbols_regex = re.compile('[^A-zÀ-ú0-9,.<>≤≥ \\-]')
+    header_cell_regex = re.compile('[A-zÀ-ú_]')
+
+    # Different names of the Autonomous Regions in the reports, replaced in this order
+    autonomous_regions_aliases = [('Castilla La Mancha', 'Castilla_La_Mancha'),
+                                  ('Castilla-La Mancha', 'Castilla_La_Mancha'),
+                                  ('C. Valenciana', 'Comunidad_Valenciana'),
+                                  ('C Valenciana', 'Comunidad_Valenciana'),
+                                  ('País Vasco', 'País_Vasco'),
+                                  ('Castilla y León', 'Castilla_y_León'),
+                                  ('La Rioja', 'La_Rioja'),
+                                  ('Total general', 'ESPAÑA'),
+                                  ('Total', 'ESPAÑA'),
+                                  ('Islas Baleares', 'Baleares'),
+                                  ('Islas Canarias', 'Canarias')]
+
+    # Processed reports cache. Increase the parser version when the processing (or the PDF text backend) changes, so
+    # the reports are processed again with the new version.
+    parser_version = 2
+    cache_filename = 'reports_cache.sqlite'
+    cache_columns = ['number', 'parser_version', 'path', 'date', 'number_of_pages', 'tables_pages',
+                     'tables_index_numbers', 'tables_index_names', 'pages']
+
+    def __init__(self, path, number):
+        self.index = number
 
-            # Read the pages
-            pages_number = range(0, reader.getNumPages())
-            pages = [reader.getPage(x).extractText() for x in pages_number]
-            pages = [' '.join(x.replace('\n', '').split()).strip() for x in pages]  # remove random line breaks
-            self.pages = pages
+        # The pages are only extracted when they are needed
+        self.pages = PDFPages(path)
 
-            # Extract the report date (this will depend on the report type)
-            self.date = self.__extract_date__(reader)
+        # Extract the report date (this will depend on the report type)
+        self.date = self.__extract_date__(self.pages.metadata)
 
-            self.tables_index_numbers = {}  # for each table number save the page number
-            self.tables_index_names = {}  # for each table number, save the name of that table
+        self.tables_index_numbers = {}  # for each table number save the page number
+        self.tables_index_names = {}  # for each table number, save the name of that table
 
-            # Get the page where is each table
-            for page_number, page_content in enumerate(pages):
-                found_table_titles = re.findall('Tabla [0-9]+[a-z]?[.,]', page_content)
-                for title in found_table_titles:
-                    table_number = int(re.match('Tabla [0-9]+', title).group()[6:])
-                    self.tables_index_numbers[table_number] = page_number
+        # Get the page where is each table, extracting only the pages that may contain a table title, and the number
+        # of the tables of interest, checking their names only where a title starts
+        # (the pages whose content stream strings can't be decoded are always extracted)
+        self.tables_pages = self.pages.find_pages('Tabla')
+        self.__index_tables__(self.tables_pages)
+
+        if not self.tables_index_numbers:
+            # The scan found no title, so it may not have decoded them: extract the text of all the pages, indexing
+            # them again in order, so the last page with a title still wins
+            self.tables_pages = list(range(len(self.pages)))
+            self.tables_index_numbers = {}
+            self.tables_index_names = {}
+            self.__index_tables__(self.tables_pages)
+
+        self.pages.close()
+
+    def __index_tables__(self, page_numbers):
+        """
+            Save the page of each table title found in some pages, and the number of the tables of interest.
+            :param page_numbers: numbers of the pages to search, whose text will be extracted.
+        """
+        for page_number in page_numbers:
+            page = self.pages[page_number]
+            for title in PDFReport.table_title_regex.finditer(page):
+                table_number = int(title.group(1))
+                self.tables_index_numbers[table_number] = page_number
+
+                for table_name, regex in self.table_names_regexes.items():
+                    if table_name not in self.tables_index_names and regex.match(page, title.start()):
+                        self.tables_index_names[table_name] = table_number
 
     @staticmethod
     def get_real_autonomous_region_name(ar):
@@ -177,27 +722,170 @@ class PDFReport:
         return ar.replace('_', ' ')
 
     @classmethod
-    def process_reports_batch(cls, directory, last_index):
-        """Return a list with a report object for each PDF report in the specified directory"""
-        reports = []
-        file_list = list(filter(lambda x: x.endswith('.pdf') and int(x[:-4]) > last_index, os.listdir(directory)))
-        new_last_index = last_index
-        for number, filename in enumerate(file_list):
-            # Update the progress percentage
-            percentage = 100 * (number / len(file_list))
-            print("Reading progress: %.2f%%" % percentage, end="\r", flush=True)
+    def process_reports(cls, store, processed_directory, processes=None):
+        """
+            Process the PDF reports of a raw files store that have not been processed yet (or were processed by an older
+            version of the parser, or from another content of the file), spreading them across a pool of processes, and
+            store them in the processed reports cache.
+
+            :param store: RawFileStore with the PDF reports, named after their number.
+            :param processed_directory: directory of the processed reports cache.
+            :param processes: number of processes. If None, use all the cores; if 1, process them in this process.
+            :return: dict with the error message of each report that could not be processed.
+        """
+        os.makedirs(processed_directory, exist_ok=True)
+        with PDFReport.__open_cache__(processed_directory) as connection:
+            processed_paths = {number: path for number, path in connection.execute(
+                'SELECT number, path FROM reports WHERE parser_version = ?', (cls.parser_version,))}
+
+        file_list = sorted((name for name in store
+                            if name.endswith('.pdf') and processed_paths.get(int(name[:-4])) != store.path(name)),
+                           key=lambda name: int(name[:-4]))  # process only the new or outdated reports
+        tasks = [(cls, store.path(name), int(name[:-4])) for name in file_list]
+
+        processes = processes or os.cpu_count()
+        print("Processing %i reports with %i processes" % (len(tasks), processes))
+        if processes == 1 or len(tasks) < 2:
+            results = [process_pdf_report(*task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                results = list(executor.map(process_pdf_report, *zip(*tasks)))
+
+        # Merge the results in the order of the reports, no matter which process finished first, and store them all
+        # in a single transaction
+        records = [record for record, error in results if record]
+        with PDFReport.__open_cache__(processed_directory) as connection:
+            connection.executemany('INSERT OR REPLACE INTO reports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   [tuple(record[column] for column in PDFReport.cache_columns)
+                                    for record in records])
+
+        errors = {file: error for file, (record, error) in zip(file_list, results) if error}
+        for file, error in errors.items():
+            print("Error processing the report %s (%s). Skipping it." % (file, error))
+
+        print("%i reports processed, %i errors" % (len(records), len(errors)))
+        return errors
+
+    @classmethod
+    def read_processed_reports(cls, processed_directory, numbers=None):
+        """
+            Return a list with the processed reports stored in the cache, sorted by their number.
+
+            :param processed_directory: directory of the processed reports cache.
+            :param numbers: (optional) list with the numbers of the reports to read. If None, read all of them.
+        """
+        query = 'SELECT %s FROM reports WHERE parser_version = ?' % ', '.join(PDFReport.cache_columns)
+        parameters = [cls.parser_version]
+        if numbers is not None:
+            query += ' AND number IN (%s)' % ', '.join('?' * len(numbers))
+            parameters.extend(numbers)
+
+        with PDFReport.__open_cache__(processed_directory) as connection:
+            rows = connection.execute(query + ' ORDER BY number', parameters).fetchall()
+
+        return [cls.from_cache_record(dict(zip(PDFReport.cache_columns, row))) for row in rows]
+
+    @classmethod
+    def read_processed_report(cls, processed_directory, number):
+        """Return a processed report stored in the cache, or None if it's not there"""
+        reports = cls.read_processed_reports(processed_directory, [number])
+        return reports[0] if reports else None
 
-            new_report = cls(directory, filename)
-            reports.append(new_report)
-            new_last_index = max(new_last_index, new_report.index)
+    @classmethod
+    def extract_and_store(cls, processed_directory, database, extractors):
+        """
+            Extract the data from the processed reports and upsert it into the database. Only the reports that have not
+            been extracted yet by the current version of each extractor (or that have been processed again) are read
+            and extracted, so a normal day only requires extracting the new reports.
+
+            :param processed_directory: directory of the processed reports cache.
+            :param database: MongoDatabase where the data will be stored.
+            :param extractors: dict with, for each collection, a tuple with the name of the report method returning its
+            documents, the version of that method (increase it when the method changes, so all the reports are
+            extracted again), and the list of fields identifying each document.
+        """
+        with PDFReport.__open_cache__(processed_directory) as connection:
+            processed_numbers = [number for number, in connection.execute(
+                'SELECT number FROM reports WHERE parser_version = ? ORDER BY number', (cls.parser_version,))]
+            extracted_versions = {(number, collection): extractor_version
+                                  for number, collection, extractor_version in connection.execute(
+                                      'SELECT number, collection, extractor_version FROM extractions '
+                                      'WHERE parser_version = ?', (cls.parser_version,))}
+
+        # Reports that each extractor has to extract
+        pending_numbers = {collection: {number for number in processed_numbers
+                                        if extracted_versions.get((number, collection)) != extractor_version}
+                           for collection, (method, extractor_version, keys) in extractors.items()}
+        numbers = sorted(set().union(*pending_numbers.values()))
+        reports = cls.read_processed_reports(processed_directory, numbers) if numbers else []
+
+        for collection, (method, extractor_version, keys) in extractors.items():
+            documents = {}  # the documents of the latest report prevail over the ones of a previous report
+            extractions = []
+            for report in filter(lambda x: x.index in pending_numbers[collection], reports):
+                try:
+                    report_documents = getattr(report, method)() or []
+                except Exception:
+                    # It will be tried again in the next run
+                    print("Error trying to extract %s from report %i" % (collection, report.index))
+                    continue
+
+                documents.update({tuple(document[key] for key in keys): document for document in report_documents})
+                extractions.append((report.index, collection, cls.parser_version, extractor_version,
+                                    len(report_documents)))
+
+            if documents:
+                database.upsert_data(collection, list(documents.values()), keys)
+
+            # Once stored, remember which reports have been extracted
+            with PDFReport.__open_cache__(processed_directory) as connection:
+                connection.executemany('INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?, ?)', extractions)
+
+            print("%s: %i reports extracted, %i documents stored" % (collection, len(extractions), len(documents)))
 
-        print("Reading progress: 100%", end="\r", flush=True)
+    def get_cache_record(self):
+        """Return a dict with the processed data of the report, as stored in the cache"""
+        return {'number': self.index,
+                'parser_version': self.parser_version,
+                'path': self.pages.path,
+                'date': self.date.isoformat() if self.date else None,
+                'number_of_pages': len(self.pages),
+                'tables_pages': json.dumps(self.tables_pages),
+                'tables_index_numbers': json.dumps(self.tables_index_numbers),
+                'tables_index_names': json.dumps(self.tables_index_names),
+                'pages': zlib.compress(json.dumps(self.pages.texts).encode())}
 
-        return reports, new_last_index
+    @classmethod
+    def from_cache_record(cls, record):
+        """Build a report from its processed data, as stored in the cache, without reading the PDF file"""
+        report = cls.__new__(cls)
+        report.index = record['number']
+        report.date = dt.fromisoformat(record['date']) if record['date'] else None
+        report.tables_pages = json.loads(record['tables_pages'])
+        report.tables_index_numbers = {int(k): v for k, v in json.loads(record['tables_index_numbers']).items()}
+        report.tables_index_names = json.loads(record['tables_index_names'])
+        texts = {int(k): v for k, v in json.loads(zlib.decompress(record['pages'])).items()}
+        report.pages = PDFPages(record['path'], texts, record['number_of_pages'])
+        return report
+
+    @staticmethod
+    def __open_cache__(processed_directory):
+        """
+            Open the processed reports cache, creating it if it didn't exist. It contains the processed reports, and
+            which reports have been extracted into each collection.
+        """
+        connection = sqlite3.connect(processed_directory + '/' + PDFReport.cache_filename)
+        connection.execute('CREATE TABLE IF NOT EXISTS reports (number INTEGER PRIMARY KEY, parser_version INTEGER, '
+                           'path TEXT, date TEXT, number_of_pages INTEGER, tables_pages TEXT, '
+                           'tables_index_numbers TEXT, tables_index_names TEXT, pages BLOB)')
+        connection.execute('CREATE TABLE IF NOT EXISTS extractions (number INTEGER, collection TEXT, '
+                           'parser_version INTEGER, extractor_version INTEGER, documents INTEGER, '
+                           'PRIMARY KEY (number, collection))')
+        return closing_connection(connection)
 
     @abstractmethod
-    def __extract_date__(self, reader):
-        """Extract the date when the report was written"""
+    def __extract_date__(self, metadata):
+        """Extract the date when the report was written, from the document information of the file or its pages"""
 
     @staticmethod
     def convert_value_to_number(value, is_float=False):
@@ -243,23 +931,15 @@ class PDFReport:
     @staticmethod
     def remove_ar_spaces_and_symbols(page, table_number):
         """Replace the spaces in the Autnomous Regions names with _ and remove undesired symbols like *, %..."""
-        replaced_page = page.replace('Castilla La Mancha', 'Castilla_La_Mancha') \
-            .replace('Castilla-La Mancha', 'Castilla_La_Mancha') \
-            .replace('C. Valenciana', 'Comunidad_Valenciana') \
-            .replace('C Valenciana', 'Comunidad_Valenciana') \
-            .replace('País Vasco', 'País_Vasco') \
-            .replace('Castilla y León', 'Castilla_y_León') \
-            .replace('La Rioja', 'La_Rioja') \
-            .replace('Total general', 'ESPAÑA') \
-            .replace('Total', 'ESPAÑA') \
-            .replace('Islas Baleares', 'Baleares') \
-            .replace('Islas Canarias', 'Canarias')
+        replaced_page = page
+        for alias, autonomous_region in PDFReport.autonomous_regions_aliases:
+            replaced_page = replaced_page.replace(alias, autonomous_region)
 
         if table_number:
             # The "Tabla X" expression is used later for trimming the table data in the text array
             replaced_page = replaced_page.replace(f'Tabla {table_number}.', f'_TABLA{table_number}_')
 
-        replaced_page = re.sub('[^A-zÀ-ú0-9,.<>≤≥ \-]', '', replaced_page)  # remove useless symbols, like %, *, (, etc.
+        replaced_page = PDFReport.removed_symbols_regex.sub('', replaced_page)  # remove useless symbols, like %, *, (...
         return replaced_page
 
     def get_table_position(self, table_number):
@@ -289,42 +969,12 @@ class PDFReport:
         """
         if header_column is None:
             header_column = PDFReport.autonomous_regions
-        header_cell_regex = '[A-zÀ-ú_]'
-        table_page = page.split()
 
-        table_start = table_page.index(f'_TABLA{table_number}_')  # get the beginning of the columns row
-        first_word = header_column[0]
-        table_first_row = table_page.index(first_word, table_start)  # get the beginning of the first row
+        page_tokens = PageTokens(page)
+        table_start = page_tokens.index(f'_TABLA{table_number}_')  # get the beginning of the columns row
+        table_first_row = page_tokens.index(header_column[0], table_start)  # get the beginning of the first row
 
-        table = []
-        row = []
-        for i, cell in enumerate(table_page[table_first_row:]):
-            if re.match(header_cell_regex, cell):
-                # New row?
-                if cell in header_column:  # New row?
-                    row = []
-                    table.append(row)
-                    row.append(cell)
-                else:
-                    # The table has finished
-                    break
-            else:
-                # New cell of the current row
-                row.append(cell)
-
-        # Does the array table contain only our table, or another table in the same page?
-        if table_position == 0:
-            # Only our table: return the table as an array where each row is represented as a list item,
-            # containing all the columns
-            return table
-        else:
-            # There are two tables in the table variable: we need to extract the data corresponding to our table
-            if table_position == 1:
-                # Our table is in the right/down side: take only the even rows
-                return table[1::2]
-            elif table_position == -1:
-                # Our table is in the left/upper side: take only the odd rows
-                return table[::2]
+        return page_tokens.extract_table(table_first_row, header_column, table_position)
 
     @staticmethod
     def get_number_of_samples(percentage, total):
@@ -343,24 +993,520 @@ class PDFReport:
         return lower_range, higher_range
 
 
-def download_csv_file(url, filename, overwrite_if_exists=True):
+def process_pdf_report(report_class, path, number):
+    """
+        Process a PDF report. Since it's run in a pool of processes, the errors are returned instead of raised.
+
+        :param report_class: PDFReport subclass of the report.
+        :param path: path of the PDF report file.
+        :param number: number of the report.
+        :return: tuple with the cache record of the processed report and the error message (one of them will be None).
+    """
+    try:
+        return report_class(path, number).get_cache_record(), None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+
+@contextmanager
+def closing_connection(connection):
+    """Commit the changes made in a SQLite connection (or roll them back on error) and close it"""
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def calculate_grouping_sets(df, index_columns, value_columns, total_labels=None, cumulative_columns=None,
+                            order_column='date'):
+    """
+        Sum some columns of a DataFrame for every combination of the index columns and, in the same pass, for all the
+        totals of those columns (for example, the whole country or both genders), like an SQL GROUPING SETS clause.
+        The index columns are converted to integer codes and the values are added into a dense array with one axis per
+        index column, so all the totals and the cumulative sums are calculated with NumPy, without intermediate
+        DataFrames.
+        :param df: DataFrame with the data to aggregate.
+        :param index_columns: List of columns identifying each group. Rows with an empty value in any of them are
+        ignored, as in DataFrame.groupby.
+        :param value_columns: List of numeric columns to sum. Empty values are considered 0.
+        :param total_labels: (optional) Dictionary with the label of the rows aggregating all the values of some index
+        columns, e.g. {'autonomous_region': 'España', 'gender': 'total'}. Every combination of totals is calculated.
+        :param cumulative_columns: (optional) Dictionary mapping some value columns to the name of a new column with
+        their cumulative sum along the order column, for each group.
+        :param order_column: Index column along which the cumulative sums are calculated.
+        :return: DataFrame with a row for each group containing at least one row of the original DataFrame.
     """
-        Download a file from an URL and store it in the csv_data folder.
+    total_labels = total_labels or {}
+    cumulative_columns = cumulative_columns or {}
+
+    # Encode each index column as integers, with an additional code for its total, if requested
+    codes = []
+    labels = []
+    for column in index_columns:
+        column_codes, column_labels = pd.factorize(df[column], sort=True)
+        if column in total_labels:
+            column_labels = column_labels.append(pd.Index([total_labels[column]]))
+        codes.append(column_codes)
+        labels.append(column_labels)
+
+    shape = tuple(len(column_labels) for column_labels in labels)
+    valid_rows = np.logical_and.reduce([column_codes >= 0 for column_codes in codes])
+    positions = np.ravel_multi_index([column_codes[valid_rows] for column_codes in codes], shape)
+    size = int(np.prod(shape))
+
+    # Add the values of each group: the first array counts the rows, used later for knowing which groups exist
+    cube = np.empty((len(value_columns) + 1,) + shape)
+    cube[0] = np.bincount(positions, minlength=size).reshape(shape)
+    for i, column in enumerate(value_columns):
+        values = df[column].to_numpy(dtype='float64', na_value=0)[valid_rows]
+        cube[i + 1] = np.bincount(positions, weights=values, minlength=size).reshape(shape)
+
+    # Calculate the totals, one index column after the other, so the totals of totals are also included
+    for column in total_labels:
+        axis = index_columns.index(column) + 1
+        total_slice = [slice(None)] * cube.ndim
+        total_slice[axis] = -1
+        values_slice = [slice(None)] * cube.ndim
+        values_slice[axis] = slice(0, -1)
+        cube[tuple(total_slice)] = cube[tuple(values_slice)].sum(axis=axis)
+
+    # Build the DataFrame with the existing groups
+    cube = cube.reshape(len(value_columns) + 1, size)
+    existing = np.flatnonzero(cube[0])
+    existing_codes = np.unravel_index(existing, shape)
+    result = pd.DataFrame({column: labels[i].take(existing_codes[i]) for i, column in enumerate(index_columns)})
+
+    for i, column in enumerate(value_columns):
+        dtype = df[column].dtype if pd.api.types.is_integer_dtype(df[column].dtype) else 'float64'
+        result[column] = cube[i + 1, existing].astype(dtype)
+
+    if cumulative_columns:
+        axis = index_columns.index(order_column)
+        for column, cumulative_column in cumulative_columns.items():
+            values = cube[value_columns.index(column) + 1].reshape(shape).cumsum(axis=axis).reshape(size)
+            dtype = result[column].dtype
+            result[cumulative_column] = values[existing].astype(dtype)
+
+    return result
+
+
+def dataframe_to_documents(df, batch_size=10000):
+    """
+        Convert a DataFrame into a list of documents ready to be stored in MongoDB, turning the dotted column paths into
+        nested documents (the column 'a.b' is stored as {'a': {'b': value}}). Instead of iterating over every key of
+        every record, each column is converted to a list of Python values at once and the documents of each level are
+        zipped from those lists, a batch of rows at a time. The values are the same as in df.to_dict('records').
+        :param df: DataFrame with the data. The column names are paths of any depth, separated by dots.
+        :param batch_size: Number of rows converted at the same time, limiting the intermediate lists kept in memory.
+        :return: list with a document for each row of the DataFrame.
+    """
+    # Tree of the column paths, in the order of the columns: every leaf is the position of its column
+    tree = {}
+    for position, column in enumerate(df.columns):
+        *parent_keys, key = str(column).split('.')
+        node = tree
+        for parent_key in parent_keys:
+            node = node.setdefault(parent_key, {})
+            if not isinstance(node, dict):
+                raise ValueError("The column %s is inside the field %s, which is also a column" % (column, parent_key))
+        if key in node:
+            raise ValueError("The column %s is repeated or contains other columns" % column)
+        node[key] = position
+
+    def build_documents(node, columns_values):
+        """Zip the values of the fields of one level of the tree into documents"""
+        fields_values = [build_documents(child, columns_values) if isinstance(child, dict) else columns_values[child]
+                         for child in node.values()]
+        return [dict(zip(node, values)) for values in zip(*fields_values)]
+
+    if not tree:
+        return [{} for _ in range(len(df))]
+
+    documents = []
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start:start + batch_size]
+        columns_values = [batch.iloc[:, position].tolist() for position in range(batch.shape[1])]
+        documents.extend(build_documents(tree, columns_values))
+
+    return documents
+
+
+DownloadResult = namedtuple('DownloadResult', ['url', 'path', 'status_code', 'changed', 'size', 'sha256', 'headers',
+                                               'elapsed_time'])
+
+
+class DownloadManager:
+    """
+        Download files over HTTP with one pooled keep-alive session per host, timeouts, retries with exponential
+        backoff, a bounded number of concurrent downloads, and a maximum request rate per host.
+    """
+
+    def __init__(self, max_workers=4, requests_per_second=4, timeout=(10, 120), retries=3, backoff_factor=1):
+        """
+            :param max_workers: maximum number of concurrent requests.
+            :param requests_per_second: maximum number of requests per second sent to the same host.
+            :param timeout: tuple with the connection and the read timeouts, in seconds.
+            :param retries: number of retries when the connection fails or the server returns a temporary error.
+            :param backoff_factor: the retry number N waits backoff_factor * 2^(N-1) seconds.
+        """
+        self.max_workers = max_workers
+        self.min_request_interval = 1 / requests_per_second if requests_per_second else 0
+        self.timeout = timeout
+        self.retry_policy = Retry(total=retries, backoff_factor=backoff_factor,
+                                  status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET', 'HEAD'],
+                                  raise_on_status=False)
+
+        self.sessions = {}  # for each host, a requests session reusing its connections
+        self.next_request_time = {}  # for each host, the moment when the next request can be sent
+        self.lock = threading.Lock()
+        self.timings = []  # for each downloaded file, a DownloadResult with its size and the time it took
+
+    def __get_session__(self, host):
+        """Return the session used for the requests to a host, creating it if needed"""
+        with self.lock:
+            if host not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, max_retries=self.retry_policy)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[host] = session
+
+            return self.sessions[host]
+
+    def __wait_for_host__(self, host):
+        """Wait until a new request can be sent to a host without exceeding its rate limit"""
+        with self.lock:
+            now = time.monotonic()
+            request_time = max(now, self.next_request_time.get(host, now))
+            self.next_request_time[host] = request_time + self.min_request_interval
+
+        if request_time > now:
+            time.sleep(request_time - now)
+
+    def request(self, method, url, **kwargs):
+        """Send an HTTP request through the session of the host, respecting its rate limit"""
+        host = urlparse(url).netloc
+        session = self.__get_session__(host)
+        self.__wait_for_host__(host)
+
+        return session.request(method, url, timeout=self.timeout, **kwargs)
+
+    def get(self, url, **kwargs):
+        """Send a GET request"""
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """Send a HEAD request"""
+        return self.request('HEAD', url, allow_redirects=True, **kwargs)
+
+    def download_file(self, url, path, headers=None, previous_sha256=None):
+        """
+            Download a file, streaming it to a temporary file that replaces the previous one only when the download
+            has finished successfully.
+            :param url: URL of the file.
+            :param path: path where the file will be saved.
+            :param headers: (optional) dictionary with additional HTTP headers, like the conditional request ones.
+            :param previous_sha256: (optional) SHA-256 of the current file. If the downloaded file has the same hash,
+            the current file is kept untouched.
+            :return: DownloadResult. If the status code is 304 or an error, nothing is saved.
+        """
+        start_time = time.perf_counter()
+        with self.get(url, headers=headers, stream=True) as response:
+            file_hash = hashlib.sha256()
+            size = 0
+            changed = False
+            has_content = response.status_code < 400 and response.status_code != 304
+
+            if has_content:
+                with open(path + '.part', 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=1024 * 1024):
+                        file.write(chunk)
+                        file_hash.update(chunk)
+                        size += len(chunk)
+
+                changed = file_hash.hexdigest() != previous_sha256
+                if changed:
+                    os.replace(path + '.part', path)
+                else:
+                    os.remove(path + '.part')
+
+            result = DownloadResult(url, path, response.status_code, changed, size,
+                                    file_hash.hexdigest() if has_content else None, response.headers,
+                                    time.perf_counter() - start_time)
+
+        with self.lock:
+            self.timings.append(result)
+
+        return result
+
+    def download_files(self, files):
+        """
+            Download several files concurrently.
+            :param files: list of (URL, path) tuples.
+            :return: list with a DownloadResult for each file, in the same order. If a file couldn't be downloaded
+            because of a connection error, its status code is None.
+        """
+        def download(file):
+            url, path = file
+            try:
+                return self.download_file(url, path)
+            except requests.RequestException as e:
+                print("Error downloading %s: %s" % (url, e))
+                return DownloadResult(url, path, None, False, 0, None, {}, None)
+
+        return self.map(download, files)
+
+    def map(self, function, items):
+        """Call a function for each item, running at most max_workers calls at the same time"""
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(function, items))
+
+    def print_timings(self):
+        """Print the size and download time of each downloaded file, and the total throughput"""
+        total_size = 0
+        total_time = 0
+        for result in self.timings:
+            if result.size:
+                print("%s: %i bytes in %.2f s" % (result.url, result.size, result.elapsed_time))
+                total_size += result.size
+                total_time += result.elapsed_time
+
+        if total_time:
+            print("Downloaded %.1f MB at %.2f MB/s per connection" % (total_size / 1e6, total_size / 1e6 / total_time))
+
+
+RawFile = namedtuple('RawFile', ['name', 'sha256', 'size', 'fetch_time', 'metadata', 'path'])
+
+
+class RawFileStore:
+    """
+        Store of the downloaded files, saved by the SHA-256 of their content, so a file downloaded again with the same
+        content (or the same content under another name) is only saved once. A manifest maps the logical name of each
+        file (report number, report date, dataset name...) in each collection to its hash, size and fetch time, so
+        checking if a file is new is a lookup instead of a directory listing.
+    """
+
+    store_directory = 'raw_files'
+    manifest_filename = 'manifest.sqlite'
+    manifest_timeout = 60  # seconds waiting for another task writing the manifest at the same time
+    validator_headers = {'etag': 'ETag', 'last_modified': 'Last-Modified'}  # metadata field of each header
+
+    def __init__(self, collection, directory=None):
+        """
+            Read the manifest of a collection of files.
+            :param collection: name of the collection (for example, renave_reports).
+            :param directory: (optional) directory of the store, shared by all the collections.
+        """
+        self.collection = collection
+        self.directory = directory or RawFileStore.store_directory
+        os.makedirs(self.directory + '/objects', exist_ok=True)
+        os.makedirs(self.directory + '/downloads', exist_ok=True)
+
+        with self.__open_manifest__() as connection:
+            self.files = {row[0]: self.__raw_file__(*row) for row in connection.execute(
+                'SELECT name, sha256, size, fetch_time, metadata FROM files WHERE collection = ?', (collection,))}
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def get(self, name):
+        """Return the RawFile with a logical name, or None if it's not in the store"""
+        return self.files.get(name)
+
+    def path(self, name):
+        """Return the path of the content of a file"""
+        return self.files[name].path
+
+    def object_path(self, sha256, name):
+        """Return the path where a content is saved, keeping the extension of the file so it can still be recognized"""
+        return '%s/objects/%s/%s%s' % (self.directory, sha256[:2], sha256, os.path.splitext(name)[1])
+
+    def add(self, name, path, sha256=None, metadata=None):
+        """
+            Move a file into the store, saving it with a logical name.
+            :param name: logical name of the file in the collection.
+            :param path: path of the file, that will be moved into the store (or removed, if its content was already
+            stored).
+            :param sha256: (optional) SHA-256 of the file, if it's already known.
+            :param metadata: (optional) dictionary with the metadata of the file (URL, ETag...).
+            :return: RawFile of the stored file.
+        """
+        sha256 = sha256 or file_sha256(path)
+        size = os.path.getsize(path)
+        object_path = self.object_path(sha256, name)
+        if os.path.exists(object_path):
+            os.remove(path)  # the same content is already stored
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(path, object_path)
+
+        raw_file = RawFile(name, sha256, size, dt.now().isoformat(), metadata or {}, object_path)
+        self.__save__(raw_file)
+        return raw_file
+
+    def update_metadata(self, name, metadata, fetched=False):
+        """
+            Update the metadata of a stored file.
+            :param name: logical name of the file.
+            :param metadata: dictionary with the metadata fields to update.
+            :param fetched: if True, the file has just been fetched again (with the same content), so its fetch time
+            is updated too.
+        """
+        raw_file = self.files[name]
+        self.__save__(raw_file._replace(metadata={**raw_file.metadata, **metadata},
+                                        fetch_time=dt.now().isoformat() if fetched else raw_file.fetch_time))
+
+    def is_processed(self, name):
+        """Return True if the current content of a file has already been processed and stored"""
+        raw_file = self.files.get(name)
+        return raw_file is not None and raw_file.metadata.get('processed_sha256') == raw_file.sha256
+
+    def mark_processed(self, name):
+        """Record that the current content of a file has been processed and stored"""
+        self.update_metadata(name, {'processed_sha256': self.files[name].sha256})
+
+    def download_files(self, download_manager, files):
+        """
+            Download several files concurrently into the store. A file already in the store is requested with its ETag
+            and Last-Modified date, so the server doesn't send it again if it hasn't changed.
+            :param download_manager: DownloadManager used for the requests.
+            :param files: list of (URL, logical name) tuples.
+            :return: list with a DownloadResult for each file, in the same order. If a file couldn't be downloaded
+            because of a connection error, its status code is None.
+        """
+        def download(file):
+            url, name = file
+            previous = self.files.get(name)
+            headers = {}
+            if previous and previous.metadata.get('etag'):
+                headers['If-None-Match'] = previous.metadata['etag']
+            if previous and previous.metadata.get('last_modified'):
+                headers['If-Modified-Since'] = previous.metadata['last_modified']
+
+            # Each file is downloaded into its own temporary file, and moved into the store once it has finished
+            path = '%s/downloads/%s' % (self.directory,
+                                        hashlib.sha256(('%s/%s' % (self.collection, name)).encode()).hexdigest())
+            try:
+                return download_manager.download_file(url, path, headers, previous.sha256 if previous else None)
+            except requests.RequestException as e:
+                print("Error downloading %s: %s" % (url, e))
+                return DownloadResult(url, path, None, False, 0, None, {}, None)
+
+        results = download_manager.map(download, files)
+
+        # Update the manifest once all the files have been downloaded
+        for (url, name), result in zip(files, results):
+            validators = {field: result.headers[header] for field, header in self.validator_headers.items()
+                          if result.headers.get(header)}
+            if result.changed:
+                # New content: the validators of the previous one are no longer valid
+                self.add(name, result.path, result.sha256,
+                         {'url': url, **{field: None for field in self.validator_headers}, **validators})
+            elif result.status_code is not None and result.status_code < 400 and name in self.files:
+                # Not modified, or downloaded with the same content: a 304 response doesn't have to repeat all the
+                # validators, so only the ones sent by the server are updated
+                self.update_metadata(name, {'url': url, **validators}, fetched=True)
+
+        return results
+
+    def import_directory(self, directory, extension):
+        """
+            Move into the store the files downloaded into a directory by the previous versions of the workflow, so they
+            are not downloaded again. The metadata saved next to each file is kept.
+            :param directory: directory with the downloaded files.
+            :param extension: extension of the files to import. Each file is stored with its filename as logical name.
+        """
+        if not os.path.isdir(directory):
+            return
+
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(extension) and filename not in self.files:
+                metadata = {}
+                if os.path.exists(directory + '/' + filename + '.json'):
+                    with open(directory + '/' + filename + '.json', 'r') as f:
+                        metadata = json.load(f)
+                    os.remove(directory + '/' + filename + '.json')
+                    metadata.pop('sha256', None)  # the hash is calculated again from the content
+
+                self.add(filename, directory + '/' + filename, metadata=metadata)
+
+        print("Imported %i files from %s into the store" % (len(self.files), directory))
+
+    def __raw_file__(self, name, sha256, size, fetch_time, metadata):
+        """Build a RawFile from a row of the manifest"""
+        return RawFile(name, sha256, size, fetch_time, json.loads(metadata), self.object_path(sha256, name))
+
+    def __save__(self, raw_file):
+        """Save a file in the manifest, removing its previous content if no other file has it"""
+        previous = self.files.get(raw_file.name)
+        with self.__open_manifest__() as connection:
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                               (self.collection, raw_file.name, raw_file.sha256, raw_file.size, raw_file.fetch_time,
+                                json.dumps(raw_file.metadata)))
+            orphaned = previous is not None and previous.path != raw_file.path and connection.execute(
+                'SELECT COUNT(*) FROM files WHERE sha256 = ?', (previous.sha256,)).fetchone()[0] == 0
+
+        self.files[raw_file.name] = raw_file
+        if orphaned and os.path.exists(previous.path):
+            os.remove(previous.path)
+
+    def __open_manifest__(self):
+        """Open the manifest of the store, creating it if it didn't exist"""
+        connection = sqlite3.connect(self.directory + '/' + RawFileStore.manifest_filename,
+                                     timeout=RawFileStore.manifest_timeout)
+        connection.execute('CREATE TABLE IF NOT EXISTS files (collection TEXT, name TEXT, sha256 TEXT, size INTEGER, '
+                           'fetch_time TEXT, metadata TEXT, PRIMARY KEY (collection, name))')
+        connection.execute('CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)')
+        return closing_connection(connection)
+
+
+def file_sha256(path):
+    """Return the SHA-256 of the content of a file"""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def download_csv_file(url, filename, overwrite_if_exists=True, download_manager=None):
+    """
+        Download a file from an URL and save it in the csv_data collection of the raw files store.
+        The ETag and Last-Modified of the file are saved in the store, so the next download is a conditional request
+        and the server doesn't send the file again if it hasn't changed. The same content is
+        only saved once.
         :param url URL of the CSV file.
-        :param filename name used to save the downloaded file.
+        :param filename logical name of the downloaded file in the store.
         :param overwrite_if_exists When True, if the file already exists, it will be downloaded anyway and overwrite
         the previous one. When False, the download will be skipped.
+        :param download_manager (optional) DownloadManager used for the request.
+        :return: True if a new content was downloaded, False if the file didn't change or couldn't be downloaded.
     """
+    store = RawFileStore('csv_data')
+    if not store:
+        store.import_directory('csv_data', '.csv')  # files downloaded before the store existed
 
-    # Create the directory for saving the CSVs
-    if 'csv_data' not in os.listdir():
-        os.mkdir('csv_data')
+    if not overwrite_if_exists and filename in store:
+        return False
 
-    if overwrite_if_exists or not os.path.exists('csv_data/' + filename):
-        request = requests.get(url)
-        if request.status_code < 400:
-            print("File %s downloaded successfully" % filename)
-            with open('csv_data/' + filename, 'wb') as file:
-                file.write(request.content)
-        else:
-            print("Error downloading file %s" % filename)
+    result, = store.download_files(download_manager or DownloadManager(), [(url, filename)])
+
+    if result.status_code is None:
+        raise requests.ConnectionError("Could not download the file %s" % filename)
+    elif result.status_code == 304:
+        print("File %s not modified since the previous download" % filename)
+    elif result.status_code >= 400:
+        print("Error downloading file %s" % filename)
+    elif result.changed:
+        print("File %s downloaded successfully in %.2f s" % (filename, result.elapsed_time))
+    else:
+        print("File %s downloaded, but its content didn't change" % filename)
+
+    return result.changed
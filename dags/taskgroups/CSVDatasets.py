@@ -7,10 +7,10 @@
 import pandas as pd
 from airflow.operators.python import PythonOperator
 from airflow.utils.task_group import TaskGroup
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta as td
 import locale
 
-from AuxiliaryFunctions import download_csv_file, CSVDataset, MongoDatabase
+from AuxiliaryFunctions import download_csv_file, calculate_grouping_sets, CSVDataset, MongoDatabase, RawFileStore
 
 
 # region CSV datasets models
@@ -19,54 +19,98 @@ from AuxiliaryFunctions import download_csv_file, CSVDataset, MongoDatabase
 class DailyCOVIDData(CSVDataset):
     """Represent the RENAVE CSV with the daily cases, hospitalizations and deaths"""
 
-    def __init__(self, covid_dataset_file, provinces_dataset_file):
+    column_translations = {'sexo': 'gender', 'provincia_iso': 'province', 'grupo_edad': 'age_range', 'fecha': 'date',
+                           'num_casos': 'new_cases', 'num_def': 'new_deaths', 'num_hosp': 'new_hospitalizations',
+                           'num_uci': 'new_ic_hospitalizations'}
+    gender_translations = {'H': 'M', 'M': 'F', 'NC': 'unknown'}
+    index_columns = ['gender', 'age_range', 'date', 'autonomous_region']
+    series_columns = ['gender', 'age_range', 'autonomous_region']
+    value_columns = ['new_cases', 'new_deaths', 'new_hospitalizations', 'new_ic_hospitalizations']
+    total_columns = {'new_cases': 'total_cases', 'new_hospitalizations': 'total_hospitalizations',
+                     'new_ic_hospitalizations': 'total_ic_hospitalizations', 'new_deaths': 'total_deaths'}
+
+    def __init__(self, covid_dataset_file, provinces_dataset_file, chunk_size=None, since=None):
+        """
+            :param covid_dataset_file: path of the RENAVE CSV.
+            :param provinces_dataset_file: path of the CSV mapping each province ISO code to its Autonomous Region.
+            :param chunk_size: (optional) when set, the RENAVE CSV is read in chunks of this number of rows, and each
+            chunk is aggregated by Autonomous Region before reading the next one, so the memory used doesn't grow with
+            the size of the file.
+            :param since: (optional) when set, only the data from this date on is processed. The total_* columns will
+            then start counting from this date, until the previous totals are added with add_previous_totals.
+        """
         self.provinces_dataset_file = provinces_dataset_file
-        super(DailyCOVIDData, self).__init__(covid_dataset_file)
+        self.chunk_size = chunk_size
+        self.since = since
 
-    def __process_dataset__(self):
-        df = self.df
-        provinces_df = pd.read_csv(self.provinces_dataset_file)
+        provinces_df = pd.read_csv(provinces_dataset_file)
+        self.provinces = provinces_df.set_index('iso')['comunidad autónoma']  # province ISO code -> Autonomous Region
+
+        df = self.__read_dataset_in_chunks__(covid_dataset_file) if chunk_size else None
+        super(DailyCOVIDData, self).__init__(covid_dataset_file, dataframe=df)
+
+    def __read_dataset_in_chunks__(self, covid_dataset_file):
+        """Stream the RENAVE CSV and return it already aggregated by Autonomous Region"""
+        df = None
+        with pd.read_csv(covid_dataset_file, usecols=list(DailyCOVIDData.column_translations.keys()),
+                         chunksize=self.chunk_size) as reader:
+            for chunk in reader:
+                chunk_df = self.__aggregate_by_autonomous_region__(chunk)
+
+                # Add the chunk to the data aggregated so far (the same day can be split between two chunks)
+                df = chunk_df if df is None else df.add(chunk_df, fill_value=0)
 
+        return df.astype('int64').reset_index()
+
+    def __aggregate_by_autonomous_region__(self, df):
+        """Translate the RENAVE columns and sum the provinces data of each Autonomous Region"""
         # Translate the indexes
-        df = df.rename(
-            columns={'sexo': 'gender', 'provincia_iso': 'province', 'grupo_edad': 'age_range', 'fecha': 'date',
-                     'num_casos': 'new_cases', 'num_def': 'new_deaths', 'num_hosp': 'new_hospitalizations',
-                     'num_uci': 'new_ic_hospitalizations'})
-        provinces_df = provinces_df.rename(columns={'iso': 'province', 'comunidad autónoma': 'autonomous_region'})
+        df = df.rename(columns=DailyCOVIDData.column_translations)
 
         # Translate the gender codes
-        gender_translations = {'H': 'M', 'M': 'F', 'NC': 'unknown'}
-        df['gender'] = df['gender'].replace(gender_translations)
+        df['gender'] = df['gender'].replace(DailyCOVIDData.gender_translations)
 
         # Convert the date from String to Date type
         df['date'] = pd.to_datetime(df['date'])
+        if self.since:
+            df = df[df['date'] >= self.since]
 
-        # Replace provinces with Autonomous Regions
-        df = pd.merge(df, provinces_df, on='province')
-        df = df.drop(columns=['province'])
-        self.df = df.groupby(['gender', 'age_range', 'date', 'autonomous_region']).sum().reset_index()
-
-        # Get the data for the whole country
-        df_total = self.df.groupby(['gender', 'age_range', 'date']).sum().reset_index()
-        df_total['autonomous_region'] = 'España'
-        self.df = pd.concat([self.df, df_total])
-
-        # Get the data for both genders
-        df_total = self.df.groupby(['age_range', 'date', 'autonomous_region']).sum().reset_index()
-        df_total['gender'] = 'total'
-        self.df = pd.concat([self.df, df_total])
+        # Replace provinces with Autonomous Regions (the rows with an unknown province are discarded)
+        df['autonomous_region'] = df['province'].map(self.provinces)
+        df = df.dropna(subset=['autonomous_region'])
 
-        # Get the data for all ages
-        df_total = self.df.groupby(['gender', 'date', 'autonomous_region']).sum().reset_index()
-        df_total['age_range'] = 'total'
-        self.df = pd.concat([self.df, df_total])
+        return df.groupby(DailyCOVIDData.index_columns)[DailyCOVIDData.value_columns].sum()
 
-        # Calculate the total cases, deaths, and hospitalizations
-        df_total = self.df.groupby(['gender', 'age_range', 'date', 'autonomous_region']).sum().groupby(
-            ['gender', 'age_range', 'autonomous_region']).cumsum().rename(
-            columns={'new_cases': 'total_cases', 'new_hospitalizations': 'total_hospitalizations',
-                     'new_ic_hospitalizations': 'total_ic_hospitalizations', 'new_deaths': 'total_deaths'})
-        self.df = pd.merge(self.df, df_total, on=['gender', 'age_range', 'date', 'autonomous_region'])
+    def __process_dataset__(self):
+        if not self.chunk_size:
+            # When the dataset is read in chunks, it is already aggregated by Autonomous Region at this point
+            self.df = self.__aggregate_by_autonomous_region__(self.df).reset_index()
+
+        # Get the data for the whole country, both genders, and all ages, and calculate the total cases, deaths, and
+        # hospitalizations for each one
+        self.df = calculate_grouping_sets(self.df, DailyCOVIDData.index_columns, DailyCOVIDData.value_columns,
+                                          total_labels={'autonomous_region': 'España', 'gender': 'total',
+                                                        'age_range': 'total'},
+                                          cumulative_columns=DailyCOVIDData.total_columns)
+
+    def add_previous_totals(self, previous_totals):
+        """
+            Carry forward the cumulative values of the dates before the processed ones, when the dataset was created
+            with the "since" parameter.
+            :param previous_totals: DataFrame with the gender, age range, Autonomous Region, and the total_* columns
+            of the last document stored for each series before the processed dates.
+        """
+        if previous_totals.empty:
+            return
+
+        total_columns = list(DailyCOVIDData.total_columns.values())
+        df = pd.merge(self.df, previous_totals, on=DailyCOVIDData.series_columns, how='left',
+                      suffixes=('', '_previous'))
+        for column in total_columns:
+            df[column] = df[column] + df[column + '_previous'].fillna(0).astype('int64')
+
+        self.df = df.drop(columns=[column + '_previous' for column in total_columns])
+        self.mongo_data = None
 
 
 class DiagnosticTestsDataset(CSVDataset):
@@ -92,7 +136,8 @@ class DiagnosticTestsDataset(CSVDataset):
         # Replace provinces with Autonomous Regions
         df = pd.merge(df, provinces_df, on='province')
         df = df.drop(columns=['province'])
-        df = df.groupby(['date', 'autonomous_region']).sum().reset_index()
+        df = calculate_grouping_sets(df, ['date', 'autonomous_region'],
+                                     list(df.select_dtypes('number').columns))
 
         # Calculate the total number of tests
         df['total_diagnostic_tests'] = df['antigens_total'] + df['pcr_total']
@@ -181,6 +226,11 @@ class DeathCausesDataset(CSVDataset):
 class CSVDatasetsTaskGroup(TaskGroup):
     """TaskGroup that downloads some CSV and JSON datasets and store them in the database"""
 
+    daily_data_chunk_size = 500000  # rows of the RENAVE CSV read at once
+    daily_data_revision_days = 30  # the RENAVE can still correct the data of the last days, so they are reprocessed
+    daily_data_full_reload_days = 7  # the RENAVE can also correct older data, so the whole dataset is reloaded weekly
+    load_state_collection = 'load_state'  # collection with the date of the last full reload of each collection
+
     def __init__(self, dag):
         # Instantiate the TaskGroup
         super(CSVDatasetsTaskGroup, self) \
@@ -230,54 +280,113 @@ class CSVDatasetsTaskGroup(TaskGroup):
     @staticmethod
     def download_daily_covid_data():
         """Download the RENAVE dataset with the daily cases, hospitalizations and deaths"""
-        download_csv_file('https://cnecovid.isciii.es/covid19/resources/casos_hosp_uci_def_sexo_edad_provres.csv',
-                          "daily_covid_data.csv")
+        return download_csv_file('https://cnecovid.isciii.es/covid19/resources/'
+                                 'casos_hosp_uci_def_sexo_edad_provres.csv', "daily_covid_data.csv")
 
     @staticmethod
     def download_population_and_provinces():
         """Download the datasets with the population on each Autonomous Region."""
-        download_csv_file('https://www.ine.es/jaxiT3/files/t/es/csv_bdsc/9683.csv', 'population_ar.csv', False)
+        return download_csv_file('https://www.ine.es/jaxiT3/files/t/es/csv_bdsc/9683.csv', 'population_ar.csv', False)
 
     @staticmethod
     def download_death_causes():
         """Download the dataset with the death causes in Spain in 2018"""
-        download_csv_file('https://www.ine.es/jaxiT3/files/t/es/csv_bdsc/6609.csv', 'death_causes.csv', False)
+        return download_csv_file('https://www.ine.es/jaxiT3/files/t/es/csv_bdsc/6609.csv', 'death_causes.csv', False)
 
     @staticmethod
     def download_diagnostic_tests_data():
         """Download the daily diagnostics tests data"""
         today = dt.today()
         filename = f'Datos_Pruebas_Realizadas_Historico_{today.strftime("%d%m%Y")}.csv'
-        download_csv_file('https://www.mscbs.gob.es/profesionales/saludPublica/ccayes/alertasActual/nCov/documentos/'
-                          + filename, 'diagnostic_tests.csv')
+        return download_csv_file('https://www.mscbs.gob.es/profesionales/saludPublica/ccayes/alertasActual/nCov/'
+                                 'documentos/' + filename, 'diagnostic_tests.csv')
 
     # endregion
 
     # region Data processing and storage
 
     @staticmethod
-    def process_and_store_cases_and_deaths():
-        dataset = DailyCOVIDData('csv_data/daily_covid_data.csv', '/home/airflow/provinces_daily_renave_data.csv')
+    def process_and_store_cases_and_deaths(dag_run=None, full_reload=False):
+        """
+            Process the RENAVE dataset and store it. If the database already contains data, only the last days (the
+            ones that can still be corrected) and the new ones are processed and upserted. The whole dataset is
+            reloaded when the last full reload is older than daily_data_full_reload_days.
+            :param dag_run: (optional) DAG run: a full reload can be forced with {"full_reload": true} in its
+            configuration.
+            :param full_reload: process the whole dataset and replace the stored collection.
+        """
+        full_reload = full_reload or bool(dag_run and (dag_run.conf or {}).get('full_reload'))
+        store = RawFileStore('csv_data')
+        if not full_reload and store.is_processed('daily_covid_data.csv'):
+            print("The RENAVE dataset hasn't changed since it was stored. Skipping it.")
+            return
+
         database = MongoDatabase(MongoDatabase.extracted_db_name)
-        dataset.store_dataset(database, 'daily_data')
+        state = database.db.get_collection(CSVDatasetsTaskGroup.load_state_collection).find_one(
+            {'collection': 'daily_data'})
+        if not state or dt.utcnow() - state['full_date'] >= td(days=CSVDatasetsTaskGroup.daily_data_full_reload_days):
+            full_reload = True
+        latest_date = None if full_reload else database.read_latest_date('daily_data')
+
+        if latest_date is None:
+            # Nothing stored yet, or a full reload: process the whole dataset
+            print("Reloading the whole RENAVE dataset")
+            dataset = DailyCOVIDData(store.path('daily_covid_data.csv'),
+                                     '/home/airflow/provinces_daily_renave_data.csv',
+                                     chunk_size=CSVDatasetsTaskGroup.daily_data_chunk_size)
+            dataset.store_dataset(database, 'daily_data')
+            database.upsert_data(CSVDatasetsTaskGroup.load_state_collection,
+                                 [{'collection': 'daily_data', 'full_date': dt.utcnow()}], ['collection'])
+        else:
+            since = latest_date - td(days=CSVDatasetsTaskGroup.daily_data_revision_days)
+            dataset = DailyCOVIDData(store.path('daily_covid_data.csv'),
+                                     '/home/airflow/provinces_daily_renave_data.csv',
+                                     chunk_size=CSVDatasetsTaskGroup.daily_data_chunk_size, since=since)
+
+            # The cumulative values of each series go on from the last ones stored before the processed days
+            previous_totals = database.read_last_values('daily_data', since, DailyCOVIDData.series_columns,
+                                                        list(DailyCOVIDData.total_columns.values()),
+                                                        series=dataset.df)
+            dataset.add_previous_totals(previous_totals)
+            dataset.store_dataset(database, 'daily_data', upsert_keys=DailyCOVIDData.index_columns)
+
+        store.mark_processed('daily_covid_data.csv')
 
     @staticmethod
     def process_and_store_ar_population():
-        dataset = ARPopulationCSVDataset("csv_data/population_ar.csv", separator=';', decimal=',', thousands='.')
+        store = RawFileStore('csv_data')
+        if store.is_processed('population_ar.csv'):
+            print("The population dataset hasn't changed since it was stored. Skipping it.")
+            return
+
+        dataset = ARPopulationCSVDataset(store.path('population_ar.csv'), separator=';', decimal=',', thousands='.')
         database = MongoDatabase(MongoDatabase.extracted_db_name)
         dataset.store_dataset(database, 'population_ar')
+        store.mark_processed('population_ar.csv')
 
     @staticmethod
     def process_and_store_death_causes():
-        dataset = DeathCausesDataset('csv_data/death_causes.csv')
+        store = RawFileStore('csv_data')
+        if store.is_processed('death_causes.csv'):
+            print("The death causes dataset hasn't changed since it was stored. Skipping it.")
+            return
+
+        dataset = DeathCausesDataset(store.path('death_causes.csv'))
         database = MongoDatabase(MongoDatabase.extracted_db_name)
         dataset.store_dataset(database, 'death_causes')
+        store.mark_processed('death_causes.csv')
 
     @staticmethod
     def process_and_store_diagnostic_tests_data():
-        dataset = DiagnosticTestsDataset('csv_data/diagnostic_tests.csv', '/home/airflow/'
-                                                                          'provinces_daily_diagnostic_data.csv')
+        store = RawFileStore('csv_data')
+        if store.is_processed('diagnostic_tests.csv'):
+            print("The diagnostic tests dataset hasn't changed since it was stored. Skipping it.")
+            return
+
+        dataset = DiagnosticTestsDataset(store.path('diagnostic_tests.csv'), '/home/airflow/'
+                                                                             'provinces_daily_diagnostic_data.csv')
         database = MongoDatabase(MongoDatabase.extracted_db_name)
         dataset.store_dataset(database, 'diagnostic_tests')
+        store.mark_processed('diagnostic_tests.csv')
 
     # endregion
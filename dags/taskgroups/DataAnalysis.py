@@ -1,14 +1,331 @@
 """
     Analyze the data stored in the database, after the download and extraction processes have finished.
 """
+import hashlib
+import os
+import re
 import pandas as pd
 import numpy as np
 from datetime import datetime as dt, timedelta as td
+import pyarrow as pa
+from pyarrow import feather
 
+# Optional compiler of the rolling windows kernel
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from airflow.models import Variable
 from airflow.operators.python import PythonOperator
 from airflow.utils.task_group import TaskGroup
 
-from AuxiliaryFunctions import MongoDatabase
+from AuxiliaryFunctions import MongoDatabase, RawFileStore
+
+
+class IncrementalAnalysis:
+    """
+        Storage of the results of an analysis of time series in a collection of the analyzed database, recomputing only
+        the last days when possible. The results of each day only depend on the input data of that day and of the
+        previous look-back days, so the analysis is run again over that tail and only the rows of the recomputed days
+        are upserted.
+        The whole history is recomputed instead when there are no previous results, when the version of the analysis or
+        of its inputs has changed, or when the last full recomputation is too old (the sources can still correct older
+        days). In the parity mode, both analyses are run and compared, and the full results are stored.
+    """
+
+    modes = ['incremental', 'full', 'parity']  # 'full' always recomputes the whole history
+    mode = 'incremental'  # default mode, if it isn't set in the DAG run configuration or the Variable (see set_mode)
+    mode_variable = 'analysis_mode'  # Airflow Variable, and key of the DAG run configuration, with the mode
+    revision_days = 30  # days before the latest analyzed date that are recomputed (see daily_data_revision_days)
+    full_recompute_days = 7  # days after which the whole history is recomputed again
+    parity_tolerance = 1e-9  # relative tolerance between the results, since rolling sums accumulate rounding errors
+    state_collection = 'analysis_state'  # collection with the version and last full recomputation of each analysis
+
+    def __init__(self, database, collection, keys, lookback_days, version):
+        """
+            :param database: MongoDatabase of the analyzed data
+            :param collection: collection in which the results are stored
+            :param keys: list of fields identifying each row of the results (for example, date and Autonomous Region)
+            :param lookback_days: number of days of input data before a day needed to calculate its results, or None
+            if they depend on the whole history (it's always loaded, but only the recomputed days are stored)
+            :param version: version of the analysis and of the inputs affecting the whole history (for example, the
+            population): when it changes, the whole history is recomputed
+        """
+        self.database = database
+        self.collection = collection
+        self.keys = keys
+        self.lookback_days = lookback_days
+        self.version = str(version)
+
+    @staticmethod
+    def set_mode(dag_run=None):
+        """
+            Set the mode of the analyses of a task from the configuration of the DAG run (for example,
+            {"analysis_mode": "parity"}) or, if it isn't set there, from the analysis_mode Airflow Variable.
+            :param dag_run: (optional) DAG run of the task
+        """
+        conf = (dag_run.conf if dag_run else None) or {}
+        mode = conf.get(IncrementalAnalysis.mode_variable) or \
+            Variable.get(IncrementalAnalysis.mode_variable, default_var=IncrementalAnalysis.mode)
+        if mode not in IncrementalAnalysis.modes:
+            raise ValueError("Unknown analysis mode %s: it must be one of %s" % (mode, IncrementalAnalysis.modes))
+
+        IncrementalAnalysis.mode = mode
+
+    def start(self):
+        """Return the first date to be recomputed, or None if the whole history must be recomputed"""
+        if IncrementalAnalysis.mode == 'full':
+            return None
+
+        state = self.database.db.get_collection(IncrementalAnalysis.state_collection) \
+            .find_one({'collection': self.collection})
+        latest_date = self.database.read_latest_date(self.collection)
+        if not state or not latest_date or state['version'] != self.version or \
+                dt.utcnow() - state['full_date'] >= td(days=IncrementalAnalysis.full_recompute_days):
+            return None
+
+        return latest_date - td(days=IncrementalAnalysis.revision_days)
+
+    @staticmethod
+    def inputs_version(analysis_version, inputs=()):
+        """
+            Return the version of an analysis and of some inputs affecting the whole history.
+            :param analysis_version: version of the analysis
+            :param inputs: files of the csv_data raw files store, whose processed content is part of the version
+        """
+        version = [str(analysis_version)]
+        if inputs:
+            store = RawFileStore('csv_data')
+            for name in inputs:
+                raw_file = store.get(name)
+                version.append(str(raw_file and raw_file.metadata.get('processed_sha256')))
+
+        return '.'.join(version)
+
+    def input_start(self, start):
+        """Return the first date of the input data needed to recompute the results from a date (None for all)"""
+        return start - td(days=self.lookback_days) if self.lookback_days is not None else None
+
+    def run(self, load, calculate, start):
+        """
+            Run the analysis and store its results.
+            :param load: function returning the input data from a date, or the whole history for None
+            :param calculate: function returning the results of the analysis of some input data, as a DataFrame with a
+            'date' column
+            :param start: first date to be recomputed (see start), or None to recompute the whole history
+        """
+        if start is None:
+            print("%s: recomputing the whole history" % self.collection)
+            self.__store_all__(calculate(load(None)))
+        elif IncrementalAnalysis.mode == 'parity':
+            print("%s: comparing the incremental analysis from %s with the whole history" % (self.collection, start))
+            results = calculate(load(None))
+            tail_results = calculate(load(self.input_start(start)))
+            differences = self.compare(tail_results[tail_results['date'] >= start], results[results['date'] >= start])
+            self.__store_all__(results)
+            if differences:
+                # The full results are stored anyway, but the task fails
+                raise ValueError("%s: the incremental analysis differs from the whole history one in %s" %
+                                 (self.collection, differences))
+        else:
+            print("%s: recomputing the results from %s" % (self.collection, start))
+            results = calculate(load(self.input_start(start)))
+            self.database.upsert_data(self.collection, results[results['date'] >= start], self.keys)
+
+    def compare(self, results, reference_results):
+        """
+            Compare the results of the incremental analysis with the ones of the whole history, printing the
+            differences.
+            :return: dict with the number of different values of each column (or with the number of rows, if the rows
+            are not the same), empty if they are equal
+        """
+        results = results.sort_values(self.keys).reset_index(drop=True)
+        reference_results = reference_results.sort_values(self.keys).reset_index(drop=True)
+        if not results[self.keys].equals(reference_results[self.keys]):
+            print("%s: the incremental analysis returned %i rows instead of %i" %
+                  (self.collection, len(results), len(reference_results)))
+            return {'rows': '%i instead of %i' % (len(results), len(reference_results))}
+
+        different_values = {}
+        for column in reference_results.columns:
+            values = results[column].infer_objects()
+            reference_values = reference_results[column].infer_objects()
+            if pd.api.types.is_numeric_dtype(values) and pd.api.types.is_numeric_dtype(reference_values):
+                equal = np.isclose(values, reference_values, rtol=IncrementalAnalysis.parity_tolerance, atol=0,
+                                   equal_nan=True)
+            else:
+                equal = (values == reference_values) | (values.isna() & reference_values.isna())
+            if not equal.all():
+                different_values[column] = int((~equal).sum())
+
+        if different_values:
+            print("%s: the incremental analysis differs in %s" % (self.collection, different_values))
+        else:
+            print("%s: the incremental analysis is equal to the whole history one (%i rows)" %
+                  (self.collection, len(results)))
+
+        return different_values
+
+    def __store_all__(self, results):
+        """Replace all the results stored, and record the full recomputation (in UTC, as pymongo returns the dates)"""
+        self.database.store_data(self.collection, results)
+        self.database.upsert_data(IncrementalAnalysis.state_collection,
+                                  [{'collection': self.collection, 'version': self.version, 'full_date': dt.utcnow()}],
+                                  ['collection'])
+
+
+class RollingWindows:
+    """
+        Rolling sums and means over time windows of some time series, like df.groupby(series)[column].rolling(window),
+        but calculated for many windows at once. Each column is laid out as a dense array with one row per series and
+        one column per day (empty for the days without data), and the sum of every window is the difference between two
+        cumulative sums of that array, so all the windows of a column are calculated from the same cumulative sums. The
+        windows are calculated by a Numba-compiled kernel if Numba is installed.
+        If a series has several rows on the same day, or a date has a time, the windows are calculated with pandas.
+    """
+
+    use_numba = True  # calculate the windows with the Numba kernel, if Numba is installed
+
+    def __init__(self, df, series_columns):
+        """
+            :param df: DataFrame indexed by date, sorted by date inside each series
+            :param series_columns: columns identifying each time series (for example, the Autonomous Region)
+        """
+        self.df = df
+        self.series_columns = series_columns
+
+        # Series of each row, numbered as in df.groupby(series): the rows with an empty series column are left out
+        columns_codes, columns_labels = zip(*[pd.factorize(df[column], sort=True) for column in series_columns])
+        self.rows = np.flatnonzero(np.logical_and.reduce([column_codes >= 0 for column_codes in columns_codes]))
+        shape = [len(column_labels) for column_labels in columns_labels]
+        codes = np.ravel_multi_index([column_codes[self.rows] for column_codes in columns_codes], shape)
+        existing_series = np.zeros(int(np.prod(shape)), dtype=bool)
+        existing_series[codes] = True
+        self.series = (np.cumsum(existing_series) - 1)[codes]
+        self.number_of_series = int(existing_series.sum())
+
+        # Day of each row, from the first one
+        dates = df.index.to_numpy(dtype='datetime64[ns]')[self.rows]
+        days = dates.astype('datetime64[D]')
+        self.days = (days - days.min()).astype('int64') if len(self.rows) else np.zeros(0, dtype='int64')
+        self.number_of_days = int(self.days.max()) + 1 if len(self.rows) else 0
+
+        cells = self.series * self.number_of_days + self.days
+        self.dense = bool(np.all(days == dates) and (not len(cells) or np.bincount(cells).max() == 1))
+
+    def calculate(self, windows):
+        """
+            Calculate some rolling windows.
+            :param windows: dictionary with the name of each result and a tuple with its column, time window (for
+            example, '14D') and statistic ('sum' or 'mean')
+            :return: dictionary with the name of each result and its values, aligned with the rows of the DataFrame
+            (empty for the rows without any value in the window)
+        """
+        results = {}
+        columns = {}
+        for name, (column, window, statistic) in windows.items():
+            if statistic not in ('sum', 'mean'):
+                raise ValueError("Unknown statistic of the rolling window %s: %s" % (name, statistic))
+            columns.setdefault(column, []).append((name, window, statistic))
+
+        for column, column_windows in columns.items():
+            if self.dense:
+                values = self.__calculate_dense__(column, column_windows)
+            else:
+                values = self.__calculate_pandas__(column, column_windows)
+
+            for (name, _, _), window_values in zip(column_windows, values):
+                results[name] = np.full(len(self.df), np.nan)
+                results[name][self.rows] = window_values
+
+        return results
+
+    def __calculate_dense__(self, column, windows):
+        """Calculate the windows of a column from the cumulative sums of its dense array"""
+        values = self.df[column].to_numpy()[self.rows]
+        if not np.issubdtype(values.dtype, np.integer):
+            # Integer columns keep exact sums, so the windows without cases are exactly 0
+            values = pd.to_numeric(values, errors='coerce').astype('float64')
+        present = ~np.isnan(values) if values.dtype.kind == 'f' else np.ones(len(values), dtype=bool)
+
+        # Dense arrays (series × days), with a first column of zeros for the cumulative sums
+        cube = np.zeros((self.number_of_series, self.number_of_days + 1), dtype=values.dtype)
+        cube[self.series, self.days + 1] = np.where(present, values, 0)
+        counts = np.zeros((self.number_of_series, self.number_of_days + 1), dtype='int64')
+        counts[self.series, self.days + 1] = present
+
+        prefix_sums = np.cumsum(cube, axis=1)
+        prefix_counts = np.cumsum(counts, axis=1)
+        window_days = np.array([RollingWindows.__window_days__(window) for _, window, _ in windows], dtype='int64')
+        means = np.array([statistic == 'mean' for _, _, statistic in windows])
+
+        result = np.empty((len(windows), self.number_of_series, self.number_of_days))
+        if RollingWindows.use_numba and numba is not None:
+            RollingWindows.__compiled_kernel__()(prefix_sums, prefix_counts, window_days, means, result)
+        else:
+            RollingWindows.__windows_kernel__(prefix_sums, prefix_counts, window_days, means, result)
+
+        return result[:, self.series, self.days]
+
+    def __calculate_pandas__(self, column, windows):
+        """Calculate the windows of a column with pandas, one rolling window at a time"""
+        order = np.argsort(self.series, kind='stable')
+        values = np.empty((len(windows), len(self.rows)))
+        for i, (_, window, statistic) in enumerate(windows):
+            rolling = self.df[column].astype('float64').groupby(
+                [self.df[series_column] for series_column in self.series_columns], sort=True).rolling(window)
+            values[i][order] = getattr(rolling, statistic)().to_numpy()
+
+        return values
+
+    @staticmethod
+    def __window_days__(window):
+        """Return the number of days of a time window, such as '14D'"""
+        days = pd.Timedelta(window) / pd.Timedelta(days=1)
+        if days < 1 or days != int(days):
+            raise ValueError("The rolling windows must be a whole number of days: %s" % window)
+
+        return int(days)
+
+    @staticmethod
+    def __windows_kernel__(prefix_sums, prefix_counts, window_days, means, result):
+        """
+            Calculate the value of each window, series and day from the cumulative sums and number of values of each
+            series: the windows without values are empty.
+        """
+        days = np.arange(1, prefix_sums.shape[1])
+        for i in range(len(window_days)):
+            first_days = np.maximum(days - window_days[i], 0)
+            sums = (prefix_sums[:, days] - prefix_sums[:, first_days]).astype('float64')
+            counts = prefix_counts[:, days] - prefix_counts[:, first_days]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result[i] = np.where(counts > 0, sums / counts if means[i] else sums, np.nan)
+
+    @staticmethod
+    def __windows_loop__(prefix_sums, prefix_counts, window_days, means, result):
+        """The same as __windows_kernel__, as loops to be compiled by Numba"""
+        for i in range(len(window_days)):
+            for series in range(prefix_sums.shape[0]):
+                for day in range(1, prefix_sums.shape[1]):
+                    first_day = max(day - window_days[i], 0)
+                    count = prefix_counts[series, day] - prefix_counts[series, first_day]
+                    if count == 0:
+                        result[i, series, day - 1] = np.nan
+                    elif means[i]:
+                        result[i, series, day - 1] = (prefix_sums[series, day] - prefix_sums[series, first_day]) / count
+                    else:
+                        result[i, series, day - 1] = prefix_sums[series, day] - prefix_sums[series, first_day]
+
+    __compiled_loop__ = None
+
+    @staticmethod
+    def __compiled_kernel__():
+        """Return __windows_loop__ compiled by Numba (the first call compiles it)"""
+        if RollingWindows.__compiled_loop__ is None:
+            RollingWindows.__compiled_loop__ = numba.njit(cache=True)(RollingWindows.__windows_loop__)
+
+        return RollingWindows.__compiled_loop__
 
 
 class DailyCOVIDData:
@@ -17,6 +334,23 @@ class DailyCOVIDData:
         Autonomous Region and age range.
     """
 
+    # Snapshot of the data merged with the population, shared by the analysis tasks of each DAG run
+    snapshot_directory = 'analysis_snapshots'
+    snapshot_inputs = ['daily_covid_data.csv', 'population_ar.csv']  # files of the csv_data raw files store
+    snapshot_version = 4  # increase it when the merged data changes, so the snapshots are written again
+
+    series_columns = ['autonomous_region', 'gender', 'age_range']  # columns identifying each time series
+
+    # Incremental analysis (see IncrementalAnalysis)
+    analyzed_collections = ['cases', 'deaths', 'hospitalizations']
+    analysis_version = 1  # increase it when the results change, so the whole history is recomputed
+    # The monthly increase of the cases compares the 60 days moving average of a row with the one 30 rows before, over
+    # the rows of all the series one after the other, so the data needed before a date depends on the rows of each
+    # series (see __input_start__)
+    lookback_rows = 30
+    lookback_window_days = 60  # longest time window of the analyses
+    lookback_days = 91  # days loaded at first, which are enough if every series has a row every day
+
     @staticmethod
     def calculate_increase_percentage(data):
         """Return the percentage increase or decrease in the new cases, deaths, or hospitalizations"""
@@ -24,19 +358,268 @@ class DailyCOVIDData:
             return 0
         return 100 * ((data[-1] - data[0]) / data[0])
 
-    def __init__(self):
-        """Load the data from the database and store it into a Pandas DataFrame"""
+    @staticmethod
+    def __increase_percentage__(first, last):
+        """Vectorized calculate_increase_percentage, from the first and last values of each window"""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(first == 0, 0, 100 * ((last - first) / first))
+
+    @staticmethod
+    def increase_percentage_by_time(df, columns, window):
+        """
+            Calculate the increase percentage of some columns over a time window, for each series of the DataFrame.
+            The result is the same as df.groupby(series)[columns].rolling(window).apply(calculate_increase_percentage,
+            raw=True), but instead of calling a Python function for each window, the position of the first row of every
+            window is found at once with a binary search over the rows sorted by series and date.
+            :param df: DataFrame indexed by date, sorted by date inside each series.
+            :param columns: column or list of columns.
+            :param window: time window, e.g. '8D'.
+            :return: Series (or DataFrame, if columns is a list) indexed by the series columns and the date.
+        """
+        order, codes, index = DailyCOVIDData.__series_order__(df)
+        dates = df.index.values[order].astype('datetime64[ns]')
+
+        # The rows of each series are identified by the series code and the position of their date among all the
+        # dates, so the first row inside the window (the first one with a date after the window start) is a search
+        unique_dates = np.unique(dates)
+        width = len(unique_dates) + 1
+        row_keys = codes * width + np.searchsorted(unique_dates, dates)
+        window_start_keys = codes * width + np.searchsorted(unique_dates, dates - pd.Timedelta(window).to_timedelta64(),
+                                                            side='right')
+        first_rows = np.searchsorted(row_keys, window_start_keys)
+
+        result = pd.DataFrame(index=index)
+        for column in ([columns] if isinstance(columns, str) else columns):
+            values = df[column].to_numpy(dtype='float64')[order]
+            result[column] = DailyCOVIDData.__increase_percentage__(values[first_rows], values)
+
+        return result[columns]
+
+    @staticmethod
+    def increase_percentage_by_rows(series, rows):
+        """
+            Calculate the increase percentage over a window of rows, like series.rolling(rows).apply(
+            calculate_increase_percentage, raw=True): the windows span the whole Series, and the ones with any empty
+            value are empty.
+        """
+        values = series.to_numpy(dtype='float64')
+        result = np.full(len(values), np.nan)
+        if len(values) >= rows:
+            empty_values = np.concatenate([[0], np.cumsum(np.isnan(values))])
+            complete_windows = (empty_values[rows:] - empty_values[:-rows]) == 0
+            increase = DailyCOVIDData.__increase_percentage__(values[:len(values) - rows + 1], values[rows - 1:])
+            result[rows - 1:] = np.where(complete_windows, increase, np.nan)
+
+        return pd.Series(result, index=series.index, name=series.name)
+
+    @staticmethod
+    def __series_order__(df):
+        """
+            Sort the rows of a DataFrame indexed by date by series, as in df.groupby(series): the series are sorted, and
+            the rows with an empty series column are left out.
+            :return: tuple with the positions of the sorted rows, the code of their series (sorted too), and their
+            index with the series columns and the date.
+        """
+        columns_codes, columns_labels = zip(*[pd.factorize(df[column], sort=True)
+                                              for column in DailyCOVIDData.series_columns])
+        valid_rows = np.flatnonzero(np.logical_and.reduce([column_codes >= 0 for column_codes in columns_codes]))
+        codes = np.ravel_multi_index([column_codes[valid_rows] for column_codes in columns_codes],
+                                     [len(column_labels) for column_labels in columns_labels])
+        sorted_rows = np.argsort(codes, kind='stable')
+        order = valid_rows[sorted_rows]
+
+        date_codes, dates = pd.factorize(df.index[order])
+        index = pd.MultiIndex(levels=list(columns_labels) + [dates],
+                              codes=[column_codes[order] for column_codes in columns_codes] + [date_codes],
+                              names=DailyCOVIDData.series_columns + ['date'], verify_integrity=False)
+
+        return order, codes[sorted_rows], index
+
+    def __init__(self, snapshot=None, analysis_start=None):
+        """
+            Load the data from the database and store it into a Pandas DataFrame.
+            :param snapshot: (optional) path of a snapshot of the data already merged with the population (see
+            write_snapshot), which is read instead of the database.
+            :param analysis_start: (optional) first date whose results will be recomputed (see IncrementalAnalysis). In
+            the incremental mode, only the data needed to recompute them is loaded.
+        """
         # Connection to the extracted data database for reading, and to the analyzed data for writing
         self.db_read = MongoDatabase(MongoDatabase.extracted_db_name)
         self.db_write = MongoDatabase(MongoDatabase.analyzed_db_name)
 
-        # Load the data from the DB
-        self.df = self.db_read.read_data('daily_data')
+        if snapshot:
+            self.df, self.analysis_start, self.input_start, self.analysis_version = \
+                DailyCOVIDData.__read_snapshot__(snapshot)
+            return
+
+        self.analysis_start = analysis_start
+        self.analysis_version = DailyCOVIDData.__inputs_version__()
+
+        if analysis_start is None or IncrementalAnalysis.mode != 'incremental':
+            # Load the whole history from the DB
+            self.__load__(None)
+            self.input_start = None if analysis_start is None else \
+                DailyCOVIDData.__input_start__(self.df, analysis_start, True)
+            return
+
+        # Load only the last days, and more of them while the rows of some series are not enough
+        load_start = analysis_start - td(days=DailyCOVIDData.lookback_days)
+        while True:
+            complete = self.db_read.db.get_collection('daily_data').find_one({'date': {'$lt': load_start}}) is None
+            self.__load__(None if complete else load_start)
+            self.input_start = DailyCOVIDData.__input_start__(self.df, analysis_start, complete)
+            if self.input_start is not None and (complete or self.input_start >= load_start):
+                break
+
+            load_start = min(self.input_start or load_start, analysis_start - 2 * (analysis_start - load_start))
+
+        self.df = self.df[self.df.index >= self.input_start]
+
+    def __load__(self, start):
+        """
+            Load the data from the DB, merged with the population.
+            :param start: first date to load, or None for the whole history.
+        """
+        filters = {'date': {'$gte': start}} if start is not None else None
+        self.df = self.db_read.read_data('daily_data', filters, columnar=True)
         self.population_df = self.db_read.read_data('population_ar')
 
         # Aggregate the data
         self.__merge__population__()
 
+    @staticmethod
+    def __input_start__(df, analysis_start, complete):
+        """
+            Return the first date of the data needed to recompute the results from a date: the rows of the windows of
+            lookback_rows rows ending in each recomputed row, and the lookback_window_days days before each of them.
+            :param df: data merged with the population, sorted by series and date
+            :param analysis_start: first date to be recomputed
+            :param complete: whether df has the whole history. If not, the series may have older rows, so a window of
+            rows can't go back beyond the first row of its series in df.
+            :return: the first date needed, or None if df doesn't have enough rows.
+        """
+        dates = df.index.values
+        series = df[DailyCOVIDData.series_columns].to_numpy()
+        series_starts = np.flatnonzero(np.concatenate([[True], (series[1:] != series[:-1]).any(axis=1)]))
+        series_ends = np.append(series_starts[1:], len(df))
+
+        # First recomputed row of each series (the rows of each series are sorted by date)
+        first_rows = series_starts + np.array([np.searchsorted(dates[start:end], np.datetime64(analysis_start))
+                                              for start, end in zip(series_starts, series_ends)], dtype='int64')
+        recomputed = first_rows < series_ends
+        window_starts = first_rows[recomputed] - DailyCOVIDData.lookback_rows
+        if not recomputed.any():
+            return analysis_start
+        elif not complete and (window_starts < series_starts[recomputed]).any():
+            return None
+
+        # Rows needed: the windows before the first recomputed row of each series, and the recomputed rows
+        needed = np.zeros(len(df) + 1, dtype='int64')
+        np.add.at(needed, np.maximum(window_starts, 0), 1)
+        np.add.at(needed, first_rows[recomputed], -1)
+        needed = (np.cumsum(needed[:-1]) > 0) | (dates >= np.datetime64(analysis_start))
+
+        first_date = pd.Timestamp(dates[needed].min()) - td(days=DailyCOVIDData.lookback_window_days)
+        return min(first_date, pd.Timestamp(analysis_start)).to_pydatetime()
+
+    @staticmethod
+    def __inputs_version__():
+        """Return the version of the analysis and of the population, which affects the results of the whole history"""
+        return IncrementalAnalysis.inputs_version(DailyCOVIDData.analysis_version, ['population_ar.csv'])
+
+    @staticmethod
+    def __incremental_analysis__(database, collection, version, lookback_days=None):
+        """
+            Return the incremental analysis storing the results in a collection.
+            :param lookback_days: (optional) days of data needed before the first recomputed date (see __input_start__)
+        """
+        return IncrementalAnalysis(database, collection, ['date'] + DailyCOVIDData.series_columns, lookback_days,
+                                   version)
+
+    @staticmethod
+    def snapshot_path(run_id):
+        """
+            Return the path of the snapshot of the merged data for a DAG run. It also depends on the version of the
+            input datasets (the content of the CSV files last stored in the database) and of the snapshot.
+        """
+        store = RawFileStore('csv_data')
+        input_version = hashlib.sha256(str(DailyCOVIDData.snapshot_version).encode())
+        for name in DailyCOVIDData.snapshot_inputs:
+            raw_file = store.get(name)
+            input_version.update(str(raw_file and raw_file.metadata.get('processed_sha256')).encode())
+
+        return '%s/daily_data.%s.%s.feather' % (DailyCOVIDData.snapshot_directory, re.sub(r'[^\w.-]', '_', run_id),
+                                                input_version.hexdigest()[:16])
+
+    @staticmethod
+    def write_snapshot(run_id):
+        """
+            Write the data merged with the population as a snapshot for a DAG run, unless it already exists, removing
+            the snapshots of the previous runs. The first date to be recomputed by the analysis tasks is decided here,
+            so all of them use the same one, and only the data needed to recompute it is written.
+            :return: path of the snapshot.
+        """
+        path = DailyCOVIDData.snapshot_path(run_id)
+        if os.path.exists(path):
+            return path
+
+        database = MongoDatabase(MongoDatabase.analyzed_db_name)
+        version = DailyCOVIDData.__inputs_version__()
+        starts = [DailyCOVIDData.__incremental_analysis__(database, collection, version).start()
+                  for collection in DailyCOVIDData.analyzed_collections]
+        data = DailyCOVIDData(analysis_start=None if None in starts else min(starts))
+        os.makedirs(DailyCOVIDData.snapshot_directory, exist_ok=True)
+
+        # Uncompressed, so the snapshot can be memory-mapped. It's written in a temporary file and then renamed, so it
+        # can't be read while it's incomplete.
+        DailyCOVIDData.write_snapshot_file(data.df, path + '.part', data.analysis_start, data.input_start,
+                                           data.analysis_version)
+        os.replace(path + '.part', path)
+        print("Snapshot of the daily data written in %s (%i rows)" % (path, len(data.df)))
+
+        for file in os.listdir(DailyCOVIDData.snapshot_directory):
+            if file.startswith('daily_data.') and file != os.path.basename(path):
+                os.remove(DailyCOVIDData.snapshot_directory + '/' + file)
+
+        return path
+
+    @staticmethod
+    def write_snapshot_file(df, path, analysis_start, input_start, analysis_version):
+        """
+            Write the merged data into a snapshot file, with the first date to be recomputed, the first date of the data
+            needed to recompute it and the analysis version
+        """
+        table = pa.Table.from_pandas(df.reset_index(), preserve_index=False)
+        table = table.replace_schema_metadata({
+            **table.schema.metadata,
+            b'analysis_start': analysis_start.isoformat().encode() if analysis_start is not None else b'',
+            b'input_start': input_start.isoformat().encode() if input_start is not None else b'',
+            b'analysis_version': analysis_version.encode()})
+        feather.write_feather(table, path, compression='uncompressed')
+
+    @staticmethod
+    def from_snapshot(run_id):
+        """Load the data from the snapshot of a DAG run, writing it first if it doesn't exist yet"""
+        return DailyCOVIDData(DailyCOVIDData.write_snapshot(run_id))
+
+    @staticmethod
+    def __read_snapshot__(path):
+        """
+            Read a snapshot memory-mapped: the numeric columns without empty values use the mapped memory, without
+            being copied.
+            :return: the merged data, the first date to be recomputed (None for the whole history), the first date of
+            the data needed to recompute it, and the analysis version.
+        """
+        table = feather.read_table(path, memory_map=True)
+        metadata = table.schema.metadata or {}
+        analysis_start = metadata.get(b'analysis_start')
+        input_start = metadata.get(b'input_start')
+
+        return table.to_pandas(split_blocks=True).set_index('date'), \
+            dt.fromisoformat(analysis_start.decode()) if analysis_start else None, \
+            dt.fromisoformat(input_start.decode()) if input_start else None, \
+            metadata.get(b'analysis_version', b'').decode()
+
     def __merge__population__(self):
         """Merge the COVID daily data dataset with the population dataset"""
 
@@ -58,109 +641,118 @@ class DailyCOVIDData:
         covid_population_df = pd.merge(self.df, self.population_df, on=['autonomous_region', 'age_range', 'gender']) \
             .rename(columns={'value': 'population'})
         covid_population_df['date'] = pd.to_datetime(covid_population_df['date'])
-        self.df = covid_population_df.set_index('date')
+
+        # Sort the rows by series and date, as they are returned by the rolling windows of each series
+        self.df = covid_population_df.dropna(subset=DailyCOVIDData.series_columns) \
+            .sort_values(DailyCOVIDData.series_columns + ['date']).set_index('date')
+
+    @staticmethod
+    def __output_dataframe__(df, columns):
+        """Return a DataFrame with the date and some columns, to be stored in the database"""
+        return pd.DataFrame({'date': df.index.to_numpy(), **{column: df[column].to_numpy() for column in columns}})
+
+    def __analyze_and_store__(self, collection, calculate):
+        """
+            Run an analysis over the loaded data and store its results, recomputing the whole history or only the days
+            from the first date to be recomputed (see IncrementalAnalysis).
+        """
+        def load(start):
+            return self.df if start is None else self.df[self.df.index >= start]
+
+        lookback_days = (self.analysis_start - self.input_start).days if self.analysis_start is not None else None
+        DailyCOVIDData.__incremental_analysis__(self.db_write, collection, self.analysis_version, lookback_days) \
+            .run(load, calculate, self.analysis_start)
 
     def process_and_store_cases(self):
+        """Analyze the data related to the cases and store the results"""
+        self.__analyze_and_store__('cases', DailyCOVIDData.__calculate_cases__)
+
+    @staticmethod
+    def __calculate_cases__(df):
         """Create a DataFrame with all the data related to the cases"""
-        # Get only the cases from the dataset
-        cases_df = self.df.copy()[
-            ['gender', 'age_range', 'autonomous_region', 'new_cases', 'total_cases', 'population']]
+        # The new columns are added to a shallow copy of the dataset, without copying the existing ones
+        cases_df = df.copy(deep=False)
 
         # Calculate the cases per population
         cases_df['new_cases_per_population'] = 100000 * cases_df['new_cases'] / cases_df['population']
         cases_df['total_cases_per_population'] = 100000 * cases_df['total_cases'] / cases_df['population']
 
+        # Rolling windows of each series
+        windows = RollingWindows(cases_df, DailyCOVIDData.series_columns).calculate({
+            'ci_last_14_days': ('new_cases_per_population', '14D', 'sum'),
+            'new_cases_ma_7d': ('new_cases', '7D', 'mean'),
+            'new_cases_ma_14d': ('new_cases', '14D', 'mean'),
+            'new_cases_ma_60d': ('new_cases', '60D', 'mean'),
+            'new_cases_ma_1w': ('new_cases_per_population', '8D', 'mean'),
+            'new_cases_ma_2w': ('new_cases_per_population', '15D', 'mean')})
+
         # CI last 14 days
-        cases_ci = cases_df.groupby(['autonomous_region', 'gender', 'age_range'])['new_cases_per_population'].rolling(
-            '14D', min_periods=1).sum()
-        cases_df = pd.merge(cases_df, cases_ci, on=['autonomous_region', 'date', 'gender', 'age_range']).rename(
-            columns={'new_cases_per_population_x': 'new_cases_per_population',
-                     'new_cases_per_population_y': 'ci_last_14_days'})
-        cases_df['inverted_ci'] = cases_df['ci_last_14_days'].apply(lambda x: 100000 / x if x > 10 else 10000)
+        cases_df['ci_last_14_days'] = windows['ci_last_14_days']
+        cases_df['inverted_ci'] = (100000 / cases_df['ci_last_14_days']).where(cases_df['ci_last_14_days'] > 10, 10000)
 
         # Daily, weekly and monthly increase
-        increase_cases_df_1d = cases_df.groupby(['autonomous_region', 'gender', 'age_range'])['new_cases'].rolling(
-            '7D').mean().rolling(2).apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-        increase_cases_df_7d = cases_df.groupby(['autonomous_region', 'gender', 'age_range'])['new_cases'].rolling(
-            '14D').mean().rolling(8).apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-        increase_cases_df_30d = cases_df.groupby(['autonomous_region', 'gender', 'age_range'])['new_cases'].rolling(
-            '60D').mean().rolling(31).apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-
-        increase_cases_percentages = pd.DataFrame(
-            {'daily_increase': increase_cases_df_1d, 'weekly_increase': increase_cases_df_7d,
-             'monthly_increase': increase_cases_df_30d})
-        cases_df = pd.merge(cases_df, increase_cases_percentages,
-                            on=['autonomous_region', 'date', 'age_range', 'gender'])
+        for column, moving_average, rows in [('daily_increase', 'new_cases_ma_7d', 2),
+                                             ('weekly_increase', 'new_cases_ma_14d', 8),
+                                             ('monthly_increase', 'new_cases_ma_60d', 31)]:
+            cases_df[column] = DailyCOVIDData.increase_percentage_by_rows(pd.Series(windows[moving_average]),
+                                                                          rows).to_numpy()
 
         # New cases moving average
-        new_cases_ma_1w = cases_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            'new_cases_per_population'].rolling('8D').mean()
-        new_cases_ma_2w = cases_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            'new_cases_per_population'].rolling('15D').mean()
-        new_cases_ma = pd.DataFrame({'new_cases_ma_1w': new_cases_ma_1w, 'new_cases_ma_2w': new_cases_ma_2w})
-        cases_df = pd.merge(cases_df, new_cases_ma, on=['autonomous_region', 'date', 'age_range', 'gender'])
-
-        cases_df = cases_df.drop(columns=['population'])
+        cases_df['new_cases_ma_1w'] = windows['new_cases_ma_1w']
+        cases_df['new_cases_ma_2w'] = windows['new_cases_ma_2w']
 
-        # Store the data
-        self.db_write.store_data('cases', cases_df.reset_index().to_dict('records'))
+        return DailyCOVIDData.__output_dataframe__(cases_df, [
+            'gender', 'age_range', 'autonomous_region', 'new_cases', 'total_cases', 'new_cases_per_population',
+            'total_cases_per_population', 'ci_last_14_days', 'inverted_ci', 'daily_increase', 'weekly_increase',
+            'monthly_increase', 'new_cases_ma_1w', 'new_cases_ma_2w'])
 
     def process_and_store_deaths(self):
+        """Analyze the data related to the deaths and store the results"""
+        self.__analyze_and_store__('deaths', DailyCOVIDData.__calculate_deaths__)
+
+    @staticmethod
+    def __calculate_deaths__(df):
         """Create a DataFrame with all the data related to the deaths"""
-        # Get only the deaths from the dataset
-        deaths_df = self.df.copy()[['gender', 'age_range', 'autonomous_region', 'new_deaths', 'total_deaths',
-                                    'new_cases', 'total_cases', 'population']]
+        # The new columns are added to a shallow copy of the dataset, without copying the existing ones
+        deaths_df = df.copy(deep=False)
 
         # Calculate the deaths per population
         deaths_df['new_deaths_per_population'] = 100000 * deaths_df['new_deaths'] / deaths_df['population']
         deaths_df['total_deaths_per_population'] = 100000 * deaths_df['total_deaths'] / deaths_df['population']
 
         # Daily, weekly and monthly increase
-        increase_deaths_df_1d = deaths_df.groupby(['autonomous_region', 'gender', 'age_range'])['new_deaths'].rolling(
-            '2D').apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-        increase_deaths_df_7d = deaths_df.groupby(['autonomous_region', 'gender', 'age_range'])['new_deaths'].rolling(
-            '8D').apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-        increase_deaths_df_14d = deaths_df.groupby(['autonomous_region', 'gender', 'age_range'])['new_deaths'].rolling(
-            '15D').apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-        increase_deaths_df_30d = deaths_df.groupby(['autonomous_region', 'gender', 'age_range'])['new_deaths'].rolling(
-            '31D').apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-
-        increase_deaths_percentages = pd.DataFrame(
-            {'daily_increase': increase_deaths_df_1d, 'weekly_increase': increase_deaths_df_7d,
-             'two_weeks_increase': increase_deaths_df_14d, 'monthly_increase': increase_deaths_df_30d})
-        deaths_df = pd.merge(deaths_df, increase_deaths_percentages,
-                             on=['autonomous_region', 'date', 'age_range', 'gender'])
-
-        # New deaths moving average
-        new_deaths_ma_1w = deaths_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            'new_deaths_per_population'].rolling('8D').mean()
-        new_deaths_ma_2w = deaths_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            'new_deaths_per_population'].rolling('15D').mean()
-        new_deaths_ma = pd.DataFrame({'new_deaths_ma_1w': new_deaths_ma_1w, 'new_deaths_ma_2w': new_deaths_ma_2w})
-        deaths_df = pd.merge(deaths_df, new_deaths_ma, on=['autonomous_region', 'date', 'age_range', 'gender'])
+        for column, window in [('daily_increase', '2D'), ('weekly_increase', '8D'), ('two_weeks_increase', '15D'),
+                               ('monthly_increase', '31D')]:
+            deaths_df[column] = DailyCOVIDData.increase_percentage_by_time(deaths_df, 'new_deaths', window).to_numpy()
 
-        # Mortality percentage
+        # New deaths and cases moving average
         deaths_df['new_cases_per_population'] = 100000 * deaths_df['new_cases'] / deaths_df['population']
-        new_cases_ma_2w = deaths_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            'new_cases_per_population'].rolling('15D').mean()
-        new_cases_ma_2w_df = pd.DataFrame({'new_cases_ma_2w': new_cases_ma_2w})
-        deaths_df = pd.merge(deaths_df, new_cases_ma_2w_df, on=['autonomous_region', 'date', 'age_range', 'gender'])
-        deaths_df['mortality_2w'] = 100 * (deaths_df['new_deaths_ma_2w'] / deaths_df['new_cases_ma_2w']). \
-            replace(np.nan, 0)
-        deaths_df['mortality_total'] = 100 * (deaths_df['total_deaths'] / deaths_df['total_cases']).replace(np.nan, 0)
+        windows = RollingWindows(deaths_df, DailyCOVIDData.series_columns).calculate({
+            'new_deaths_ma_1w': ('new_deaths_per_population', '8D', 'mean'),
+            'new_deaths_ma_2w': ('new_deaths_per_population', '15D', 'mean'),
+            'new_cases_ma_2w': ('new_cases_per_population', '15D', 'mean')})
+        deaths_df['new_deaths_ma_1w'] = windows['new_deaths_ma_1w']
+        deaths_df['new_deaths_ma_2w'] = windows['new_deaths_ma_2w']
+        new_cases_ma_2w = windows['new_cases_ma_2w']
 
-        deaths_df = deaths_df.drop(
-            columns=['new_cases_ma_2w', 'new_cases_per_population', 'new_cases', 'total_cases', 'population'])
+        # Mortality percentage
+        deaths_df['mortality_2w'] = 100 * (deaths_df['new_deaths_ma_2w'] / new_cases_ma_2w).replace(np.nan, 0)
+        deaths_df['mortality_total'] = 100 * (deaths_df['total_deaths'] / deaths_df['total_cases']).replace(np.nan, 0)
 
-        # Store the data
-        self.db_write.store_data('deaths', deaths_df.reset_index().to_dict('records'))
+        return DailyCOVIDData.__output_dataframe__(deaths_df, [
+            'gender', 'age_range', 'autonomous_region', 'new_deaths', 'total_deaths', 'new_deaths_per_population',
+            'total_deaths_per_population', 'daily_increase', 'weekly_increase', 'two_weeks_increase',
+            'monthly_increase', 'new_deaths_ma_1w', 'new_deaths_ma_2w', 'mortality_2w', 'mortality_total'])
 
     def process_and_store_hospitalizations(self):
+        """Analyze the data related to the hospitalizations and store the results"""
+        self.__analyze_and_store__('hospitalizations', DailyCOVIDData.__calculate_hospitalizations__)
+
+    @staticmethod
+    def __calculate_hospitalizations__(df):
         """Create a DataFrame with all the data related to the hospitalizations"""
-        # Get only the hospitalizations from the dataset
-        hospitalizations_df = self.df.copy()[
-            ['gender', 'age_range', 'autonomous_region', 'new_hospitalizations', 'total_hospitalizations',
-             'new_ic_hospitalizations', 'total_ic_hospitalizations', 'new_cases', 'total_cases', 'population']]
+        # The new columns are added to a shallow copy of the dataset, without copying the existing ones
+        hospitalizations_df = df.copy(deep=False)
 
         # Calculate the hospitalizations per population
         hospitalizations_df['new_hospitalizations_per_population'] = 100000 * hospitalizations_df[
@@ -173,69 +765,47 @@ class DailyCOVIDData:
             'total_ic_hospitalizations'] / hospitalizations_df['population']
 
         # Daily, weekly and monthly increase
-        increase_hospitalizations_df_1d = hospitalizations_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            ['new_hospitalizations', 'new_ic_hospitalizations']].rolling('2D'). \
-            apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-        increase_hospitalizations_df_7d = hospitalizations_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            ['new_hospitalizations', 'new_ic_hospitalizations']].rolling('8D'). \
-            apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-        increase_hospitalizations_df_14d = hospitalizations_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            ['new_hospitalizations', 'new_ic_hospitalizations']].rolling('15D'). \
-            apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-        increase_hospitalizations_df_30d = hospitalizations_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            ['new_hospitalizations', 'new_ic_hospitalizations']].rolling('31D'). \
-            apply(DailyCOVIDData.calculate_increase_percentage, raw=True)
-
-        increase_hospitalizations_percentages = pd.DataFrame(
-            {'hospitalizations_daily_increase': increase_hospitalizations_df_1d['new_hospitalizations'],
-             'hospitalizations_weekly_increase': increase_hospitalizations_df_7d['new_hospitalizations'],
-             'hospitalizations_two_weeks_increase': increase_hospitalizations_df_14d['new_hospitalizations'],
-             'hospitalizations_monthly_increase': increase_hospitalizations_df_30d['new_hospitalizations'],
-             'ic_daily_increase': increase_hospitalizations_df_1d['new_ic_hospitalizations'],
-             'ic_weekly_increase': increase_hospitalizations_df_7d['new_ic_hospitalizations'],
-             'ic_two_weeks_increase': increase_hospitalizations_df_14d['new_ic_hospitalizations'],
-             'ic_monthly_increase': increase_hospitalizations_df_30d['new_ic_hospitalizations']})
-        hospitalizations_df = pd.merge(hospitalizations_df, increase_hospitalizations_percentages,
-                                       on=['autonomous_region', 'date', 'age_range', 'gender'])
-
-        # New hospitalizations moving average
-        new_hospitalizations_ma_1w = hospitalizations_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            ['new_hospitalizations_per_population', 'new_ic_hospitalizations_per_population']].rolling('8D').mean()
-        new_hospitalizations_ma_2w = hospitalizations_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            ['new_hospitalizations_per_population', 'new_ic_hospitalizations_per_population']].rolling('15D').mean()
-        new_hospitalizations_ma = pd.DataFrame(
-            {'new_hospitalizations_ma_1w': new_hospitalizations_ma_1w['new_hospitalizations_per_population'],
-             'new_hospitalizations_ma_2w': new_hospitalizations_ma_2w['new_hospitalizations_per_population'],
-             'new_ic_ma_1w': new_hospitalizations_ma_1w['new_ic_hospitalizations_per_population'],
-             'new_ic_ma_2w': new_hospitalizations_ma_2w['new_ic_hospitalizations_per_population']})
-        hospitalizations_df = pd.merge(hospitalizations_df, new_hospitalizations_ma,
-                                       on=['autonomous_region', 'date', 'age_range', 'gender'])
+        for period, window in [('daily', '2D'), ('weekly', '8D'), ('two_weeks', '15D'), ('monthly', '31D')]:
+            increase = DailyCOVIDData.increase_percentage_by_time(
+                hospitalizations_df, ['new_hospitalizations', 'new_ic_hospitalizations'], window)
+            hospitalizations_df['hospitalizations_%s_increase' % period] = increase['new_hospitalizations'].to_numpy()
+            hospitalizations_df['ic_%s_increase' % period] = increase['new_ic_hospitalizations'].to_numpy()
 
-        # Hospitalization percentage
+        # New hospitalizations and cases moving average
         hospitalizations_df['new_cases_per_population'] = \
             100000 * hospitalizations_df['new_cases'] / hospitalizations_df['population']
-        new_cases_ma_2w = hospitalizations_df.groupby(['autonomous_region', 'gender', 'age_range'])[
-            'new_cases_per_population'].rolling('15D').mean()
-        new_cases_ma_2w_df = pd.DataFrame({'new_cases_ma_2w': new_cases_ma_2w})
-        hospitalizations_df = pd.merge(hospitalizations_df, new_cases_ma_2w_df,
-                                       on=['autonomous_region', 'date', 'age_range', 'gender'])
+        windows = RollingWindows(hospitalizations_df, DailyCOVIDData.series_columns).calculate({
+            **{'new_hospitalizations_ma_' + period: ('new_hospitalizations_per_population', window, 'mean')
+               for period, window in [('1w', '8D'), ('2w', '15D')]},
+            **{'new_ic_ma_' + period: ('new_ic_hospitalizations_per_population', window, 'mean')
+               for period, window in [('1w', '8D'), ('2w', '15D')]},
+            'new_cases_ma_2w': ('new_cases_per_population', '15D', 'mean')})
+        for column in ['new_hospitalizations_ma_1w', 'new_hospitalizations_ma_2w', 'new_ic_ma_1w', 'new_ic_ma_2w']:
+            hospitalizations_df[column] = windows[column]
+        new_cases_ma_2w = windows['new_cases_ma_2w']
+
+        # Hospitalization percentage
         hospitalizations_df['hospitalization_ratio_2w'] = 100 * (
-                hospitalizations_df['new_hospitalizations_ma_2w'] / hospitalizations_df['new_cases_ma_2w']).replace(
-            np.nan, 0)
+                hospitalizations_df['new_hospitalizations_ma_2w'] / new_cases_ma_2w).replace(np.nan, 0)
         hospitalizations_df['hospitalization_ratio_total'] = 100 * (
                 hospitalizations_df['total_hospitalizations'] / hospitalizations_df['total_cases']).replace(np.nan,
                                                                                                             0)
         hospitalizations_df['hospitalization_ic_ratio_2w'] = 100 * (
-                hospitalizations_df['new_ic_ma_2w'] / hospitalizations_df['new_cases_ma_2w']).replace(np.nan, 0)
+                hospitalizations_df['new_ic_ma_2w'] / new_cases_ma_2w).replace(np.nan, 0)
         hospitalizations_df['hospitalization_ic_ratio_total'] = 100 * (
                 hospitalizations_df['total_ic_hospitalizations'] / hospitalizations_df['total_cases']).replace(
             np.nan, 0)
 
-        hospitalizations_df = hospitalizations_df.drop(
-            columns=['new_cases_ma_2w', 'new_cases_per_population', 'new_cases', 'total_cases', 'population'])
-
-        # Store the data
-        self.db_write.store_data('hospitalizations', hospitalizations_df.reset_index().to_dict('records'))
+        return DailyCOVIDData.__output_dataframe__(hospitalizations_df, [
+            'gender', 'age_range', 'autonomous_region', 'new_hospitalizations', 'total_hospitalizations',
+            'new_ic_hospitalizations', 'total_ic_hospitalizations', 'new_hospitalizations_per_population',
+            'total_hospitalizations_per_population', 'new_ic_hospitalizations_per_population',
+            'total_ic_hospitalizations_per_population', 'hospitalizations_daily_increase',
+            'hospitalizations_weekly_increase', 'hospitalizations_two_weeks_increase',
+            'hospitalizations_monthly_increase', 'ic_daily_increase', 'ic_weekly_increase', 'ic_two_weeks_increase',
+            'ic_monthly_increase', 'new_hospitalizations_ma_1w', 'new_hospitalizations_ma_2w', 'new_ic_ma_1w',
+            'new_ic_ma_2w', 'hospitalization_ratio_2w', 'hospitalization_ratio_total', 'hospitalization_ic_ratio_2w',
+            'hospitalization_ic_ratio_total'])
 
 
 class VaccinationData:
@@ -264,11 +834,9 @@ class VaccinationData:
         df = self.df_vaccination_general.sort_values(['date', 'autonomous_region']).replace({None: np.nan})\
             .set_index('date')
         df['new_vaccinations'] = df.groupby(['autonomous_region'])['number_fully_vaccinated_people'].diff()
-        new_vaccinations_ma = df.groupby('autonomous_region')['new_vaccinations'].rolling('7D').mean()
-        self.df_vaccination_general = pd.merge(df, new_vaccinations_ma, on=['autonomous_region', 'date'])\
-            .rename(columns={'new_vaccinations_x': 'new_vaccinations', 'new_vaccinations_y': 'new_vaccinations_ma_7d'})\
-            .reset_index()\
-            .replace({np.nan: None})
+        df['new_vaccinations_ma_7d'] = RollingWindows(df, ['autonomous_region']).calculate(
+            {'new_vaccinations_ma_7d': ('new_vaccinations', '7D', 'mean')})['new_vaccinations_ma_7d']
+        self.df_vaccination_general = df.reset_index().replace({np.nan: None})
 
     def __move_ages_data__(self):
         """Just move the ages data from the extracted to the analyzed database"""
@@ -463,17 +1031,24 @@ class PopulationPyramidVariation:
 class DiagnosticTests:
     """Dataset with the number of diagnostic tests made each day on each Autonomous Region"""
 
+    analysis_version = 1  # increase it when the results change, so the whole history is recomputed
+
     def __init__(self):
         """Load the datasets"""
         # Connection to the extracted data database for reading, and to the analyzed data for writing
         self.db_read = MongoDatabase(MongoDatabase.extracted_db_name)
         self.db_write = MongoDatabase(MongoDatabase.analyzed_db_name)
 
-        # Load the diagnostic tests, Spanish population and COVID cases datasets
-        self.diagnostic_tests_df = self.db_read.read_data('diagnostic_tests')
+        # Load the Spanish population dataset (the diagnostic tests are loaded by the analysis)
         self.population_df = self.db_read.read_data('population_ar', {'age_range': 'total'},
                                                     ['autonomous_region', 'total'])
 
+        # The total number of tests and the average positivity accumulate the whole history, so it's always analyzed
+        # (it's small), but only the results of the last days are stored
+        self.analysis = IncrementalAnalysis(self.db_write, 'diagnostic_tests', ['date', 'autonomous_region'], None,
+                                            IncrementalAnalysis.inputs_version(DiagnosticTests.analysis_version,
+                                                                               ['population_ar.csv']))
+
     def __process_dataset__(self):
         """
             Get the data for the whole country, the total number of tests, the average positivity, and the number of
@@ -490,13 +1065,13 @@ class DiagnosticTests:
         self.diagnostic_tests_df = pd.concat([self.diagnostic_tests_df, diagnostics_df_total])
         self.diagnostic_tests_df = self.diagnostic_tests_df.sort_values(by=['date', 'autonomous_region'])
 
-        # Moving average for positivity (the positivity line is very sharp)
+        # Moving averages for positivity (the positivity line is very sharp) and for the number of tests
         diagnostics_df = self.diagnostic_tests_df.set_index('date')
-        positivity_ma = diagnostics_df.groupby('autonomous_region')['positivity'].rolling('14D').mean()
-        self.diagnostic_tests_df = pd.merge(diagnostics_df, positivity_ma, on=['autonomous_region', 'date'])\
-            .rename(columns={'positivity_x': 'positivity', 'positivity_y': 'positivity_ma_14d'}) \
-            .reset_index() \
-            .replace({np.nan: None})
+        moving_averages = RollingWindows(diagnostics_df, ['autonomous_region']).calculate({
+            'positivity_ma_14d': ('positivity', '14D', 'mean'),
+            'new_diagnostic_tests_ma_14d': ('total_diagnostic_tests', '14D', 'mean')})
+        diagnostics_df['positivity_ma_14d'] = moving_averages['positivity_ma_14d']
+        self.diagnostic_tests_df = diagnostics_df.reset_index().replace({np.nan: None})
 
         # Number of total tests
         diagnostic_tests_df_total = self.diagnostic_tests_df[['date', 'autonomous_region', 'total_diagnostic_tests']] \
@@ -506,14 +1081,9 @@ class DiagnosticTests:
             columns={'total_diagnostic_tests_x': 'new_diagnostic_tests',
                      'total_diagnostic_tests_y': 'total_diagnostic_tests'})
 
-        # Moving average for number of total tests
-        diagnostics_df = self.diagnostic_tests_df.set_index('date')
-        diagnostics_ma = diagnostics_df.groupby('autonomous_region')['new_diagnostic_tests'].rolling('14D').mean()
-        self.diagnostic_tests_df = pd.merge(diagnostics_df, diagnostics_ma, on=['autonomous_region', 'date'])\
-            .rename(columns={'new_diagnostic_tests_x': 'new_diagnostic_tests',
-                             'new_diagnostic_tests_y': 'new_diagnostic_tests_ma_14d'}) \
-            .reset_index() \
-            .replace({np.nan: None})
+        # Moving average for number of total tests (the merge keeps the order of the rows)
+        self.diagnostic_tests_df['new_diagnostic_tests_ma_14d'] = moving_averages['new_diagnostic_tests_ma_14d']
+        self.diagnostic_tests_df = self.diagnostic_tests_df.replace({np.nan: None})
 
         # Average positivity for each Autonomous Region
         diagnostic_tests_df_avg_positivity = self.diagnostic_tests_df[
@@ -533,16 +1103,19 @@ class DiagnosticTests:
             'total_diagnostic_tests'] / diagnostics_population_df['population']
         self.diagnostic_tests_df = diagnostics_population_df.drop(columns='population')
 
-    def __store_data__(self):
-        """Store the processed dataset in the database"""
-        mongo_data = self.diagnostic_tests_df.replace({np.nan: None}).to_dict('records')
-        collection = 'diagnostic_tests'
-        self.db_write.store_data(collection, mongo_data)
+    def __load_data__(self, start):
+        """Load the diagnostic tests dataset (the whole history, whatever the first date to be recomputed is)"""
+        return self.db_read.read_data('diagnostic_tests')
+
+    def __calculate__(self, diagnostic_tests_df):
+        """Analyze the diagnostic tests and return the processed dataset"""
+        self.diagnostic_tests_df = diagnostic_tests_df
+        self.__process_dataset__()
+        return self.diagnostic_tests_df.replace({np.nan: None})
 
     def process_and_store(self):
         """Analyze the data, calculate some new variables, and store the results to the database"""
-        self.__process_dataset__()
-        self.__store_data__()
+        self.analysis.run(self.__load_data__, self.__calculate__, self.analysis.start())
 
 
 class OutbreaksDescription:
@@ -571,17 +1144,23 @@ class OutbreaksDescription:
 class HospitalsPressure:
     """Hospitals pressure in Spain"""
 
+    analysis_version = 1  # increase it when the results change, so the whole history is recomputed
+    lookback_days = 14  # moving average of the beds percentages
+
     def __init__(self):
-        """Load the dataset"""
+        """Connect to the databases (the hospitals pressure data is loaded by the analysis)"""
         # Connection to the extracted data database for reading, and to the analyzed data for writing
         self.db_read = MongoDatabase(MongoDatabase.extracted_db_name)
         self.db_write = MongoDatabase(MongoDatabase.analyzed_db_name)
 
-        # Load the hospitals pressure data
-        self.hospitals_pressure = self.db_read.read_data('hospitals_pressure',
-                                                         projection=['autonomous_region', 'date',
-                                                                     'hospitalized_patients', 'beds_percentage',
-                                                                     'ic_patients', 'ic_beds_percentage'])
+        self.analysis = IncrementalAnalysis(self.db_write, 'hospitals_pressure', ['date', 'autonomous_region'],
+                                            HospitalsPressure.lookback_days, HospitalsPressure.analysis_version)
+
+    def __load_data__(self, start):
+        """Load the hospitals pressure data from a date, or the whole history for None"""
+        return self.db_read.read_data('hospitals_pressure', {'date': {'$gte': start}} if start else None,
+                                      projection=['autonomous_region', 'date', 'hospitalized_patients',
+                                                  'beds_percentage', 'ic_patients', 'ic_beds_percentage'])
 
     def __aggregate_data__(self):
         """Calculate the data for the whole country"""
@@ -596,26 +1175,23 @@ class HospitalsPressure:
     def __calculate_ma__(self):
         """Calculate the moving average for the beds percentages, since the data can be very sharp"""
         hospitals_pressure_df = self.hospitals_pressure.set_index('date')
-        hospitals_ma = hospitals_pressure_df.groupby('autonomous_region')[['beds_percentage', 'ic_beds_percentage']]\
-            .rolling('14D').mean()
-        self.hospitals_pressure = pd.merge(hospitals_pressure_df, hospitals_ma, on=['autonomous_region', 'date'])\
-            .rename(columns={'beds_percentage_x': 'beds_percentage', 'beds_percentage_y': 'beds_percentage_ma_14d',
-                             'ic_beds_percentage_x': 'ic_beds_percentage',
-                             'ic_beds_percentage_y': 'ic_beds_percentage_ma_14d'}) \
+        moving_averages = RollingWindows(hospitals_pressure_df, ['autonomous_region']).calculate({
+            'beds_percentage_ma_14d': ('beds_percentage', '14D', 'mean'),
+            'ic_beds_percentage_ma_14d': ('ic_beds_percentage', '14D', 'mean')})
+        self.hospitals_pressure = hospitals_pressure_df.assign(**moving_averages) \
             .reset_index() \
             .replace({np.nan: None})
 
-    def transform_and_store(self):
-        """Analyze the data, calculate some new variables, and store the results to the database"""
+    def __calculate__(self, hospitals_pressure):
+        """Analyze the hospitals pressure data and return the results"""
+        self.hospitals_pressure = hospitals_pressure
         self.__aggregate_data__()
         self.__calculate_ma__()
-        self.__store_data__()
+        return self.hospitals_pressure
 
-    def __store_data__(self):
-        """Store the outbreaks description in the database"""
-        mongo_data = self.hospitals_pressure.to_dict('records')
-        collection = 'hospitals_pressure'
-        self.db_write.store_data(collection, mongo_data)
+    def transform_and_store(self):
+        """Analyze the data, calculate some new variables, and store the results to the database"""
+        self.analysis.run(self.__load_data__, self.__calculate__, self.analysis.start())
 
 
 class TransmissionIndicators:
@@ -676,20 +1252,28 @@ class DataAnalysisTaskGroup(TaskGroup):
                       dag=dag)
 
         # Instantiate the operators
-        PythonOperator(task_id='analyze_cases_data',
-                       python_callable=DataAnalysisTaskGroup.analyze_daily_cases,
-                       task_group=self,
-                       dag=dag)
+        prepare_daily_data_op = PythonOperator(task_id='prepare_daily_data',
+                                               python_callable=DataAnalysisTaskGroup.prepare_daily_data,
+                                               task_group=self,
+                                               dag=dag)
+
+        analyze_cases_data_op = PythonOperator(task_id='analyze_cases_data',
+                                               python_callable=DataAnalysisTaskGroup.analyze_daily_cases,
+                                               task_group=self,
+                                               dag=dag)
 
         analyze_deaths_data_op = PythonOperator(task_id='analyze_deaths_data',
                                                 python_callable=DataAnalysisTaskGroup.analyze_daily_deaths,
                                                 task_group=self,
                                                 dag=dag)
 
-        PythonOperator(task_id='analyze_hospitalizations_data',
-                       python_callable=DataAnalysisTaskGroup.analyze_daily_hospitalizations,
-                       task_group=self,
-                       dag=dag)
+        analyze_hospitalizations_data_op = PythonOperator(task_id='analyze_hospitalizations_data',
+                                                          python_callable=DataAnalysisTaskGroup.
+                                                          analyze_daily_hospitalizations,
+                                                          task_group=self,
+                                                          dag=dag)
+
+        prepare_daily_data_op >> [analyze_cases_data_op, analyze_deaths_data_op, analyze_hospitalizations_data_op]
 
         analyze_death_causes_op = PythonOperator(task_id='analyze_death_causes',
                                                  python_callable=DataAnalysisTaskGroup.analyze_death_causes,
@@ -735,21 +1319,30 @@ class DataAnalysisTaskGroup(TaskGroup):
                        dag=dag)
 
     @staticmethod
-    def analyze_daily_cases():
+    def prepare_daily_data(run_id, dag_run=None):
+        """Write the snapshot of the daily COVID dataset merged with the population, read by the next tasks"""
+        IncrementalAnalysis.set_mode(dag_run)
+        DailyCOVIDData.write_snapshot(run_id)
+
+    @staticmethod
+    def analyze_daily_cases(run_id, dag_run=None):
         """Analyze the cases data in the daily COVID dataset"""
-        data = DailyCOVIDData()
+        IncrementalAnalysis.set_mode(dag_run)
+        data = DailyCOVIDData.from_snapshot(run_id)
         data.process_and_store_cases()
 
     @staticmethod
-    def analyze_daily_deaths():
+    def analyze_daily_deaths(run_id, dag_run=None):
         """Analyze the deaths data in the daily COVID dataset"""
-        data = DailyCOVIDData()
+        IncrementalAnalysis.set_mode(dag_run)
+        data = DailyCOVIDData.from_snapshot(run_id)
         data.process_and_store_deaths()
 
     @staticmethod
-    def analyze_daily_hospitalizations():
+    def analyze_daily_hospitalizations(run_id, dag_run=None):
         """Analyze the hospitalizations data in the daily COVID dataset"""
-        data = DailyCOVIDData()
+        IncrementalAnalysis.set_mode(dag_run)
+        data = DailyCOVIDData.from_snapshot(run_id)
         data.process_and_store_hospitalizations()
 
     @staticmethod
@@ -771,14 +1364,16 @@ class DataAnalysisTaskGroup(TaskGroup):
         data.move_data()
 
     @staticmethod
-    def analyze_hospitals_pressure():
+    def analyze_hospitals_pressure(dag_run=None):
         """Analyze the hospitals pressure data"""
+        IncrementalAnalysis.set_mode(dag_run)
         data = HospitalsPressure()
         data.transform_and_store()
 
     @staticmethod
-    def analyze_diagnostic_tests():
+    def analyze_diagnostic_tests(dag_run=None):
         """Analyze the diagnostic tests data"""
+        IncrementalAnalysis.set_mode(dag_run)
         data = DiagnosticTests()
         data.process_and_store()
 
@@ -2,8 +2,8 @@
     Download the reports from the Ministry of Health, extract the data from the PDFs, and store it in the database.
 """
 
+import json
 import os
-import pickle
 import re
 import requests
 from datetime import datetime as dt, timedelta as td
@@ -11,42 +11,46 @@ from datetime import datetime as dt, timedelta as td
 from airflow.operators.python import PythonOperator
 from airflow.utils.task_group import TaskGroup
 
-from AuxiliaryFunctions import PDFReport, MongoDatabase
+from AuxiliaryFunctions import DownloadManager, PageTokens, PDFReport, MongoDatabase, RawFileStore
 
 
 class MHealthPDFReport(PDFReport):
     """Represent a Ministry of Health report"""
 
-    def __init__(self, directory, filename):
-        super().__init__(directory, filename)
-
-        # Extract the tables names
-        self.__extract_tables_names_index__()
-
-    def __extract_date__(self, reader):
+    table_names_regexes = {
+        'hospital_pressure': re.compile('Tabla [1-9]+\\. Situación capacidad asistencial'),
+        'hospital_cases': re.compile('Tabla [1-9]+\\. Casos (de )?COVID-19.+, ingreso en UCI'),
+        'outbreaks_description': re.compile('Tabla [0-9]+\\. Distribución del nº de brotes y casos por ámbito')
+    }
+
+    # Remove information between parenthesis and notes at the end of the page, and put together the separated words
+    # compounding one sentence
+    outbreaks_replacements = [
+        (re.compile('\\([A-zÀ-ú, \\.]+\\)'), ''),
+        (re.compile(', etc.'), ''),
+        (re.compile(', '), '/'),
+        (re.compile(' y/o '), '/'),
+        (re.compile('1 A efectos de notificación .* de un mismo domicilio.'), ''),
+        (re.compile('([A-zÀ-ú]) ([A-zÀ-ú])'), '\\1_\\2'),
+        (re.compile('([A-zÀ-ú]) ([A-zÀ-ú])'), '\\1_\\2')
+    ]
+
+    def __init__(self, path, number):
+        super().__init__(path, number)
+
+        # The outbreaks table is displayed in two pages: extract the second one too, so it's kept with the processed
+        # report
+        table_number = self.tables_index_names.get('outbreaks_description')
+        if table_number in self.tables_index_numbers and self.tables_index_numbers[table_number] + 1 < len(self.pages):
+            _ = self.pages[self.tables_index_numbers[table_number] + 1]
+            self.pages.close()
+
+    def __extract_date__(self, metadata):
         """Extract the report date from the PDF file metadata"""
-        date_string = reader.documentInfo['/CreationDate'][2:10]
+        date_string = metadata['CreationDate'][2:10]
         date_object = dt(int(date_string[0:4]), int(date_string[4:6]), int(date_string[6:8]))
         return date_object
 
-    def __extract_tables_names_index__(self):
-        """Map the table name to the table number"""
-        hospital_pressure_regex = 'Tabla [1-9]+\. Situación capacidad asistencial'
-        hospital_cases_regex = 'Tabla [1-9]+\. Casos (de )?COVID-19.+, ingreso en UCI'
-        outbreaks_description_regex = 'Tabla [0-9]+\. Distribución del nº de brotes y casos por ámbito'
-
-        regex_list = {'hospital_pressure': hospital_pressure_regex,
-                      'hospital_cases': hospital_cases_regex,
-                      'outbreaks_description': outbreaks_description_regex}
-
-        for table_name, regex in regex_list.items():
-            for page in self.pages:
-                match_result = re.search(regex, page)
-                if match_result:  # one table of interest was found
-                    table_number = int(re.match('Tabla [0-9]+', match_result.group()).group()[6:])
-                    self.tables_index_names[table_name] = int(table_number)
-                    break
-
     def get_hospital_pressure(self):
         """Return the hospital pressure data for this report or None if it's not available in this report"""
         hospital_pressure_report = []
@@ -128,19 +132,8 @@ class MHealthPDFReport(PDFReport):
 
             table_page = table_page_1 + ' ' + table_page_2
 
-            # Remove information between parenthesis and notes at the end of the page, and put together the separated
-            # words compounding one sentence
-            replacements = [
-                ('\([A-zÀ-ú, \.]+\)', ''),
-                (', etc.', ''),
-                (', ', '/'),
-                (' y/o ', '/'),
-                ('1 A efectos de notificación .* de un mismo domicilio.', ''),
-                ('([A-zÀ-ú]) ([A-zÀ-ú])', '\\1_\\2'),
-                ('([A-zÀ-ú]) ([A-zÀ-ú])', '\\1_\\2')
-            ]
-            for regex, replace in replacements:
-                table_page = re.sub(regex, replace, table_page)
+            for regex, replace in MHealthPDFReport.outbreaks_replacements:
+                table_page = regex.sub(replace, table_page)
 
             # Split the tables
             table = table_page.split()
@@ -154,6 +147,9 @@ class MHealthPDFReport(PDFReport):
                         table[word_index] = 'Otro'
                         break
 
+            # Index the position of every word, since the rows are looked for from the beginning of their scope
+            table_tokens = PageTokens(' '.join(table), indexed=True)
+
             # Get all the row keys
             row_keys = list(filter(lambda x: any(c.isalpha() for c in x), table))
             scope = ''
@@ -167,12 +163,12 @@ class MHealthPDFReport(PDFReport):
                     scope = current_key
 
                 # Iterate row by row
+                scope_start = table_tokens.index(scope)
                 if i < len(row_keys) - 1:
-                    row = table[
-                          table.index(current_key, table.index(scope)) + 1:table.index(row_keys[i + 1],
-                                                                                       table.index(scope))]
+                    row = table[table_tokens.index(current_key, scope_start) + 1:
+                                table_tokens.index(row_keys[i + 1], scope_start)]
                 else:
-                    row = table[table.index(current_key, table.index(scope)) + 1:]
+                    row = table[table_tokens.index(current_key, scope_start) + 1:]
 
                 if len(row) == 6:
                     # 6 columns: accumulated outbreaks, accumulated cases, accumulated cases/outbreak, new oubreaks,
@@ -258,6 +254,18 @@ class PDFMhealthTaskGroup(TaskGroup):
 
     reports_directory = 'mhealth_reports'
     processed_reports_directory = reports_directory + '/processed'
+    processes = None  # number of processes for processing the reports (None: one per core)
+
+    # Collections where the data extracted from the reports is stored, with the report method extracting it, its version
+    # and the fields identifying each document
+    extractors = {'hospitals_pressure': ('get_hospital_pressure', 1, ['date', 'autonomous_region']),
+                  'outbreaks_description': ('get_outbreaks_description', 1, ['date', 'scope', 'subscope'])}
+    reports_index_file = reports_directory + '/reports_index.json'
+    reports_url = 'https://www.mscbs.gob.es/profesionales/saludPublica/ccayes/alertasActual/nCov/documentos/' \
+                  'Actualizacion_{index}_COVID-19.pdf'
+    first_report_number = 55  # the first report to work with will be the number 55 (25th March 2020)
+    missing_checks = 3  # runs in which a report must not be found to be considered never published
+    recent_reports = 10  # a missing report can still be published until this number of newer reports are published
     mongo_collection_name = 'covid_extracted_data'
 
     def __init__(self, dag):
@@ -288,80 +296,137 @@ class PDFMhealthTaskGroup(TaskGroup):
     @staticmethod
     def download_mhealth_reports():
         """Download all the PDF reports released by the Ministry of Health"""
-        url = 'https://www.mscbs.gob.es/profesionales/saludPublica/ccayes/alertasActual/nCov/documentos/Actualizacion_' \
-              '{index}_COVID-19.pdf'
-
-        report_number = 55  # the first report to work with will be the number 55 (25th March 2020)
-
-        if PDFMhealthTaskGroup.reports_directory not in os.listdir():
-            os.mkdir(PDFMhealthTaskGroup.reports_directory)  # create the folder for downloading the reports
-
-        while True:
-            # Download report by report, until there are no more available
-            if '{}.pdf'.format(report_number) not in os.listdir(PDFMhealthTaskGroup.reports_directory):
-                # Just download the report if it hasn't been downloaded yet
-                print("Downloading report %i" % report_number)
-                request = requests.get(url.format(index=report_number))
-                if request.status_code < 400:
-                    with open("mhealth_reports/{number}.pdf".format(number=report_number), "wb") as file:
-                        file.write(request.content)
-                else:
-                    # No more reports available
+        os.makedirs(PDFMhealthTaskGroup.reports_directory, exist_ok=True)  # folder for the reports index and cache
+        store = RawFileStore(PDFMhealthTaskGroup.reports_directory)
+        if not store:
+            store.import_directory(PDFMhealthTaskGroup.reports_directory, '.pdf')  # reports downloaded before the store
+
+        download_manager = DownloadManager()
+        downloaded_numbers = {int(name[:-4]) for name in store}
+        reports_index = PDFMhealthTaskGroup.__read_reports_index__()
+        missing_reports = reports_index['missing']  # report number -> times not found, and latest report then
+
+        # Find the number of the latest report, starting from the latest one known
+        last_known_number = max([reports_index['last_report'], PDFMhealthTaskGroup.first_report_number - 1,
+                                 *downloaded_numbers])
+        last_report_number = PDFMhealthTaskGroup.__find_last_report_number__(download_manager, last_known_number)
+        print("The latest report is the number %i" % last_report_number)
+
+        # Download all the reports not downloaded yet, in parallel. A report that wasn't found (the server can also
+        # fail temporarily) is requested again until it hasn't been found several times, and while it's recent.
+        def never_published(number):
+            missing = missing_reports.get(str(number))
+            return missing is not None and missing['checks'] >= PDFMhealthTaskGroup.missing_checks and \
+                missing['last_report'] >= number + PDFMhealthTaskGroup.recent_reports
+
+        report_numbers = [number for number in range(PDFMhealthTaskGroup.first_report_number, last_report_number + 1)
+                          if number not in downloaded_numbers and not never_published(number)]
+        if report_numbers:
+            print("Downloading reports %s" % ', '.join(str(number) for number in report_numbers))
+
+        results = store.download_files(download_manager, [(PDFMhealthTaskGroup.reports_url.format(index=number),
+                                                           "{number}.pdf".format(number=number))
+                                                          for number in report_numbers])
+        for number, result in zip(report_numbers, results):
+            if result.status_code == 404:
+                checks = missing_reports.get(str(number), {}).get('checks', 0)
+                missing_reports[str(number)] = {'checks': checks + 1, 'last_report': last_report_number}
+            elif result.status_code is not None and result.status_code < 400:
+                missing_reports.pop(str(number), None)
+
+        download_manager.print_timings()
+        PDFMhealthTaskGroup.__write_reports_index__({'last_report': last_report_number, 'missing': missing_reports})
+
+    @staticmethod
+    def __find_last_report_number__(download_manager, last_known_number):
+        """
+            Find the number of the latest published report with a galloping search: check the reports after the last
+            known one at exponentially growing distances until one of them is not published, and then narrow down the
+            interval between the last published report and the first unpublished one. All the checks of each round are
+            sent at the same time as HEAD requests, so only O(log n) round trips are needed.
+        """
+        def is_published(number):
+            url = PDFMhealthTaskGroup.reports_url.format(index=number)
+            try:
+                response = download_manager.head(url)
+                if response.status_code in [405, 501]:
+                    # HEAD requests not allowed: request the file, but close the connection without reading it
+                    with download_manager.get(url, stream=True) as response:
+                        pass
+            except requests.RequestException as e:
+                print("Could not check the report %i: %s" % (number, e))
+                return False  # it will be checked again in the next run
+
+            return response.status_code < 400
+
+        def check_reports(numbers):
+            """Return the last published report and the first unpublished one (or None) in a list of numbers"""
+            published, unpublished = None, None
+            for number, number_published in zip(numbers, download_manager.map(is_published, numbers)):
+                if not number_published:
+                    unpublished = number
                     break
-            report_number += 1
+                published = number
+            return published, unpublished
+
+        checks_per_round = download_manager.max_workers
+        last_published = last_known_number
+        first_unpublished = None
+
+        # Galloping: last known + 1, + 2, + 4, + 8...
+        distance = 1
+        while first_unpublished is None:
+            numbers = [last_published + distance * 2 ** i for i in range(checks_per_round)]
+            published, first_unpublished = check_reports(numbers)
+            last_published = published or last_published
+            distance *= 2 ** checks_per_round
+
+        # Search between the last published report and the first unpublished one
+        while first_unpublished - last_published > 1:
+            interval = first_unpublished - last_published
+            numbers = sorted({last_published + interval * (i + 1) // (checks_per_round + 1)
+                              for i in range(checks_per_round)} - {last_published, first_unpublished})
+            published, unpublished = check_reports(numbers)
+            last_published = published or last_published
+            first_unpublished = unpublished or first_unpublished
+
+        return last_published
+
+    @staticmethod
+    def __read_reports_index__():
+        """
+            Read the number of the latest report found and the reports not found: for each number, the times it wasn't
+            found and the latest report number the last time.
+        """
+        try:
+            with open(PDFMhealthTaskGroup.reports_index_file, 'r') as f:
+                reports_index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'last_report': 0, 'missing': {}}
+
+        if isinstance(reports_index['missing'], list):
+            # Index written before the missing reports were checked again: they have only been checked once
+            reports_index['missing'] = {str(number): {'checks': 1, 'last_report': reports_index['last_report']}
+                                        for number in reports_index['missing']}
+
+        return reports_index
+
+    @staticmethod
+    def __write_reports_index__(reports_index):
+        """Replace the file with the latest report number and the reports not found atomically"""
+        with open(PDFMhealthTaskGroup.reports_index_file + '.part', 'w') as f:
+            json.dump(reports_index, f, sort_keys=True)
+        os.replace(PDFMhealthTaskGroup.reports_index_file + '.part', PDFMhealthTaskGroup.reports_index_file)
 
     @staticmethod
     def process_pdfs():
-        """Process the PDF files and save the processed data"""
-        file_list = list(filter(lambda x: x.endswith('.pdf'), os.listdir(PDFMhealthTaskGroup.reports_directory)))
-
-        # If it hadn't been created, create the directory where the processed files will be stored
-        os.makedirs(PDFMhealthTaskGroup.processed_reports_directory, exist_ok=True)
-
-        for filename in file_list:
-            processed_report_filename = filename[:-4] + '.bin'
-            if processed_report_filename not in os.listdir(PDFMhealthTaskGroup.processed_reports_directory):
-                # Process only the new reports
-                print("Processing RENAVE report %s" % filename)
-                try:
-                    report = MHealthPDFReport(PDFMhealthTaskGroup.reports_directory, filename)
-                    with open(PDFMhealthTaskGroup.processed_reports_directory + '/' + processed_report_filename, 'wb') \
-                            as f:
-                        # Store the processed report as a file, so it can be read later in the next task
-                        pickle.dump(report, f)
-                except Exception:
-                    # Error processing the report
-                    print("Error processing the report %i. Skipping it." % filename)
+        """Process the new PDF files in parallel and save the processed data"""
+        MHealthPDFReport.process_reports(RawFileStore(PDFMhealthTaskGroup.reports_directory),
+                                         PDFMhealthTaskGroup.processed_reports_directory, PDFMhealthTaskGroup.processes)
 
     @staticmethod
     def extract_and_store():
-        """Read the processed PDF files, extract the information, and store it into the database"""
-        reports = []
-        documents_hospitals_pressure = []
-        documents_outbreaks_description = []
+        """Extract the information from the processed PDF files not extracted yet, and store it into the database"""
         database = MongoDatabase(MongoDatabase.extracted_db_name)
-
-        # Read the processed reports
-        processed_reports_files = os.listdir(PDFMhealthTaskGroup.processed_reports_directory)
-        for file in processed_reports_files:
-            with open(PDFMhealthTaskGroup.processed_reports_directory + '/' + file, 'rb') as f:
-                processed_report = pickle.load(f)
-                reports.append(processed_report)
-
-        for report in reports:
-            try:
-                hospitals_pressure = report.get_hospital_pressure()
-                if hospitals_pressure:
-                    documents_hospitals_pressure.extend(hospitals_pressure)
-            except Exception:
-                print("Error trying to extract the hospital pressure from Health Ministry report %i" % report.index)
-
-            try:
-                outbreaks_description = report.get_outbreaks_description()
-                if outbreaks_description:
-                    documents_outbreaks_description.extend(outbreaks_description)
-            except Exception:
-                print("Error trying to extract the transmission indicators from RENAVE report %i" % report.index)
-
-        database.store_data('hospitals_pressure', documents_hospitals_pressure)
-        database.store_data('outbreaks_description', documents_outbreaks_description)
+        MHealthPDFReport.extract_and_store(PDFMhealthTaskGroup.processed_reports_directory, database,
+                                           PDFMhealthTaskGroup.extractors)
@@ -2,28 +2,26 @@
     Download the RENAVE reports, extract the data from the PDFs, and store it in the database.
 """
 import locale
-import os
-import pickle
 import re
-import requests
 from datetime import datetime as dt
 
 from airflow.operators.python import PythonOperator
 from airflow.utils.task_group import TaskGroup
 from bs4 import BeautifulSoup
 
-from AuxiliaryFunctions import PDFReport, MongoDatabase
+from AuxiliaryFunctions import DownloadManager, PageTokens, PDFReport, MongoDatabase, RawFileStore
 
 
 class RenavePDFReport(PDFReport):
     """Represent a RENAVE report"""
 
-    def __extract_date__(self, reader):
+    clinic_removed_symbols_regex = re.compile('[^A-zÀ-ú0-9,. \\-<>]')
+
+    def __extract_date__(self, metadata):
         # Change the locale to the Spanish one, since the date will be in Spanish
         locale.setlocale(locale.LC_ALL, 'es_ES')
 
-        text = reader.getPage(0).extractText()
-        text = ' '.join(text.replace('\n', '').split()).strip()
+        text = self.pages[0]
 
         # The modification/creation date of the PDF report is not the actual report date, so it has to be extracted
         # from the first page. Depending on the report, the sentence before the actual date can be different, that's
@@ -79,7 +77,7 @@ class RenavePDFReport(PDFReport):
         if self.index in range(16, 34):
             # Data only available from report number 12 to 33; reports from 12 to 15 are illegible in that page
             clinic_page = self.get_table_page_by_number(table_number)
-            clinic_page = re.sub('[^A-zÀ-ú0-9,. \-<>]', '', clinic_page).lower()
+            clinic_page = RenavePDFReport.clinic_removed_symbols_regex.sub('', clinic_page).lower()
             clinic_page = clinic_page.replace('enfermedad de base y factores de riesgo',
                                               'enfermedades_previas').replace(
                 'enfermedades y factores de riesgo', 'enfermedades_previas')
@@ -88,7 +86,7 @@ class RenavePDFReport(PDFReport):
             for before, after in symptoms_list.items():
                 clinic_page = clinic_page.replace(' ' + before + ' ', ' ' + after + ' ')
 
-            clinic_table = clinic_page.split()
+            clinic_table = PageTokens(clinic_page, indexed=True)
 
             # Sometimes women ("mujeres") column is before men ("hombres") column, other times after, we need to know
             index_men = clinic_table.index('hombres')
@@ -100,12 +98,17 @@ class RenavePDFReport(PDFReport):
             # Symptoms table
             table_symptoms_start = clinic_table.index('síntomas')
             table_symptoms_end = clinic_table.index('enfermedades_previas', table_symptoms_start)
-            symptoms_table = clinic_table[table_symptoms_start + 1:table_symptoms_end]
+            symptoms_table = clinic_table.tokens[table_symptoms_start + 1:table_symptoms_end]
 
             # Look for symptoms
             for symptom in set(symptoms_list.values()):
-                if symptom in symptoms_table:
-                    row = symptoms_table.index(symptom) + (1 if is_samples_number_column else 0)
+                try:
+                    symptom_position = clinic_table.index(symptom, table_symptoms_start + 1)
+                except ValueError:
+                    continue
+
+                if symptom_position < table_symptoms_end:
+                    row = symptom_position - (table_symptoms_start + 1) + (1 if is_samples_number_column else 0)
 
                     # Number of patients
                     number_of_patients_total = PDFReport.convert_value_to_number(symptoms_table[row + 1])
@@ -218,6 +221,12 @@ class PDFRenaveTaskGroup(TaskGroup):
 
     reports_directory = 'renave_reports'
     processed_reports_directory = reports_directory + '/processed'
+    processes = None  # number of processes for processing the reports (None: one per core)
+
+    # Collections where the data extracted from the reports is stored, with the report method extracting it, its version
+    # and the fields identifying each document
+    extractors = {'clinic_description': ('get_clinic_description', 1, ['date', 'symptom']),
+                  'transmission_indicators': ('get_transmission_indicators', 1, ['date', 'autonomous_region'])}
 
     def __init__(self, dag):
         self.dag = dag
@@ -260,15 +269,17 @@ class PDFRenaveTaskGroup(TaskGroup):
         old_reports_url = base_url + '/QueHacemos/Servicios/VigilanciaSaludPublicaRENAVE/EnfermedadesTransmisibles' \
                                      '/Paginas/-COVID-19.-Informes-previos.aspx'
 
-        if 'renave_reports' not in os.listdir():
-            os.mkdir('renave_reports')  # create the folder for downloading the reports
+        store = RawFileStore(PDFRenaveTaskGroup.reports_directory)
+        if not store:
+            store.import_directory(PDFRenaveTaskGroup.reports_directory, '.pdf')  # reports downloaded before the store
 
         link_title_placeholder = "informe nº"
+        download_manager = DownloadManager()
 
         # Now let's download the HTML of the reports list for searching the PDFs URLs through HTML scrapping
         for url in [old_reports_url, new_reports_url]:
             # Download the HTML page
-            html_reports = requests.get(url)
+            html_reports = download_manager.get(url)
 
             # Scrap the HTML and look for the PDF links
             soup_reports = BeautifulSoup(html_reports.content, 'html.parser')
@@ -283,68 +294,26 @@ class PDFRenaveTaskGroup(TaskGroup):
                     number = int(link_title[index_start + len(link_title_placeholder):index_end])
                     links[number] = link_href
 
-            # Download the PDFs
+            # Download the PDFs that had not been previously downloaded
+            files = []
             for number, report_url in links.items():
-                if '{}.pdf'.format(number) not in os.listdir(PDFRenaveTaskGroup.reports_directory):
-                    # Download the file only if it had not been previously downloaded
+                if '{}.pdf'.format(number) not in store:
                     print("Downloading report number %i: %s" % (number, report_url.replace('%20', ' ')))
-                    request = requests.get(base_url + report_url)
-                    if request.status_code < 400:
-                        with open("renave_reports/{number}.pdf".format(number=number), "wb") as file:
-                            file.write(request.content)
+                    files.append((base_url + report_url, "{number}.pdf".format(number=number)))
 
-    @staticmethod
-    def process_pdfs():
-        """Process the PDF files and save the processed data"""
-        file_list = list(filter(lambda x: x.endswith('.pdf'), os.listdir(PDFRenaveTaskGroup.reports_directory)))
+            store.download_files(download_manager, files)
 
-        # If it hadn't been created, create the directory where the processed files will be stored
-        os.makedirs(PDFRenaveTaskGroup.processed_reports_directory, exist_ok=True)
+        download_manager.print_timings()
 
-        for filename in file_list:
-            processed_report_filename = filename[:-4] + '.bin'
-            if processed_report_filename not in os.listdir(PDFRenaveTaskGroup.processed_reports_directory):
-                # Process only the new reports
-                print("Processing RENAVE report %s" % filename)
-                try:
-                    report = RenavePDFReport(PDFRenaveTaskGroup.reports_directory, filename)
-                    with open(PDFRenaveTaskGroup.processed_reports_directory + '/' + processed_report_filename, 'wb') \
-                            as f:
-                        # Store the processed report as a file, so it can be read later in the next task
-                        pickle.dump(report, f)
-                except Exception:
-                    # Error processing the report
-                    print("Error processing the report %s. Skipping it." % filename)
+    @staticmethod
+    def process_pdfs():
+        """Process the new PDF files in parallel and save the processed data"""
+        RenavePDFReport.process_reports(RawFileStore(PDFRenaveTaskGroup.reports_directory),
+                                        PDFRenaveTaskGroup.processed_reports_directory, PDFRenaveTaskGroup.processes)
 
     @staticmethod
     def extract_and_store():
-        """Read the processed PDF files, extract the information, and store it into the database"""
-        reports = []
-        documents_clinic_description = []
-        documents_transmission_indicators = []
+        """Extract the information from the processed PDF files not extracted yet, and store it into the database"""
         database = MongoDatabase(MongoDatabase.extracted_db_name)
-
-        # Read the processed reports
-        processed_reports_files = os.listdir(PDFRenaveTaskGroup.processed_reports_directory)
-        for file in processed_reports_files:
-            with open(PDFRenaveTaskGroup.processed_reports_directory + '/' + file, 'rb') as f:
-                processed_report = pickle.load(f)
-                reports.append(processed_report)
-
-        for report in reports:
-            try:
-                clinic_description = report.get_clinic_description()
-                if clinic_description:
-                    documents_clinic_description.extend(clinic_description)
-            except Exception:
-                print("Error trying to extract the clinic description from RENAVE report %i" % report.index)
-
-            try:
-                transmission_indicators = report.get_transmission_indicators()
-                if transmission_indicators:
-                    documents_transmission_indicators.extend(transmission_indicators)
-            except Exception:
-                print("Error trying to extract the transmission indicators from RENAVE report %i" % report.index)
-
-        database.store_data('clinic_description', documents_clinic_description)
-        database.store_data('transmission_indicators', documents_transmission_indicators)
+        RenavePDFReport.extract_and_store(PDFRenaveTaskGroup.processed_reports_directory, database,
+                                          PDFRenaveTaskGroup.extractors)
@@ -1,18 +1,24 @@
+import json
 import os
-import requests
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from airflow.operators.python import PythonOperator
 from airflow.utils.task_group import TaskGroup
 from datetime import datetime as dt, timedelta as td
 
-from AuxiliaryFunctions import MongoDatabase
+from AuxiliaryFunctions import DownloadManager, MongoDatabase, RawFileStore, dataframe_to_documents
 
 
 class VaccinationReportsTaskGroup(TaskGroup):
     """TaskGroup that downloads and stores in the database the vaccination reports released by the Ministry of Health"""
 
     reports_folder = 'vaccination_reports'
+    processed_reports_folder = reports_folder + '/processed'
+    missing_reports_file = reports_folder + '/missing_reports.json'
+    parser_version = 1  # increase it when the parsing changes, so the reports are parsed again
+    processes = None  # number of processes for parsing the reports (None: one per core)
     date_filename_format = '%Y%m%d'
+    recent_days = 14  # a missing report can still be published during these days after its date
 
     def __init__(self, dag):
         # Instantiate the TaskGroup
@@ -37,9 +43,11 @@ class VaccinationReportsTaskGroup(TaskGroup):
     def download_vaccination_reports():
         """Download the vaccination reports from the Ministry of Health website"""
 
-        # Create the folder for the vaccination reports, if it didn't exist yet
-        if VaccinationReportsTaskGroup.reports_folder not in os.listdir():
-            os.mkdir(VaccinationReportsTaskGroup.reports_folder)
+        # Create the folder for the index of missing reports, if it didn't exist yet
+        os.makedirs(VaccinationReportsTaskGroup.reports_folder, exist_ok=True)
+        store = RawFileStore(VaccinationReportsTaskGroup.reports_folder)
+        if not store:
+            store.import_directory(VaccinationReportsTaskGroup.reports_folder, '.ods')  # reports downloaded before
 
         date_current_file = dt(2021, 1, 11)
         today = dt.today()
@@ -47,145 +55,88 @@ class VaccinationReportsTaskGroup(TaskGroup):
         base_url = 'https://www.mscbs.gob.es/profesionales/saludPublica/ccayes/alertasActual/nCov/documentos/'
         filename_url = 'Informe_Comunicacion_{date}.ods'
 
-        # Download all the vaccination reports
-        while True:
-            filename = filename_url.format(date=date_current_file.strftime(
-                VaccinationReportsTaskGroup.date_filename_format))
-            if filename not in os.listdir(VaccinationReportsTaskGroup.reports_folder):
-                request = requests.get(
-                    base_url + filename.format(date=date_current_file.strftime(
-                        VaccinationReportsTaskGroup.date_filename_format)))
-                if request.status_code < 400:
-                    # Download the report and go for the next one
-                    print(f"Downloading report {filename}")
-                    with open(VaccinationReportsTaskGroup.reports_folder + '/' + filename, 'wb') as f:
-                        f.write(request.content)
+        # Dates whose report has already been downloaded or is known to be missing (weekends, holidays...)
+        downloaded_dates = {name[-12:-4] for name in store}
+        missing_dates = VaccinationReportsTaskGroup.__read_missing_reports__()  # report date -> date last checked
+
+        # List the vaccination reports that could have been published and have not been downloaded yet. A missing
+        # report expires from the list of missing ones while it's recent, but once it has been checked after the
+        # recent days, there won't be a report for that date anymore.
+        files = []
+        while date_current_file < today:
+            date_string = date_current_file.strftime(VaccinationReportsTaskGroup.date_filename_format)
+            recent_limit = (date_current_file + td(days=VaccinationReportsTaskGroup.recent_days)).strftime(
+                VaccinationReportsTaskGroup.date_filename_format)
+            if date_string not in downloaded_dates and missing_dates.get(date_string, '') < recent_limit:
+                filename = filename_url.format(date=date_string)
+                files.append((base_url + filename, filename))
 
             date_current_file = date_current_file + td(days=1)
 
-            if date_current_file == today:
-                # No more reports available
-                break
+        # Download them concurrently
+        download_manager = DownloadManager()
+        check_date = today.strftime(VaccinationReportsTaskGroup.date_filename_format)
+        for (url, filename), result in zip(files, store.download_files(download_manager, files)):
+            date_string = filename[-12:-4]
+            if result.changed:
+                print(f"Downloaded report {filename}")
+                missing_dates.pop(date_string, None)
+            elif result.status_code == 404:
+                # There is no report for this date
+                missing_dates[date_string] = check_date
+
+        download_manager.print_timings()
+        VaccinationReportsTaskGroup.__write_missing_reports__(missing_dates)
+
+    @staticmethod
+    def __read_missing_reports__():
+        """Read the dates known not to have a report, with the date when each one was last checked"""
+        try:
+            with open(VaccinationReportsTaskGroup.missing_reports_file, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def __write_missing_reports__(missing_dates):
+        """Replace the file with the dates known not to have a report atomically"""
+        with open(VaccinationReportsTaskGroup.missing_reports_file + '.part', 'w') as f:
+            json.dump(missing_dates, f, sort_keys=True)
+        os.replace(VaccinationReportsTaskGroup.missing_reports_file + '.part',
+                   VaccinationReportsTaskGroup.missing_reports_file)
 
     @staticmethod
     def store_vaccination_reports():
-        """Store in the database the downloaded reports"""
+        """Store in the database the downloaded reports, parsing only the ones that have not been parsed yet"""
         vaccination_data = []
         vaccination_single = []
         vaccination_complete = []
 
-        for file in os.listdir(VaccinationReportsTaskGroup.reports_folder):
-            # Read the report
-            df = pd.read_excel(VaccinationReportsTaskGroup.reports_folder + '/' + file, sheet_name=None)
+        store = RawFileStore(VaccinationReportsTaskGroup.reports_folder)
+        VaccinationReportsTaskGroup.parse_reports(store)
 
+        for file in sorted(store):
             # Get the report date
             date_string = file[-12:-4]
             date_report = dt.strptime(date_string, VaccinationReportsTaskGroup.date_filename_format)
             print(f"Reading report of {date_report.isoformat()}")
 
-            # Get the basic vaccination data
-            df_basic_data = df[list(df.keys())[0]]
-
-            # Translate the DataFrame columns
-            columns_translations = {'Unnamed: 0': 'autonomous_region', 'Dosis entregadas (1)': 'received_doses.total',
-                                    'Total Dosis entregadas (1)': 'received_doses.total',
-                                    'Dosis entregadas Pfizer (1)': 'received_doses.Pfizer',
-                                    'Dosis entregadas Moderna (1)': 'received_doses.Moderna',
-                                    'Dosis entregadas AstraZeneca (1)': 'received_doses.AstraZeneca',
-                                    'Dosis entregadas Janssen (1)': 'received_doses.Janssen',
-                                    'Dosis administradas (2)': 'applied_doses',
-                                    '% sobre entregadas': 'percentage_applied_doses',
-                                    'Nº Personas con al menos 1 dosis': 'number_at_least_single_dose_people',
-                                    'Nº Personas vacunadas(pauta completada)': 'number_fully_vaccinated_people',
-                                    'Fecha de la última vacuna registrada (2)': 'date'}
-            df_basic_data = df_basic_data.rename(columns=columns_translations)
-            df_basic_data['autonomous_region'] = df_basic_data['autonomous_region'].replace({'Totales': 'España'})
-
-            # Transform some columns
+            # Read the tables of the report from the cache
+            sha256 = store.get(file).sha256
+            df_basic_data = pd.read_parquet(VaccinationReportsTaskGroup.__cache_path__(sha256, 'general'))
             df_basic_data['date'] = date_report
-            df_basic_data['percentage_applied_doses'] = 100 * df_basic_data['percentage_applied_doses']
-
-            # Save into MongoDB
-            df_dict = df_basic_data.to_dict('records')
-            mongo_data = []
 
-            # Transform the a.b columns into a: {b: ''}
-            for record in df_dict:
-                transformed_record = {}
-                mongo_data.append(transformed_record)
-                for k, v in record.items():
-                    if '.' not in k:
-                        transformed_record[k] = v
-                    else:
-                        key, subkey = k.split('.')
-                        if key not in transformed_record:
-                            transformed_record[key] = {}
+            # Save into MongoDB, transforming the a.b columns into a: {b: ''}
+            vaccination_data.extend(dataframe_to_documents(df_basic_data))
 
-                        transformed_record[key][subkey] = v
-
-            vaccination_data.extend(mongo_data)
-
-            if len(df) > 3:
-                # Newer vaccination reports: get the age ranges
-                df_single_dose = df[list(df.keys())[-2]]
-                df_complete_dose = df[list(df.keys())[-1]]
-
-                for number_doses in ['single', 'complete']:
-                    df_doses = df_single_dose if number_doses == 'single' else df_complete_dose
-
-                    # Remove useless columns and rename the useful ones
-                    columns = df_doses.columns
-
-                    if any(['20-29' in col for col in df_doses.columns]):
-                        # From the last week of June, the reports age range has changed to 12-19, 20-29, 30-39, 40-49...
-                        columns_translations = {'Unnamed: 0': 'autonomous_region', '%': '80+', '%.1': '70-79',
-                                                '%.2': '60-69', '%.3': '50-59', '%.4': '40-49', '%.5': '30-39',
-                                                '%.6': '20-29', '%.7': '12-19', columns[-1]: 'total'}
-                    else:
-                        # Before, it used to be 16-17, 18-24, 25-49 and then 50-59, 60-69...
-                        columns_translations = {'Unnamed: 0': 'autonomous_region', '%': '80+', '%.1': '70-79',
-                                                '%.2': '60-69', '%.3': '50-59', '%.4': '25-49', '%.5': '18-24',
-                                                '%.6': '16-17', columns[-1]: 'total'}
-
-                    if len(columns) > 20:
-                        # For each age range, the sheet contains the number of vaccinated people, the total population
-                        # and the percentage
-                        df_doses = df_doses.drop(
-                            columns=[columns[i] for i in [1, 2, 4, 5, 7, 8, 10, 11, 13, 14, 16, 17, 19, 20, 22, 23]])
-                    else:
-                        # For each age range, the sheet contains the number of vaccinated people and the percentage
-                        df_doses = df_doses.drop(
-                            columns=[columns[i] for i in [1, 3, 5, 7, 9, 11, 13, 15, 17, 18, 19]])
-
-                    df_doses = df_doses.rename(columns=columns_translations)
-                    df_doses['autonomous_region'] = df_doses['autonomous_region'].replace({'Total España': 'España'})
-
-                    # Remove information about the navy
-                    df_doses = df_doses[df_doses['autonomous_region'] != 'Fuerzas Armadas']
-
-                    # Remove invalid data
-                    df_doses = df_doses.dropna()
-
-                    # Trim the autonomous region name (some have a trailing space for unknown reason)
-                    df_doses['autonomous_region'] = df_doses['autonomous_region'].apply(lambda x: x.strip())
-
-                    # Multiply by 100 the percentages
-                    df_doses[df_doses.columns[1:]] = 100 * df_doses[df_doses.columns[1:]]
-
-                    # Add the date to the DataFrame
-                    df_doses['date'] = date_report
-
-                    # Melt age range columns
-                    df_doses = df_doses.melt(id_vars=['autonomous_region', 'date'], var_name='age_range',
-                                             value_name='percentage')
-
-                    # Convert data to dict
-                    df_dict = df_doses.to_dict('records')
-
-                    if number_doses == 'single':
-                        vaccination_single.extend(df_dict)
-                    else:
-                        vaccination_complete.extend(df_dict)
+            for number_doses, vaccination_doses in [('single', vaccination_single),
+                                                    ('complete', vaccination_complete)]:
+                path = VaccinationReportsTaskGroup.__cache_path__(sha256, number_doses)
+                if os.path.exists(path):
+                    # Newer vaccination reports: age ranges
+                    df_doses = pd.read_parquet(path)
+                    df_doses.insert(1, 'date', date_report)
+                    vaccination_doses.extend(dataframe_to_documents(df_doses))
 
         # Store the data in MongoDB
         database = MongoDatabase(MongoDatabase.extracted_db_name)
@@ -193,3 +144,130 @@ class VaccinationReportsTaskGroup(TaskGroup):
         database.store_data("vaccination_ages_single", vaccination_single)
         database.store_data("vaccination_ages_complete", vaccination_complete)
 
+    @staticmethod
+    def parse_reports(store):
+        """
+            Parse the reports whose content has not been parsed yet (by the current version of the parser), spreading
+            them across a pool of processes, and save their tables in the cache.
+            :param store: RawFileStore with the vaccination reports.
+        """
+        os.makedirs(VaccinationReportsTaskGroup.processed_reports_folder, exist_ok=True)
+
+        # The tables are cached by the hash of the report, so a report is parsed only once, even if it's repeated
+        pending_reports = {}
+        for file in sorted(store):
+            raw_file = store.get(file)
+            if not os.path.exists(VaccinationReportsTaskGroup.__cache_path__(raw_file.sha256, 'general')):
+                pending_reports[raw_file.sha256] = raw_file.path
+
+        processes = VaccinationReportsTaskGroup.processes or os.cpu_count()
+        print("Parsing %i reports with %i processes" % (len(pending_reports), processes))
+        if processes == 1 or len(pending_reports) < 2:
+            for sha256, path in pending_reports.items():
+                VaccinationReportsTaskGroup.parse_report(path, sha256)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                list(executor.map(VaccinationReportsTaskGroup.parse_report, pending_reports.values(),
+                                  pending_reports.keys()))
+
+    @staticmethod
+    def parse_report(path, sha256):
+        """
+            Read only the sheets of a report with the data stored in the database (the first one, and the last two
+            with the age ranges in the newer reports), normalize them and save them in the cache.
+            :param path: path of the report.
+            :param sha256: hash of the report, identifying it in the cache.
+        """
+        with pd.ExcelFile(path) as report:
+            sheet_names = report.sheet_names
+            tables = {'general': VaccinationReportsTaskGroup.__normalize_general_data__(report.parse(sheet_names[0]))}
+
+            if len(sheet_names) > 3:
+                # Newer vaccination reports: get the age ranges
+                tables['single'] = VaccinationReportsTaskGroup.__normalize_doses_data__(report.parse(sheet_names[-2]))
+                tables['complete'] = VaccinationReportsTaskGroup.__normalize_doses_data__(report.parse(sheet_names[-1]))
+
+        # The general table is saved the last one, since it marks the report as parsed
+        for table in ['single', 'complete', 'general']:
+            if table in tables:
+                path = VaccinationReportsTaskGroup.__cache_path__(sha256, table)
+                tables[table].to_parquet(path + '.part', index=False)
+                os.replace(path + '.part', path)
+
+    @staticmethod
+    def __cache_path__(sha256, table):
+        """Return the path of a table of a report in the cache"""
+        return '%s/%s.v%i.%s.parquet' % (VaccinationReportsTaskGroup.processed_reports_folder, sha256,
+                                         VaccinationReportsTaskGroup.parser_version, table)
+
+    @staticmethod
+    def __normalize_general_data__(df_basic_data):
+        """Translate and transform the basic vaccination data. The date is set when the report is stored."""
+        # Translate the DataFrame columns
+        columns_translations = {'Unnamed: 0': 'autonomous_region', 'Dosis entregadas (1)': 'received_doses.total',
+                                'Total Dosis entregadas (1)': 'received_doses.total',
+                                'Dosis entregadas Pfizer (1)': 'received_doses.Pfizer',
+                                'Dosis entregadas Moderna (1)': 'received_doses.Moderna',
+                                'Dosis entregadas AstraZeneca (1)': 'received_doses.AstraZeneca',
+                                'Dosis entregadas Janssen (1)': 'received_doses.Janssen',
+                                'Dosis administradas (2)': 'applied_doses',
+                                '% sobre entregadas': 'percentage_applied_doses',
+                                'Nº Personas con al menos 1 dosis': 'number_at_least_single_dose_people',
+                                'Nº Personas vacunadas(pauta completada)': 'number_fully_vaccinated_people',
+                                'Fecha de la última vacuna registrada (2)': 'date'}
+        df_basic_data = df_basic_data.rename(columns=columns_translations)
+        df_basic_data['autonomous_region'] = df_basic_data['autonomous_region'].replace({'Totales': 'España'})
+
+        # Transform some columns
+        df_basic_data['date'] = None
+        df_basic_data['percentage_applied_doses'] = 100 * df_basic_data['percentage_applied_doses']
+
+        return df_basic_data
+
+    @staticmethod
+    def __normalize_doses_data__(df_doses):
+        """
+            Translate and transform the vaccinated people by age range, with one row for each Autonomous Region and
+            age range. The date is set when the report is stored.
+        """
+        # Remove useless columns and rename the useful ones
+        columns = df_doses.columns
+
+        if any(['20-29' in col for col in df_doses.columns]):
+            # From the last week of June, the reports age range has changed to 12-19, 20-29, 30-39, 40-49...
+            columns_translations = {'Unnamed: 0': 'autonomous_region', '%': '80+', '%.1': '70-79',
+                                    '%.2': '60-69', '%.3': '50-59', '%.4': '40-49', '%.5': '30-39',
+                                    '%.6': '20-29', '%.7': '12-19', columns[-1]: 'total'}
+        else:
+            # Before, it used to be 16-17, 18-24, 25-49 and then 50-59, 60-69...
+            columns_translations = {'Unnamed: 0': 'autonomous_region', '%': '80+', '%.1': '70-79',
+                                    '%.2': '60-69', '%.3': '50-59', '%.4': '25-49', '%.5': '18-24',
+                                    '%.6': '16-17', columns[-1]: 'total'}
+
+        if len(columns) > 20:
+            # For each age range, the sheet contains the number of vaccinated people, the total population
+            # and the percentage
+            df_doses = df_doses.drop(
+                columns=[columns[i] for i in [1, 2, 4, 5, 7, 8, 10, 11, 13, 14, 16, 17, 19, 20, 22, 23]])
+        else:
+            # For each age range, the sheet contains the number of vaccinated people and the percentage
+            df_doses = df_doses.drop(
+                columns=[columns[i] for i in [1, 3, 5, 7, 9, 11, 13, 15, 17, 18, 19]])
+
+        df_doses = df_doses.rename(columns=columns_translations)
+        df_doses['autonomous_region'] = df_doses['autonomous_region'].replace({'Total España': 'España'})
+
+        # Remove information about the navy
+        df_doses = df_doses[df_doses['autonomous_region'] != 'Fuerzas Armadas']
+
+        # Remove invalid data
+        df_doses = df_doses.dropna()
+
+        # Trim the autonomous region name (some have a trailing space for unknown reason)
+        df_doses['autonomous_region'] = df_doses['autonomous_region'].apply(lambda x: x.strip())
+
+        # Multiply by 100 the percentages
+        df_doses[df_doses.columns[1:]] = 100 * df_doses[df_doses.columns[1:]]
+
+        # Melt age range columns
+        return df_doses.melt(id_vars=['autonomous_region'], var_name='age_range', value_name='percentage')